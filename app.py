@@ -1,14 +1,36 @@
 import os
+import io
+import abc
+import sys
+import csv
 import json
+import math
+import zlib
+import gzip
 import time
+import queue
+import signal
+import heapq
+import bisect
+import hashlib
 import sqlite3
+import fcntl
+import zipfile
+import functools
+import contextlib
+import itertools
+import tempfile
 import requests
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from flask import Flask, render_template, jsonify, request
-from dataclasses import dataclass, asdict
+from flask import Flask, render_template, jsonify, request, Response, stream_with_context, send_file, g
+from dataclasses import dataclass, asdict, field, replace
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
 import numpy as np
 import logging
+import atexit
 
 # Configurazione logging
 logging.basicConfig(level=logging.INFO)
@@ -21,6 +43,89 @@ SAMPLING_INTERVAL = int(os.environ.get('SAMPLING_INTERVAL', '30'))
 TEST_DURATION_HOURS = int(os.environ.get('TEST_DURATION_HOURS', '336'))  # 2 settimane
 DEBUG_MODE = os.environ.get('DEBUG_MODE', 'true').lower() == 'true'
 
+# Database: commit a gruppi per numero di punti o dopo DB_COMMIT_INTERVAL secondi
+DB_PATH = os.environ.get('DB_PATH', '/data/test_data.db')
+DB_COMMIT_BATCH_SIZE = int(os.environ.get('DB_COMMIT_BATCH_SIZE', '20'))
+DB_COMMIT_INTERVAL = float(os.environ.get('DB_COMMIT_INTERVAL', '60'))
+
+# Modalità lettura pin: 'batch' (una richiesta multi-pin), 'concurrent' (richieste parallele), 'sequential'
+BLYNK_FETCH_MODE = os.environ.get('BLYNK_FETCH_MODE', 'batch').lower()
+BLYNK_MAX_CONCURRENCY = int(os.environ.get('BLYNK_MAX_CONCURRENCY', '5'))
+
+# Età massima (secondi) dell'ultimo campione servito da /api/current prima di una lettura live
+SNAPSHOT_MAX_AGE = float(os.environ.get('SNAPSHOT_MAX_AGE', str(SAMPLING_INTERVAL * 2)))
+
+# Stream SSE: campioni in coda per client e intervallo keepalive (secondi)
+STREAM_QUEUE_SIZE = int(os.environ.get('STREAM_QUEUE_SIZE', '10'))
+STREAM_KEEPALIVE = float(os.environ.get('STREAM_KEEPALIVE', '15'))
+
+# Calibrazione empirica: uso al posto delle curve teoriche, raccolta automatica da flow_blynk, griglia modello
+USE_EMPIRICAL_CURVES = os.environ.get('USE_EMPIRICAL_CURVES', 'false').lower() == 'true'
+CALIBRATION_AUTO_COLLECT = os.environ.get('CALIBRATION_AUTO_COLLECT', 'false').lower() == 'true'
+CALIBRATION_MAX_PRESSURE = float(os.environ.get('CALIBRATION_MAX_PRESSURE', '500'))
+CALIBRATION_PRESSURE_STEP = float(os.environ.get('CALIBRATION_PRESSURE_STEP', '5'))
+
+# Flotta: file JSON con l'elenco dispositivi (vuoto = un solo dispositivo dalle variabili BLYNK_*)
+FLEET_CONFIG = os.environ.get('FLEET_CONFIG', '')
+DEVICE_ID = os.environ.get('DEVICE_ID', 'default')
+FLEET_WORKERS = int(os.environ.get('FLEET_WORKERS', '8'))
+
+# Limite globale richieste HTTP a Blynk (richieste/s, 0 = nessun limite)
+BLYNK_RATE_LIMIT = float(os.environ.get('BLYNK_RATE_LIMIT', '20'))
+
+# Rilevatori di anomalie in streaming dopo calculate_metrics (nomi separati da virgola, vuoto = nessuno)
+ANOMALY_DETECTORS = os.environ.get('ANOMALY_DETECTORS', 'obstruction_cusum,flow_residual_cusum,pressure_band_zscore')
+
+# Ore di campioni recenti tenute in memoria per dispositivo (storico dashboard/API senza SQLite)
+RING_BUFFER_HOURS = float(os.environ.get('RING_BUFFER_HOURS', '24'))
+
+# Ritardo massimo (frazione dell'intervallo) con cui uno slot viene ancora eseguito invece che saltato
+SLOT_TOLERANCE = float(os.environ.get('SLOT_TOLERANCE', '0.5'))
+
+# Letture fallite: tentativi per pin con backoff esponenziale (secondi) e circuit breaker
+BLYNK_RETRIES = int(os.environ.get('BLYNK_RETRIES', '2'))
+BLYNK_RETRY_BACKOFF = float(os.environ.get('BLYNK_RETRY_BACKOFF', '0.5'))
+BLYNK_BREAKER_THRESHOLD = int(os.environ.get('BLYNK_BREAKER_THRESHOLD', '3'))
+BLYNK_BREAKER_COOLDOWN = float(os.environ.get('BLYNK_BREAKER_COOLDOWN', '30'))
+BLYNK_BREAKER_MAX_COOLDOWN = float(os.environ.get('BLYNK_BREAKER_MAX_COOLDOWN', '600'))
+
+# Recupero buchi al ritorno della connettività: template URL storico pin (vuoto = disabilitato)
+BLYNK_HISTORY_URL = os.environ.get('BLYNK_HISTORY_URL', '')
+BACKFILL_MAX_SLOTS = int(os.environ.get('BACKFILL_MAX_SLOTS', '2880'))
+
+# Strumentazione: metriche Prometheus su /metrics e profiler a campionamento (Hz, 0 = disattivato)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+PROFILER_HZ = float(os.environ.get('PROFILER_HZ', '0'))
+
+# Risposte JSON compresse gzip da questa dimensione (byte) se il client lo accetta (0 = mai)
+GZIP_MIN_BYTES = int(os.environ.get('GZIP_MIN_BYTES', '1024'))
+
+# Ruolo del processo: 'all' campionatore e API insieme, 'sampler' il solo processo che campiona
+# (unico per database), 'api' worker API senza campionatore (più processi, es. gunicorn)
+APP_ROLE = os.environ.get('APP_ROLE', 'all').lower()
+if APP_ROLE not in ('all', 'sampler', 'api'):
+    raise ValueError(f"APP_ROLE non valido '{APP_ROLE}' (all, sampler, api)")
+# Worker API: campionatore a cui inoltrare stato live e comandi, timeout (s) delle richieste inoltrate
+SAMPLER_URL = os.environ.get('SAMPLER_URL', 'http://127.0.0.1:8081')
+SAMPLER_TIMEOUT = float(os.environ.get('SAMPLER_TIMEOUT', '10'))
+
+# Pin virtuali Blynk
+BLYNK_PINS = {
+    'pressure': 'v19',
+    'flow': 'v10',
+    'pwm': 'v26',
+    'temperature': 'v8',
+    'pm_value': 'v4'
+}
+
+
+def build_blynk_urls(token: str, server: str, pins: dict = None) -> dict:
+    """URL diretti /external/api/get per ogni pin di un dispositivo"""
+    pins = pins or BLYNK_PINS
+    base = server if '://' in server else f"https://{server}"
+    return {name: f"{base}/external/api/get?token={token}&{pin}" for name, pin in pins.items()}
+
+
 # Mappa URL completi per bypass problemi variabili ambiente
 BLYNK_URLS = {
     'pressure': f"https://fra1.blynk.cloud/external/api/get?token=_PtiUhnhKwhtkmhsVz8G76bWCw3Uzs73&v19",
@@ -32,17 +137,22 @@ BLYNK_URLS = {
 
 # Fallback: se le variabili ambiente sono disponibili, ricostruisci URL dinamicamente
 if BLYNK_TOKEN and BLYNK_TOKEN != '_PtiUhnhKwhtkmhsVz8G76bWCw3Uzs73&v19' and BLYNK_SERVER:
-    BLYNK_URLS = {
-        'pressure': f"https://{BLYNK_SERVER}/external/api/get?token={BLYNK_TOKEN}&v19",
-        'flow': f"https://{BLYNK_SERVER}/external/api/get?token={BLYNK_TOKEN}&v10",
-        'pwm': f"https://{BLYNK_SERVER}/external/api/get?token={BLYNK_TOKEN}&v26",
-        'temperature': f"https://{BLYNK_SERVER}/external/api/get?token={BLYNK_TOKEN}&v8",
-        'pm_value': f"https://{BLYNK_SERVER}/external/api/get?token={BLYNK_TOKEN}&v4"
-    }
+    BLYNK_URLS = build_blynk_urls(BLYNK_TOKEN, BLYNK_SERVER)
+
+# Pin letti ad ogni ciclo di campionamento e colonna SystemData/test_data corrispondente
+SAMPLING_PINS = ['pressure', 'flow', 'pwm', 'temperature', 'pm_value']
+PIN_COLUMNS = {
+    'pressure': 'pressure_measured',
+    'flow': 'flow_blynk',
+    'pwm': 'pwm_percentage',
+    'temperature': 'temperature',
+    'pm_value': 'pm_value'
+}
 
 
 @dataclass
 class SystemData:
+    __slots__ = ('timestamp', 'pwm_percentage', 'pressure_measured', 'flow_blynk', 'temperature', 'pm_value')
     timestamp: str
     pwm_percentage: float
     pressure_measured: float
@@ -53,6 +163,9 @@ class SystemData:
 
 @dataclass
 class CalculatedMetrics:
+    __slots__ = ('pressure_clean', 'obstruction_index', 'filter_wear_percent', 'filter_efficiency',
+                 'obstruction_trend', 'hours_since_change', 'filter_change_needed', 'system_anomaly_detected',
+                 'predicted_hours_remaining', 'flow_calculated')
     pressure_clean: float
     obstruction_index: float
     filter_wear_percent: float
@@ -65,84 +178,763 @@ class CalculatedMetrics:
     flow_calculated: float  # Flusso calcolato dal nostro algoritmo
 
 
+@dataclass
+class PinSnapshot:
+    values: dict  # pin -> valore (NaN se la lettura è fallita)
+    timestamps: dict  # pin -> timestamp ISO di acquisizione
+    timestamp: str  # timestamp di riferimento del campione
+    missing: list = field(default_factory=list)  # pin non letti
+
+
+def is_missing(value) -> bool:
+    """Valore mancante: None o NaN (lettura fallita)"""
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+@dataclass
+class RetryPolicy:
+    retries: int = 2  # tentativi aggiuntivi dopo il primo
+    backoff: float = 0.5  # attesa prima del primo nuovo tentativo (raddoppia ad ogni tentativo)
+    max_backoff: float = 5.0
+
+
+class BlynkUnavailable(Exception):
+    """Circuito aperto: il server non viene interrogato fino alla fine del cooldown"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker per pin (o richiesta batch)
+
+    Dopo threshold fallimenti consecutivi il circuito si apre e le letture
+    falliscono subito senza richieste HTTP. Scaduto il cooldown passa una sola
+    richiesta di prova: se riesce il circuito si chiude, altrimenti si riapre
+    con cooldown raddoppiato (fino a max_cooldown).
+    """
+
+    def __init__(self, threshold: int = 3, cooldown: float = 30.0, max_cooldown: float = 600.0):
+        self.threshold = max(1, threshold)
+        self.base_cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        self.failures = 0
+        self.cooldown = cooldown
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if self._probing or time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+
+    def allow(self) -> bool:
+        """True se la richiesta può partire (circuito chiuso o unica prova dopo il cooldown)"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing:
+                # Prova fallita: riapre con cooldown più lungo
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self.opened_at = time.monotonic()
+            elif self.opened_at is None and self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def as_dict(self) -> dict:
+        return {'state': self.state, 'failures': self.failures, 'cooldown': self.cooldown}
+
+
+class MetricsRegistry:
+    """
+    Contatori e istogrammi in formato Prometheus a registrazione quasi senza lock
+
+    Ogni thread scrive solo nel proprio shard (dict etichette -> celle), quindi
+    observe/inc non prendono lock: il lock serve solo a creare lo shard del thread
+    e a elencare gli shard in render(). Gli shard sono indicizzati per ident del
+    thread (riusato dai thread nuovi), così restano tanti quanti i thread vivi.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._metrics = []
+        self._gauges = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> 'Counter':
+        metric = Counter(self, name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = None) -> 'Histogram':
+        metric = Histogram(self, name, help_text, labels, buckets or Histogram.BUCKETS)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, collect):
+        """Gauge calcolato alla lettura: collect() -> {(etichetta, valore), ...: valore}"""
+        self._gauges.append((name, help_text, collect))
+
+    def render(self, names: tuple = None, extra_labels: tuple = ()) -> str:
+        """
+        Metriche nel formato testuale Prometheus 0.0.4
+
+        names limita l'output a quelle famiglie; extra_labels ((nome, valore), ...) è
+        aggiunto a ogni serie (es. il pid del worker API che risponde).
+        """
+        lines = []
+        for metric in self._metrics:
+            if names is None or metric.name in names:
+                metric.render(lines, extra_labels)
+        for name, help_text, collect in self._gauges:
+            if names is not None and name not in names:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in collect().items():
+                lines.append(f'{name}{format_labels(tuple(extra_labels) + tuple(labels))} {format_sample(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def drop_metric_families(text: str, names: tuple) -> str:
+    """Toglie da un testo Prometheus le famiglie indicate (righe HELP/TYPE e campioni, _bucket/_sum/_count inclusi)"""
+    kept = []
+    for line in text.splitlines():
+        if line.startswith(('# HELP ', '# TYPE ')):
+            metric = line.split(' ', 3)[2]
+        else:
+            metric = line.split('{', 1)[0].split(' ', 1)[0]
+        if not any(metric == name or metric.startswith(name + '_') for name in names):
+            kept.append(line)
+    return '\n'.join(kept) + '\n' if kept else ''
+
+
+def format_labels(labels) -> str:
+    """Etichette Prometheus {nome="valore",...} con escape di backslash, virgolette e a capo"""
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    ]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_sample(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Counter:
+    """Contatore monotono per combinazione di etichette"""
+
+    def __init__(self, registry: MetricsRegistry, name: str, help_text: str, labels: tuple):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._shards = {}
+
+    def _cells(self) -> dict:
+        ident = threading.get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            with self.registry._lock:
+                shard = self._shards.setdefault(ident, {})
+        return shard
+
+    def _merged(self) -> dict:
+        with self.registry._lock:
+            shards = list(self._shards.values())
+        merged = {}
+        for shard in shards:
+            for key, cell in list(shard.items()):
+                total = merged.setdefault(key, [0.0] * len(cell))
+                for i, value in enumerate(cell):
+                    total[i] += value
+        return merged
+
+    def inc(self, *label_values, amount: float = 1.0):
+        if not self.registry.enabled:
+            return
+        cells = self._cells()
+        cell = cells.get(label_values)
+        if cell is None:
+            cell = cells[label_values] = [0.0]
+        cell[0] += amount
+
+    def value(self, *label_values) -> float:
+        return self._merged().get(label_values, [0.0])[0]
+
+    def render(self, lines: list, extra_labels: tuple = ()):
+        lines.append(f'# HELP {self.name}_total {self.help_text}')
+        lines.append(f'# TYPE {self.name}_total counter')
+        for key, cell in sorted(self._merged().items()):
+            labels = list(extra_labels) + list(zip(self.labels, key))
+            lines.append(f'{self.name}_total{format_labels(labels)} {format_sample(cell[0])}')
+
+
+class Histogram(Counter):
+    """Istogramma a bucket fissi (secondi); cella = conteggi per bucket + somma + totale"""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, registry: MetricsRegistry, name: str, help_text: str, labels: tuple, buckets: tuple):
+        super().__init__(registry, name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values):
+        if not self.registry.enabled:
+            return
+        cells = self._cells()
+        cell = cells.get(label_values)
+        if cell is None:
+            cell = cells[label_values] = [0.0] * (len(self.buckets) + 3)
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def time(self, *label_values):
+        """Context manager che osserva la durata del blocco"""
+        return _Timer(self, label_values)
+
+    def count(self, *label_values) -> int:
+        return int(self._merged().get(label_values, [0.0])[-1])
+
+    def render(self, lines: list, extra_labels: tuple = ()):
+        lines.append(f'# HELP {self.name} {self.help_text}')
+        lines.append(f'# TYPE {self.name} histogram')
+        for key, cell in sorted(self._merged().items()):
+            labels = list(extra_labels) + list(zip(self.labels, key))
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (math.inf,), cell):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{format_labels(labels + [("le", format_sample(bound))])} '
+                             f'{format_sample(cumulative)}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {format_sample(cell[-2])}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {format_sample(cell[-1])}')
+
+
+class _Timer:
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+        return False
+
+
+class SamplingProfiler:
+    """
+    Profiler statistico opzionale: campiona gli stack di tutti i thread a hz campioni/s
+
+    Gli stack sono aggregati in formato "folded" (thread;modulo:funzione;... conteggio),
+    leggibile da flamegraph.pl o speedscope. Costo nullo se non avviato.
+    """
+
+    MAX_DEPTH = 64
+
+    def __init__(self, hz: float):
+        self.interval = 1.0 / hz
+        self.samples = 0
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                calls = []
+                while frame is not None and len(calls) < self.MAX_DEPTH:
+                    code = frame.f_code
+                    calls.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                # Nome thread senza numero: i worker dello stesso pool si sommano
+                thread = names.get(ident, 'thread').rstrip('0123456789').rstrip('-_') or 'thread'
+                stacks.append(';'.join([thread] + calls[::-1]))
+            with self._lock:
+                self.samples += 1
+                for stack in stacks:
+                    self._stacks[stack] = self._stacks.get(stack, 0) + 1
+
+    def folded(self, thread_prefix: str = '', reset: bool = False) -> str:
+        """Stack aggregati, dal più frequente"""
+        with self._lock:
+            stacks = self._stacks
+            if reset:
+                self._stacks = {}
+                self.samples = 0
+        lines = [f'{stack} {count}' for stack, count in sorted(stacks.items(), key=lambda item: -item[1])
+                 if stack.startswith(thread_prefix)]
+        return '\n'.join(lines) + '\n'
+
+
+# Metriche dei percorsi critici (campionamento, algoritmo, database, HTTP)
+metrics_registry = MetricsRegistry(METRICS_ENABLED)
+BLYNK_READ_SECONDS = metrics_registry.histogram(
+    'blynk_read_seconds', 'Durata lettura pin Blynk (tentativi inclusi)', ('device', 'pin', 'status', 'error'))
+CALCULATE_METRICS_SECONDS = metrics_registry.histogram(
+    'calculate_metrics_seconds', 'Durata calculate_metrics', ('device',))
+DB_SAVE_SECONDS = metrics_registry.histogram(
+    'db_save_data_point_seconds', 'Durata save_data_point (lock scrittura e commit inclusi)', ('device',))
+DB_COMMIT_SECONDS = metrics_registry.histogram('db_commit_seconds', 'Latenza commit SQLite')
+DB_COMMITTED_ROWS = metrics_registry.counter('db_committed_rows', 'Righe scritte da commit SQLite')
+SAMPLE_CYCLE_SECONDS = metrics_registry.histogram(
+    'sampling_cycle_seconds', 'Durata ciclo di campionamento', ('device',))
+SAMPLE_OVERRUNS = metrics_registry.counter(
+    'sampling_overruns', 'Cicli di campionamento più lunghi dell\'intervallo', ('device',))
+SAMPLE_MISSED_SLOTS = metrics_registry.counter('sampling_missed_slots', 'Slot di campionamento saltati', ('device',))
+SAMPLE_ERRORS = metrics_registry.counter('sampling_errors', 'Cicli di campionamento falliti', ('device',))
+HTTP_REQUEST_SECONDS = metrics_registry.histogram(
+    'http_request_seconds', 'Durata richieste Flask per route', ('route', 'method', 'status'))
+# Serie misurate da ogni worker API; tutte le altre sono del campionatore
+API_WORKER_METRICS = ('http_request_seconds',)
+
+profiler = SamplingProfiler(PROFILER_HZ) if PROFILER_HZ > 0 else None
+
+
+class RateLimiter:
+    """Token bucket condiviso: limita le richieste HTTP al secondo di tutti i client"""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = max(1.0, burst if burst is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Attende un token (nessuna attesa se rate <= 0)"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
 class BlynkDirectClient:
     """Client Blynk con URL diretti per massima affidabilità"""
 
-    def __init__(self, url_mapping: dict):
+    # Errori transitori per cui ha senso ritentare (gli altri contano solo per il circuit breaker)
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    # Risposte con cui il server rifiuta la richiesta multi-pin: richieste per pin fino alla prossima prova
+    BATCH_REJECT_STATUS = (400, 404, 405)
+
+    def __init__(self, url_mapping: dict, fetch_mode: str = 'batch', max_concurrency: int = 5,
+                 session: requests.Session = None, rate_limiter: RateLimiter = None, name: str = 'blynk',
+                 retry_policy: RetryPolicy = None, pin_policies: dict = None, history_url: str = ''):
         self.urls = url_mapping
-        self.session = requests.Session()
-        self.session.timeout = 15
+        self.fetch_mode = fetch_mode
+        # Dopo un rifiuto della richiesta multi-pin si usa concurrent e si riprova batch allo scadere
+        # di un cooldown (come il circuit breaker: raddoppia ad ogni rifiuto consecutivo)
+        self.batch_cooldown = BLYNK_BREAKER_COOLDOWN
+        self._batch_retry_at = 0.0
+        self._batch_rejections = 0
+        self.max_concurrency = max(1, max_concurrency)
+        # Sessione condivisa tra i dispositivi della flotta (stesso pool di connessioni keep-alive)
+        self.session = session or self.create_session(self.max_concurrency)
+        self.rate_limiter = rate_limiter
+        self.name = name
+        # Politica tentativi di default e override per pin; un circuit breaker per pin (o batch)
+        self.retry_policy = retry_policy or RetryPolicy(BLYNK_RETRIES, BLYNK_RETRY_BACKOFF)
+        self.pin_policies = pin_policies or {}
+        self.history_url = history_url
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        logger.info(f"Blynk Direct Client inizializzato ({name})")
+        for pin_name, url in self.urls.items():
+            # Nascondi token nei log per sicurezza
+            safe_url = url.replace(url.split('token=')[1].split('&')[0], 'TOKEN_HIDDEN')
+            logger.info(f"  {pin_name}: {safe_url}")
+
+    @staticmethod
+    def create_session(pool_size: int) -> requests.Session:
+        """Sessione HTTP con pool connessioni dimensionato per le richieste concorrenti"""
+        session = requests.Session()
+        session.timeout = 15
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
 
         # Headers per migliorare compatibilità
-        self.session.headers.update({
+        session.headers.update({
             'User-Agent': 'BalenaIoT-PredictiveMaintenance/1.0',
             'Accept': 'application/json'
         })
+        return session
+
+    def _get(self, url: str) -> requests.Response:
+        """GET sulla sessione rispettando il limite di richieste globale"""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return self.session.get(url, timeout=self.session.timeout)
+
+    def breaker(self, key: str) -> CircuitBreaker:
+        """Circuit breaker di un pin (o 'batch'), creato al primo uso"""
+        with self._breakers_lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(
+                    BLYNK_BREAKER_THRESHOLD, BLYNK_BREAKER_COOLDOWN, BLYNK_BREAKER_MAX_COOLDOWN)
+            return breaker
+
+    def breaker_status(self) -> dict:
+        with self._breakers_lock:
+            return {key: breaker.as_dict() for key, breaker in self._breakers.items()}
+
+    def _request(self, key: str, url: str) -> requests.Response:
+        """
+        GET con tentativi e backoff secondo la politica del pin, sotto circuit breaker
 
-        logger.info("Blynk Direct Client inizializzato")
-        for name, url in self.urls.items():
-            # Nascondi token nei log per sicurezza
-            safe_url = url.replace(url.split('token=')[1].split('&')[0], 'TOKEN_HIDDEN')
-            logger.info(f"  {name}: {safe_url}")
+        Solleva BlynkUnavailable se il circuito è aperto (nessuna richiesta inviata),
+        altrimenti l'eccezione requests dell'ultimo tentativo.
+        """
+        breaker = self.breaker(key)
+        if not breaker.allow():
+            raise BlynkUnavailable(f"circuito aperto per {key}")
+
+        policy = self.pin_policies.get(key, self.retry_policy)
+        attempt = 0
+        while True:
+            try:
+                response = self._get(url)
+                response.raise_for_status()
+                breaker.record_success()
+                return response
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                    requests.exceptions.HTTPError) as e:
+                status = e.response.status_code if e.response is not None else None
+                transient = status is None or status in self.RETRY_STATUS
+                # In half-open basta un fallimento: niente raffiche verso un server ancora giù
+                if not transient or attempt >= policy.retries or breaker.state != 'closed':
+                    breaker.record_failure()
+                    raise
+                time.sleep(min(policy.backoff * 2 ** attempt, policy.max_backoff))
+                attempt += 1
+
+    def _observe_read(self, key: str, started: float, response: requests.Response = None, error: Exception = None):
+        """Durata di una lettura (pin o batch) con stato HTTP e classe d'errore"""
+        if response is None and error is not None:
+            response = getattr(error, 'response', None)
+        status = str(response.status_code) if response is not None else ''
+        BLYNK_READ_SECONDS.observe(time.perf_counter() - started, self.name, key, status,
+                                   type(error).__name__ if error is not None else '')
 
     def get_pin_value(self, pin_name: str) -> float:
-        """Ottieni valore da URL diretto"""
+        """Ottieni valore da URL diretto (NaN se la lettura fallisce)"""
+        started = time.perf_counter()
+        response = error = None
         try:
             if pin_name not in self.urls:
                 logger.error(f"Pin {pin_name} non configurato")
-                return 0.0
+                return math.nan
 
             url = self.urls[pin_name]
             logger.debug(f"GET: {pin_name}")
 
-            response = self.session.get(url)
-            response.raise_for_status()
+            response = self._request(pin_name, url)
 
             # Parse risposta Blynk
-            data = response.json()
-
-            if isinstance(data, list):
-                value = float(data[0]) if data and len(data) > 0 else 0.0
-            elif isinstance(data, (int, float)):
-                value = float(data)
-            elif isinstance(data, str):
-                try:
-                    value = float(data)
-                except ValueError:
-                    logger.warning(f"Valore non numerico da {pin_name}: {data}")
-                    value = 0.0
-            else:
-                logger.warning(f"Formato risposta sconosciuto da {pin_name}: {type(data)}")
-                value = 0.0
+            value = self._parse_value(pin_name, response.json())
 
             logger.debug(f"{pin_name}: {value}")
             return value
 
-        except requests.exceptions.Timeout:
+        except BlynkUnavailable as e:
+            error = e
+            logger.debug(f"Lettura {pin_name} saltata: circuito aperto")
+            return math.nan
+        except requests.exceptions.Timeout as e:
+            error = e
             logger.error(f"Timeout lettura {pin_name}")
-            return 0.0
-        except requests.exceptions.ConnectionError:
+            return math.nan
+        except requests.exceptions.ConnectionError as e:
+            error = e
             logger.error(f"Errore connessione {pin_name}")
-            return 0.0
+            return math.nan
         except requests.exceptions.HTTPError as e:
-            logger.error(f"Errore HTTP {pin_name}: {e.response.status_code if e.response else 'unknown'}")
-            return 0.0
+            error = e
+            logger.error(f"Errore HTTP {pin_name}: {e.response.status_code if e.response is not None else 'unknown'}")
+            return math.nan
         except (ValueError, TypeError) as e:
+            error = e
             logger.error(f"Errore parsing {pin_name}: {e}")
-            return 0.0
+            return math.nan
         except Exception as e:
+            error = e
             logger.error(f"Errore generico {pin_name}: {e}")
-            return 0.0
+            return math.nan
+        finally:
+            self._observe_read(pin_name, started, response, error)
+
+    def _parse_value(self, pin_name: str, data) -> float:
+        """Converte la risposta Blynk di un pin in float (NaN se vuota o non numerica)"""
+        if isinstance(data, list):
+            return self._parse_value(pin_name, data[0]) if data and len(data) > 0 else math.nan
+        elif isinstance(data, (int, float)):
+            return float(data)
+        elif isinstance(data, str):
+            try:
+                return float(data)
+            except ValueError:
+                logger.warning(f"Valore non numerico da {pin_name}: {data}")
+                return math.nan
+        logger.warning(f"Formato risposta sconosciuto da {pin_name}: {type(data)}")
+        return math.nan
+
+    def _split_url(self, pin_name: str) -> tuple:
+        """Separa URL base (server + token) e pin virtuale"""
+        base_url, pin = self.urls[pin_name].rsplit('&', 1)
+        return base_url, pin.lower()
 
     def get_multiple_pins(self, pin_names: list) -> dict:
         """Ottieni valori multipli pin"""
-        results = {}
+        return self.get_pins_snapshot(pin_names).values
 
-        for pin_name in pin_names:
+    def get_pins_snapshot(self, pin_names: list) -> PinSnapshot:
+        """
+        Legge tutti i pin in un unico passaggio secondo fetch_mode
+
+        - batch: una sola richiesta multi-pin (/external/api/get?token=...&v19&v10...)
+        - concurrent: richieste parallele limitate sulla sessione condivisa
+        - sequential: una richiesta alla volta (comportamento originale)
+
+        Se il server non supporta la richiesta multi-pin si ripiega su concurrent.
+        I pin non letti valgono NaN e sono elencati in snapshot.missing.
+        """
+        if self.fetch_mode == 'batch':
+            snapshot = self._fetch_batch(pin_names) if self.batch_supported else None
+            if snapshot is not None:
+                return snapshot
+            return self._fetch_concurrent(pin_names)
+        elif self.fetch_mode == 'concurrent':
+            return self._fetch_concurrent(pin_names)
+        return self._fetch_sequential(pin_names)
+
+    @property
+    def batch_supported(self) -> bool:
+        """False nel cooldown dopo un rifiuto della richiesta multi-pin"""
+        return time.monotonic() >= self._batch_retry_at
+
+    def _reject_batch(self, status: int):
+        """Rifiuto (4xx) della richiesta multi-pin: concurrent fino al prossimo tentativo"""
+        cooldown = min(self.batch_cooldown * 2 ** self._batch_rejections, BLYNK_BREAKER_MAX_COOLDOWN)
+        self._batch_rejections += 1
+        self._batch_retry_at = time.monotonic() + cooldown
+        # Il server risponde: il rifiuto non deve aprire il circuito batch (letture NaN invece di concurrent)
+        self.breaker('batch').record_success()
+        logger.warning(f"Richiesta multi-pin rifiutata (HTTP {status}), richieste concorrenti "
+                       f"per {cooldown:.0f}s")
+
+    def _fetch_batch(self, pin_names: list):
+        """Richiesta multi-pin unica; None se non applicabile, rifiutata dal server o formato inatteso"""
+        known = [name for name in pin_names if name in self.urls]
+        if not known:
+            return None
+
+        base_urls = {self._split_url(name)[0] for name in known}
+        if len(base_urls) != 1:
+            # Pin su token/server diversi: impossibile una richiesta unica
+            return None
+
+        pins = {name: self._split_url(name)[1] for name in known}
+        url = base_urls.pop() + ''.join(f"&{pin}" for pin in pins.values())
+        values = {name: math.nan for name in pin_names}
+
+        started = time.perf_counter()
+        response = error = None
+        try:
+            logger.debug(f"GET batch: {', '.join(known)}")
+            response = self._request('batch', url)
+            data = response.json()
+        except BlynkUnavailable as e:
+            error = e
+            logger.debug("Lettura batch saltata: circuito aperto")
+            data = {}
+        except requests.exceptions.Timeout as e:
+            error = e
+            logger.error("Timeout lettura batch pin")
+            data = {}
+        except requests.exceptions.ConnectionError as e:
+            error = e
+            logger.error("Errore connessione lettura batch pin")
+            data = {}
+        except requests.exceptions.HTTPError as e:
+            error = e
+            status = e.response.status_code if e.response is not None else None
+            if status in self.BATCH_REJECT_STATUS:
+                self._reject_batch(status)
+                return None
+            logger.error(f"Errore HTTP batch pin: {status or 'unknown'}")
+            data = {}
+        except ValueError as e:
+            error = e
+            logger.warning(f"Risposta batch non JSON, uso richieste concorrenti: {e}")
+            return None
+        finally:
+            self._observe_read('batch', started, response, error)
+
+        timestamp = datetime.now().isoformat()
+
+        if not isinstance(data, dict):
+            logger.warning(f"Formato risposta batch inatteso ({type(data)}), uso richieste concorrenti")
+            return None
+        if error is None:
+            self._batch_rejections = 0
+
+        data = {str(key).lower(): value for key, value in data.items()}
+        for name, pin in pins.items():
+            if pin in data:
+                try:
+                    values[name] = self._parse_value(name, data[pin])
+                except (ValueError, TypeError) as e:
+                    logger.error(f"Errore parsing {name}: {e}")
+
+        return PinSnapshot(
+            values=values,
+            timestamps={name: timestamp for name in pin_names},
+            timestamp=timestamp,
+            missing=[name for name in pin_names if is_missing(values[name])]
+        )
+
+    def _fetch_concurrent(self, pin_names: list) -> PinSnapshot:
+        """Richieste parallele con concorrenza limitata"""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                    thread_name_prefix='blynk-fetch')
+
+        def fetch(pin_name):
             value = self.get_pin_value(pin_name)
-            results[pin_name] = value
+            return value, datetime.now().isoformat()
 
-        return results
+        futures = {name: self._executor.submit(fetch, name) for name in pin_names}
+        values, timestamps = {}, {}
+        for name, future in futures.items():
+            values[name], timestamps[name] = future.result()
+
+        return self._build_snapshot(values, timestamps)
+
+    def _fetch_sequential(self, pin_names: list) -> PinSnapshot:
+        """Una richiesta alla volta"""
+        values, timestamps = {}, {}
+        for pin_name in pin_names:
+            values[pin_name] = self.get_pin_value(pin_name)
+            timestamps[pin_name] = datetime.now().isoformat()
+
+        return self._build_snapshot(values, timestamps)
+
+    def _build_snapshot(self, values: dict, timestamps: dict) -> PinSnapshot:
+        """Snapshot con timestamp di riferimento = ultima acquisizione"""
+        reference = max(timestamps.values()) if timestamps else datetime.now().isoformat()
+        return PinSnapshot(values=values, timestamps=timestamps, timestamp=reference,
+                           missing=[name for name, value in values.items() if is_missing(value)])
+
+    def get_pin_history(self, pin_names: list, start_epoch: float, end_epoch: float) -> dict:
+        """
+        Storico dei pin dal server (history_url) nell'intervallo indicato
+
+        history_url è un template con segnaposto {base} (schema + host), {token},
+        {pin} (es. v19), {start}/{end} (epoch secondi) e {start_ms}/{end_ms}.
+        La risposta attesa è una lista di coppie [timestamp, valore] o di oggetti
+        {ts, value}, eventualmente dentro una chiave "data". Ritorna
+        pin -> lista ordinata di (epoch, valore); i pin non recuperati sono omessi.
+        """
+        history = {}
+        if not self.history_url:
+            return history
+
+        for name in pin_names:
+            if name not in self.urls:
+                continue
+            base_url, pin = self._split_url(name)
+            parts = urlsplit(base_url)
+            token = parse_qs(parts.query).get('token', [''])[0]
+            url = self.history_url.format(
+                base=f"{parts.scheme}://{parts.netloc}", token=token, pin=pin,
+                start=int(start_epoch), end=int(math.ceil(end_epoch)),
+                start_ms=int(start_epoch * 1000), end_ms=int(math.ceil(end_epoch * 1000))
+            )
+            try:
+                points = self._parse_history(self._request(name, url).json())
+            except BlynkUnavailable:
+                continue
+            except (requests.exceptions.RequestException, ValueError, TypeError, KeyError) as e:
+                logger.warning(f"Storico {name} non disponibile: {e}")
+                continue
+            history[name] = [(ts, value) for ts, value in points if start_epoch <= ts <= end_epoch]
+        return history
+
+    @staticmethod
+    def _parse_history(data) -> list:
+        """Normalizza la risposta storico in [(epoch, valore)] ordinata per tempo"""
+        if isinstance(data, dict):
+            data = data.get('data', [])
+        points = []
+        for item in data:
+            if isinstance(item, dict):
+                ts = next(item[key] for key in ('ts', 'timestamp', 't', 'x') if key in item)
+                value = next(item[key] for key in ('value', 'v', 'y') if key in item)
+            else:
+                ts, value = item[0], item[1]
+            if isinstance(ts, str) and not ts.replace('.', '', 1).isdigit():
+                ts = iso_to_epoch(ts)
+            try:
+                ts, value = float(ts), float(value)
+            except (ValueError, TypeError):
+                continue
+            if ts > 1e11:
+                # Timestamp in millisecondi
+                ts /= 1000.0
+            if not math.isnan(value):
+                points.append((ts, value))
+        points.sort()
+        return points
 
     def test_connectivity(self) -> dict:
         """Test connettività a tutti i pin"""
@@ -150,21 +942,57 @@ class BlynkDirectClient:
 
         logger.info("Test connettività Blynk...")
         for pin_name in self.urls.keys():
-            try:
-                value = self.get_pin_value(pin_name)
+            value = self.get_pin_value(pin_name)
+            if is_missing(value):
+                results[pin_name] = {'status': 'ERROR', 'error': 'lettura non riuscita'}
+                logger.error(f"  ✗ {pin_name}: lettura non riuscita")
+            else:
                 results[pin_name] = {'status': 'OK', 'value': value}
                 logger.info(f"  ✓ {pin_name}: {value}")
-            except Exception as e:
-                results[pin_name] = {'status': 'ERROR', 'error': str(e)}
-                logger.error(f"  ✗ {pin_name}: {e}")
 
         return results
 
 
+class FanTableParam:
+    """
+    Attributo da cui dipende la tabella delle curve ventole: assegnarlo la invalida
+
+    Le curve (array=True) sono copiate in sola lettura: una modifica sul posto, che
+    lascerebbe la tabella non aggiornata, solleva ValueError invece di passare inosservata.
+    """
+
+    def __init__(self, array: bool = False):
+        self.array = array
+
+    def __set_name__(self, owner, name):
+        self.attr = '_' + name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return getattr(instance, self.attr)
+
+    def __set__(self, instance, value):
+        if self.array:
+            value = np.array(value)
+            value.setflags(write=False)
+        setattr(instance, self.attr, value)
+        instance._fan_table = None
+
+
 class PredictiveAlgorithm:
     """Algoritmo manutenzione predittiva ottimizzato"""
 
+    # Curve ventole e mapping PWM da cui dipende la tabella PWM -> curve scalate
+    fan_flow = FanTableParam(array=True)
+    fan_pressure = FanTableParam(array=True)
+    fan_flow_total = FanTableParam(array=True)
+    MIN_FAN_SPEED_PWM = FanTableParam()
+    MAX_FAN_SPEED_PWM = FanTableParam()
+
     def __init__(self):
+        self._fan_table = None
+
         # Curve ventole semplificate (punti chiave)
         self.fan_flow = np.array([0, 500, 1000, 1500, 2000, 2500, 2950])
         self.fan_pressure = np.array([450, 320, 240, 180, 120, 70, 20])
@@ -185,11 +1013,105 @@ class PredictiveAlgorithm:
         self.MAX_OBSTRUCTION_CRITICAL = 2.0
         self.FILTER_CHANGE_HOURS = 2000
 
+        # Offset pressione per perdite di carico fisse (griglia, prefiltro, tenuta), da calibrare
+        self.PRESSURE_OFFSET = 0.0
+
+        # Calibrazione empirica (EmpiricalCalibration) usata al posto delle curve teoriche se attiva
+        self.USE_EMPIRICAL_CURVES = False
+        self.calibration = None
+
         # Stato interno
         self.hours_since_change = 0
         self.obstruction_history = [1.0] * 10
         self.history_index = 0
 
+    PWM_LEVELS = 101  # Blynk pubblica PWM interi 0-100%
+
+    # Tabelle condivise tra istanze con le stesse curve (es. molti dispositivi nello stesso processo),
+    # usate dai thread dello scheduler: accesso sotto lock, si scarta la più vecchia oltre il limite
+    FAN_TABLE_CACHE_SIZE = 64
+    _fan_table_cache = {}
+    _fan_table_lock = threading.Lock()
+
+    def fan_curve_table(self) -> tuple:
+        """
+        Curve ventole scalate precalcolate per ogni livello PWM intero 0-100
+
+        Returns:
+            (q_table, p_table): array (101, punti curva) di portata e pressione
+        """
+        table = self._fan_table
+        if table is None:
+            key = (self.fan_flow_total.dtype.str, self.fan_flow_total.tobytes(),
+                   self.fan_pressure.dtype.str, self.fan_pressure.tobytes(),
+                   self.MIN_FAN_SPEED_PWM, self.MAX_FAN_SPEED_PWM)
+            cache = self._fan_table_cache
+            with self._fan_table_lock:
+                table = cache.get(key)
+                if table is None:
+                    table = self._build_fan_curve_table()
+                    while len(cache) >= self.FAN_TABLE_CACHE_SIZE:
+                        del cache[next(iter(cache))]
+                    cache[key] = table
+            self._fan_table = table
+        return table
+
+    def _build_fan_curve_table(self) -> tuple:
+        """Calcola le curve scalate con le stesse operazioni del calcolo per campione"""
+        q_table = np.empty((self.PWM_LEVELS, len(self.fan_flow_total)), dtype=np.float64)
+        p_table = np.empty((self.PWM_LEVELS, len(self.fan_pressure)), dtype=np.float64)
+        for level in range(self.PWM_LEVELS):
+            scale_factor = self.convert_blynk_pwm_to_real_speed(float(level)) / 100.0
+            q_table[level] = self.fan_flow_total * scale_factor
+            p_table[level] = self.fan_pressure * scale_factor * scale_factor
+
+        # Tabelle condivise tra istanze: sola lettura
+        for array in (q_table, p_table):
+            array.setflags(write=False)
+        return q_table, p_table
+
+    def scaled_fan_curves(self, blynk_pwm_percent: float) -> tuple:
+        """Curve ventole (portata, pressione) scalate per il PWM: lookup in tabella per PWM interi"""
+        if 0 <= blynk_pwm_percent <= 100 and float(blynk_pwm_percent).is_integer():
+            q_table, p_table = self.fan_curve_table()
+            level = int(blynk_pwm_percent)
+            return q_table[level], p_table[level]
+
+        # PWM fuori tabella (non intero o fuori range): calcolo diretto
+        scale_factor = self.convert_blynk_pwm_to_real_speed(blynk_pwm_percent) / 100.0
+        return self.fan_flow_total * scale_factor, self.fan_pressure * scale_factor * scale_factor
+
+    # Parametri modificabili con configure() (soglie, mapping PWM, curve)
+    TUNABLE_PARAMS = (
+        'MIN_FAN_SPEED_PWM', 'MAX_FAN_SPEED_PWM', 'MAX_OBSTRUCTION_WARNING', 'MAX_OBSTRUCTION_CRITICAL',
+        'FILTER_CHANGE_HOURS', 'PRESSURE_OFFSET', 'fan_flow', 'fan_pressure', 'filter_flow', 'filter_pressure'
+    )
+    CURVE_PARAMS = ('fan_flow', 'fan_pressure', 'filter_flow', 'filter_pressure')
+
+    def configure(self, **params):
+        """
+        Aggiorna parametri e curve dell'algoritmo (es. da replay o calibrazione)
+
+        Le curve sono convertite in array NumPy e la curva di sistema a 2 ventole
+        viene ricalcolata. Parametri sconosciuti sollevano ValueError.
+        """
+        unknown = [name for name in params if name not in self.TUNABLE_PARAMS]
+        if unknown:
+            raise ValueError(f"Parametri algoritmo sconosciuti: {', '.join(unknown)}")
+
+        for name, value in params.items():
+            if name in self.CURVE_PARAMS:
+                value = np.asarray(value)
+            setattr(self, name, value)
+
+        # Sistema (2 ventole)
+        self.fan_flow_total = self.fan_flow * 2
+        return self
+
+    def empirical_active(self) -> bool:
+        """True se la calibrazione empirica è attiva e ha punti sufficienti"""
+        return bool(self.USE_EMPIRICAL_CURVES and self.calibration is not None and self.calibration.ready)
+
     def convert_blynk_pwm_to_real_speed(self, blynk_pwm_percent: float) -> float:
         """
         Converte la percentuale PWM da Blynk alla velocità effettiva delle ventole
@@ -236,30 +1158,38 @@ class PredictiveAlgorithm:
         return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
 
     def interpolate(self, x: float, x_arr: np.ndarray, y_arr: np.ndarray) -> float:
-        """Interpolazione lineare veloce"""
+        """Interpolazione lineare veloce (sempre float Python, anche con curve intere)"""
         if x <= x_arr[0]:
-            return max(0.0, y_arr[0])
+            return float(max(0.0, y_arr[0]))
         if x >= x_arr[-1]:
-            return max(0.0, y_arr[-1])
-        return max(0.0, np.interp(x, x_arr, y_arr))
-
-    def calculate_metrics(self, system_data: SystemData) -> CalculatedMetrics:
-        """Calcola metriche principali"""
+            return float(max(0.0, y_arr[-1]))
+        return float(max(0.0, np.interp(x, x_arr, y_arr)))
 
-        # Converte PWM Blynk a velocità reale ventole
-        real_fan_speed = self.convert_blynk_pwm_to_real_speed(system_data.pwm_percentage)
+    def calculate_metrics(self, system_data: SystemData, update_state: bool = True) -> CalculatedMetrics:
+        """
+        Calcola metriche principali
 
-        # Scala curva ventole per velocità reale
-        scale_factor = real_fan_speed / 100.0
-        q_fan_scaled = self.fan_flow_total * scale_factor
-        p_fan_scaled = self.fan_pressure * scale_factor * scale_factor
+        Con update_state=False il calcolo non modifica lo storico ostruzione
+        (letture occasionali che non devono alterare il trend del campionatore).
+        Se PWM o pressione mancano (lettura fallita) ritorna missing_metrics()
+        senza toccare lo stato.
+        """
+        if is_missing(system_data.pwm_percentage) or is_missing(system_data.pressure_measured):
+            return self.missing_metrics()
 
-        # Calcola portata dalla pressione
-        flow_calculated = self.interpolate(
-            system_data.pressure_measured,
-            p_fan_scaled,
-            q_fan_scaled
-        )
+        if self.empirical_active():
+            # Calibrazione empirica sul sistema reale (include tutte le perdite)
+            flow_calculated = self.calibration.predict(system_data.pwm_percentage, system_data.pressure_measured)
+        else:
+            # Curva ventole scalata per la velocità reale (tabella precalcolata per PWM 0-100)
+            q_fan_scaled, p_fan_scaled = self.scaled_fan_curves(system_data.pwm_percentage)
+
+            # Calcola portata dalla pressione (corretta per le perdite fisse)
+            flow_calculated = self.interpolate(
+                system_data.pressure_measured + self.PRESSURE_OFFSET,
+                p_fan_scaled,
+                q_fan_scaled
+            )
 
         # Pressione filtro pulito teorica
         pressure_clean = self.interpolate(
@@ -278,11 +1208,16 @@ class PredictiveAlgorithm:
         filter_efficiency = max(0.0, min(100.0, (2.0 - obstruction_index) * 100.0))
 
         # Trend ostruzione
-        self.obstruction_history[self.history_index] = obstruction_index
-        self.history_index = (self.history_index + 1) % 10
+        if update_state:
+            history = self.obstruction_history
+            history[self.history_index] = obstruction_index
+            self.history_index = (self.history_index + 1) % 10
+        else:
+            history = list(self.obstruction_history)
+            history[self.history_index] = obstruction_index
 
-        recent_avg = sum(self.obstruction_history[:5]) / 5.0
-        older_avg = sum(self.obstruction_history[5:]) / 5.0
+        recent_avg = sum(history[:5]) / 5.0
+        older_avg = sum(history[5:]) / 5.0
         obstruction_trend = recent_avg - older_avg
 
         # Predizioni
@@ -317,190 +1252,2576 @@ class PredictiveAlgorithm:
             flow_calculated=flow_calculated
         )
 
+    def missing_metrics(self) -> CalculatedMetrics:
+        """Metriche di un campione con ingressi mancanti: valori NaN e nessun allarme"""
+        return CalculatedMetrics(
+            pressure_clean=math.nan,
+            obstruction_index=math.nan,
+            filter_wear_percent=math.nan,
+            filter_efficiency=math.nan,
+            obstruction_trend=math.nan,
+            hours_since_change=self.hours_since_change,
+            filter_change_needed=False,
+            system_anomaly_detected=False,
+            predicted_hours_remaining=math.nan,
+            flow_calculated=math.nan
+        )
+
+    @staticmethod
+    def _max0(values: np.ndarray) -> np.ndarray:
+        """Equivalente vettoriale di max(0.0, x) (stessa semantica anche con NaN)"""
+        return np.where(values > 0.0, values, 0.0)
+
+    @staticmethod
+    def _min_cap(cap: float, values: np.ndarray) -> np.ndarray:
+        """Equivalente vettoriale di min(cap, x)"""
+        return np.where(values < cap, values, cap)
+
+    def interpolate_batch(self, x: np.ndarray, x_arr: np.ndarray, y_arr: np.ndarray) -> np.ndarray:
+        """Versione vettoriale di interpolate() su un array di x"""
+        result = np.where(
+            x <= x_arr[0], y_arr[0],
+            np.where(x >= x_arr[-1], y_arr[-1], np.interp(x, x_arr, y_arr))
+        )
+        return self._max0(result.astype(np.float64))
+
+    def convert_blynk_pwm_to_real_speed_batch(self, blynk_pwm_percent: np.ndarray) -> np.ndarray:
+        """Versione vettoriale di convert_blynk_pwm_to_real_speed()"""
+        pwm = np.asarray(blynk_pwm_percent, dtype=np.float64)
+        duty_cycle = self.map_value(pwm, 1, 100, self.MIN_FAN_SPEED_PWM, self.MAX_FAN_SPEED_PWM)
+        physical_pwm_percent = (duty_cycle / 255.0) * 100.0
+
+        curve_scale_percent = self.map_value(physical_pwm_percent, 25.0, 60.0, 0.0, 100.0)
+        curve_scale_percent = self._max0(self._min_cap(100.0, curve_scale_percent))
+        curve_scale_percent = np.where(physical_pwm_percent <= 25.0, 0.0, curve_scale_percent)
+
+        return np.where(pwm == 0, 0.0, curve_scale_percent)
+
+    def calculate_metrics_batch(self, pwm_percentage, pressure_measured=None, hours_since_change=None,
+                                update_state: bool = False) -> dict:
+        """
+        Calcola le metriche su interi array di campioni in un solo passaggio
+
+        Accetta array separati di PWM e pressione, oppure come primo argomento una
+        tabella con colonne pwm_percentage/pressure_measured (DataFrame, array
+        strutturato, dict di array, npz). I risultati coincidono con chiamate
+        successive di calculate_metrics sugli stessi campioni, incluso il trend
+        ostruzione calcolato sullo storico circolare a 10 posizioni.
+
+        Args:
+            pwm_percentage: PWM Blynk (0-100%) o tabella di campioni
+            pressure_measured: Pressione misurata (Pa)
+            hours_since_change: Ore filtro per campione (default: stato corrente, come
+                chiamate ripetute senza avanzamento del timer; se omesso e il primo
+                argomento è una tabella con hours_since_change viene usata quella colonna)
+            update_state: Se True aggiorna storico ostruzione come il percorso scalare
+
+        Returns:
+            Dict colonna CalculatedMetrics -> np.ndarray
+        """
+        if pressure_measured is None:
+            table = pwm_percentage
+            pwm_percentage = table['pwm_percentage']
+            pressure_measured = table['pressure_measured']
+            if hours_since_change is None:
+                try:
+                    hours_since_change = table['hours_since_change']
+                except (KeyError, ValueError, IndexError):
+                    hours_since_change = None
+
+        pwm = np.asarray(pwm_percentage, dtype=np.float64).ravel()
+        pressure = np.asarray(pressure_measured, dtype=np.float64).ravel()
+        n = len(pwm)
+        if hours_since_change is None:
+            hours = np.full(n, float(self.hours_since_change))
+        else:
+            hours = np.broadcast_to(np.asarray(hours_since_change, dtype=np.float64), (n,))
+
+        # Campioni con ingressi mancanti: come missing_metrics(), fuori dallo storico ostruzione
+        valid = ~(np.isnan(pwm) | np.isnan(pressure))
+        if not valid.all():
+            partial = self.calculate_metrics_batch(pwm[valid], pressure[valid], hours[valid], update_state)
+            result = {}
+            for column, values in partial.items():
+                if values.dtype == bool:
+                    full = np.zeros(n, dtype=bool)
+                else:
+                    full = np.full(n, np.nan)
+                full[valid] = values
+                result[column] = full
+            result['hours_since_change'] = np.array(hours, dtype=np.float64)
+            return result
+
+        # Portata: calibrazione empirica o curve scalate raggruppando per livello PWM
+        if self.empirical_active():
+            flow_calculated = self.calibration.predict_batch(pwm, pressure)
+        else:
+            flow_calculated = np.empty(n, dtype=np.float64)
+            pressure_corrected = pressure + self.PRESSURE_OFFSET
+            for level in np.unique(pwm):
+                mask = pwm == level if not np.isnan(level) else np.isnan(pwm)
+                q_fan_scaled, p_fan_scaled = self.scaled_fan_curves(float(level))
+                flow_calculated[mask] = self.interpolate_batch(pressure_corrected[mask], p_fan_scaled,
+                                                               q_fan_scaled)
+
+        pressure_clean = self.interpolate_batch(flow_calculated, self.filter_flow, self.filter_pressure)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            obstruction_index = np.where(pressure_clean > 0.1, pressure / pressure_clean, 1.0)
+
+        filter_wear = self._max0(self._min_cap(100.0, (obstruction_index - 1.0) * 100.0))
+        filter_efficiency = self._max0(self._min_cap(100.0, (2.0 - obstruction_index) * 100.0))
+
+        # Trend: ricostruisce, per ogni campione, il contenuto delle 10 posizioni dello storico
+        slots = len(self.obstruction_history)
+        start_index = self.history_index
+        steps = np.arange(n)
+        initial_history = np.asarray(self.obstruction_history, dtype=np.float64)
+        slot_values = []
+        for slot in range(slots):
+            last_written = steps - (start_index + steps - slot) % slots
+            values = np.where(last_written >= 0, obstruction_index[np.maximum(last_written, 0)],
+                              initial_history[slot])
+            slot_values.append(values)
+
+        half = slots // 2
+        recent_sum = slot_values[0].copy()
+        for values in slot_values[1:half]:
+            recent_sum += values
+        older_sum = slot_values[half].copy()
+        for values in slot_values[half + 1:]:
+            older_sum += values
+        obstruction_trend = recent_sum / 5.0 - older_sum / 5.0
+
+        filter_change_needed = (obstruction_index >= self.MAX_OBSTRUCTION_CRITICAL) | \
+                               (hours >= self.FILTER_CHANGE_HOURS)
+        system_anomaly = (pressure > 500) | (pressure < 0) | (obstruction_index > self.MAX_OBSTRUCTION_CRITICAL)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            degradation_rate = filter_wear / hours
+            predicted_hours = np.where(degradation_rate > 0, (100.0 - filter_wear) / degradation_rate, 999.0)
+        predicted_hours = np.where((filter_wear > 0) & (hours > 10), predicted_hours, 999.0)
+        predicted_hours = self._min_cap(999.0, predicted_hours)
+
+        if update_state and n:
+            self.obstruction_history = [float(values[-1]) for values in slot_values]
+            self.history_index = (start_index + n) % slots
+
+        return {
+            'pressure_clean': pressure_clean,
+            'obstruction_index': obstruction_index,
+            'filter_wear_percent': filter_wear,
+            'filter_efficiency': filter_efficiency,
+            'obstruction_trend': obstruction_trend,
+            'hours_since_change': np.array(hours, dtype=np.float64),
+            'filter_change_needed': filter_change_needed,
+            'system_anomaly_detected': system_anomaly,
+            'predicted_hours_remaining': predicted_hours,
+            'flow_calculated': flow_calculated
+        }
+
+
+class EmpiricalCalibration:
+    """
+    Modello empirico (PWM, pressione) -> portata prefittato su griglia
+
+    Per ogni cella della griglia conserva i K punti di calibrazione più vicini
+    (distanza normalizzata come calculate_flow_empirical: PWM/50, pressione/30) e il
+    valore della media pesata 1/(d+0.1). Aggiungere un punto aggiorna solo le celle
+    di cui entra tra i più vicini; la stima per campione è un'interpolazione
+    bilineare sulla griglia, O(1) qualunque sia il numero di punti.
+    """
+
+    K_NEAREST = 3
+    PWM_SCALE = 50.0
+    PRESSURE_SCALE = 30.0
+
+    # Coordinate normalizzate delle celle, condivise tra istanze con la stessa griglia
+    _cells_cache = {}
+
+    def __init__(self, max_pressure: float = 500.0, pressure_step: float = 5.0, pwm_step: float = 1.0):
+        self.pwm_step = pwm_step
+        self.pressure_step = pressure_step
+        self.pwm_grid = np.arange(0.0, 100.0 + pwm_step / 2, pwm_step)
+        self.pressure_grid = np.arange(0.0, max_pressure + pressure_step / 2, pressure_step)
+        self.shape = (len(self.pwm_grid), len(self.pressure_grid))
+
+        key = (max_pressure, pressure_step, pwm_step)
+        if key not in self._cells_cache:
+            cell_pwm, cell_pressure = np.meshgrid(self.pwm_grid, self.pressure_grid, indexing='ij')
+            self._cells_cache[key] = (cell_pwm.ravel() / self.PWM_SCALE, cell_pressure.ravel() / self.PRESSURE_SCALE)
+        self._cell_pwm, self._cell_pressure = self._cells_cache[key]
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Rimuove tutti i punti (la griglia viene allocata solo al primo punto)"""
+        with self._lock:
+            self._nearest_distance = None
+            self._nearest_flow = None
+            self.surface = None
+            self.points = 0
+
+    def _allocate(self):
+        cells = self.shape[0] * self.shape[1]
+        self._nearest_distance = np.full((cells, self.K_NEAREST), np.inf)
+        self._nearest_flow = np.zeros((cells, self.K_NEAREST))
+        self.surface = np.zeros(self.shape)
+
+    @property
+    def ready(self) -> bool:
+        """Almeno K punti: con meno dati si usa il metodo teorico"""
+        return self.points >= self.K_NEAREST
+
+    def add_points(self, pwm, pressure, flow, chunk_size: int = 256):
+        """Aggiunge punti e aggiorna in modo incrementale solo le celle interessate"""
+        pwm = np.atleast_1d(np.asarray(pwm, dtype=np.float64))
+        pressure = np.atleast_1d(np.asarray(pressure, dtype=np.float64))
+        flow = np.atleast_1d(np.asarray(flow, dtype=np.float64))
+
+        with self._lock:
+            if self.surface is None:
+                self._allocate()
+            for start in range(0, len(pwm), chunk_size):
+                end = start + chunk_size
+                distance = np.sqrt(
+                    (self._cell_pwm[:, None] - pwm[None, start:end] / self.PWM_SCALE) ** 2 +
+                    (self._cell_pressure[:, None] - pressure[None, start:end] / self.PRESSURE_SCALE) ** 2
+                )
+                changed = (distance < self._nearest_distance[:, -1:]).any(axis=1)
+                if not changed.any():
+                    continue
+
+                # Fonde i vicini attuali con i nuovi punti e tiene i K più vicini
+                merged_distance = np.concatenate((self._nearest_distance[changed], distance[changed]), axis=1)
+                merged_flow = np.concatenate(
+                    (self._nearest_flow[changed], np.broadcast_to(flow[start:end], distance[changed].shape)), axis=1
+                )
+                order = np.argsort(merged_distance, axis=1, kind='stable')[:, :self.K_NEAREST]
+                self._nearest_distance[changed] = np.take_along_axis(merged_distance, order, axis=1)
+                self._nearest_flow[changed] = np.take_along_axis(merged_flow, order, axis=1)
+
+                weights = 1.0 / (self._nearest_distance[changed] + 0.1)
+                weights[~np.isfinite(self._nearest_distance[changed])] = 0.0
+                total = weights.sum(axis=1)
+                values = np.divide((weights * self._nearest_flow[changed]).sum(axis=1), total,
+                                   out=np.zeros(len(total)), where=total > 0)
+                self.surface.reshape(-1)[changed] = values
+
+            self.points += len(pwm)
+
+    def fit(self, pwm, pressure, flow):
+        """Ricostruisce il modello da zero"""
+        self.reset()
+        if len(np.atleast_1d(pwm)):
+            self.add_points(pwm, pressure, flow)
+
+    def _grid_position(self, value: float, step: float, size: int) -> tuple:
+        position = min(max(value / step, 0.0), size - 1.0)
+        index = min(int(position), size - 2)
+        return index, position - index
+
+    def predict(self, pwm_percent: float, pressure_measured: float) -> float:
+        """Portata stimata per un campione (interpolazione bilineare sulla griglia)"""
+        if self.surface is None or math.isnan(pwm_percent) or math.isnan(pressure_measured):
+            return float('nan')
+        i, fx = self._grid_position(pwm_percent, self.pwm_step, self.shape[0])
+        j, fy = self._grid_position(pressure_measured, self.pressure_step, self.shape[1])
+        surface = self.surface
+        return float(
+            surface[i, j] * (1.0 - fx) * (1.0 - fy) + surface[i + 1, j] * fx * (1.0 - fy) +
+            surface[i, j + 1] * (1.0 - fx) * fy + surface[i + 1, j + 1] * fx * fy
+        )
+
+    def predict_batch(self, pwm_percent: np.ndarray, pressure_measured: np.ndarray) -> np.ndarray:
+        """Versione vettoriale di predict()"""
+        pwm_percent = np.asarray(pwm_percent, dtype=np.float64)
+        pressure_measured = np.asarray(pressure_measured, dtype=np.float64)
+        missing = np.isnan(pwm_percent) | np.isnan(pressure_measured)
+        if self.surface is None:
+            return np.full(np.broadcast(pwm_percent, pressure_measured).shape, np.nan)
+
+        def grid_position(values, step, size):
+            position = np.minimum(np.maximum(np.where(missing, 0.0, values) / step, 0.0), size - 1.0)
+            index = np.minimum(position.astype(np.int64), size - 2)
+            return index, position - index
+
+        i, fx = grid_position(pwm_percent, self.pwm_step, self.shape[0])
+        j, fy = grid_position(pressure_measured, self.pressure_step, self.shape[1])
+        surface = self.surface
+        flow = (surface[i, j] * (1.0 - fx) * (1.0 - fy) + surface[i + 1, j] * fx * (1.0 - fy) +
+                surface[i, j + 1] * (1.0 - fx) * fy + surface[i + 1, j + 1] * fx * fy)
+        return np.where(missing, np.nan, flow)
+
+
+class StreamingDetector(abc.ABC):
+    """
+    Rilevatore di anomalie in streaming: tempo e memoria O(1) per campione
+
+    update() ritorna (stato, messaggio) solo quando l'allarme si attiva
+    ('raised') o rientra ('cleared'), altrimenti None. Lo stato è serializzabile
+    (STATE_FIELDS) per riprendere dopo un riavvio.
+    """
+
+    name = 'detector'
+    DEFAULTS = {}
+    STATE_FIELDS = ('alarm', 'samples')
+
+    def __init__(self, **params):
+        unknown = set(params) - set(self.DEFAULTS)
+        if unknown:
+            raise ValueError(f"Parametri sconosciuti per {self.name}: {', '.join(sorted(unknown))}")
+        self.params = {**self.DEFAULTS, **params}
+        self.reset()
+
+    def reset(self):
+        self.alarm = False
+        self.samples = 0
+
+    @abc.abstractmethod
+    def update(self, system_data: SystemData, metrics: CalculatedMetrics):
+        """Elabora un campione; (stato, messaggio) al cambio di allarme, altrimenti None"""
+
+    def _transition(self, alarm: bool, message: str):
+        """Registra il cambio di stato dell'allarme"""
+        if alarm == self.alarm:
+            return None
+        self.alarm = alarm
+        return ('raised' if alarm else 'cleared'), message
+
+    def state(self) -> dict:
+        return {name: getattr(self, name) for name in self.STATE_FIELDS}
+
+    def load(self, state: dict):
+        for name in self.STATE_FIELDS:
+            if name in state:
+                setattr(self, name, state[name])
+
+    def status(self) -> dict:
+        return {'alarm': self.alarm, 'samples': self.samples}
+
+
+class CusumDetector(StreamingDetector):
+    """
+    CUSUM su un segnale standardizzato rispetto a una baseline di riferimento
+
+    Media e varianza della baseline sono stimate sui primi `warmup` campioni,
+    poi seguono il segnale con peso alpha solo senza allarme attivo (alpha = 0:
+    baseline fissa fino al reset). direction: 1 = solo aumenti, -1 = solo
+    diminuzioni, 0 = entrambe.
+    """
+
+    DEFAULTS = {'alpha': 0.0, 'k': 0.5, 'h': 10.0, 'warmup': 200, 'min_std': 0.01}
+    STATE_FIELDS = StreamingDetector.STATE_FIELDS + ('mean', 'variance', 'upper', 'lower')
+    direction = 0
+
+    def reset(self):
+        super().reset()
+        self.mean = 0.0
+        self.variance = 0.0
+        self.upper = 0.0
+        self.lower = 0.0
+
+    @abc.abstractmethod
+    def value(self, system_data: SystemData, metrics: CalculatedMetrics):
+        """Segnale monitorato per il campione (NaN/None = campione ignorato)"""
+
+    @abc.abstractmethod
+    def message(self, value: float, score: float) -> str:
+        """Testo dell'evento quando l'allarme si attiva"""
+
+    def update(self, system_data: SystemData, metrics: CalculatedMetrics):
+        value = self.value(system_data, metrics)
+        if is_missing(value):
+            return None
+        params = self.params
+        self.samples += 1
+        delta = value - self.mean
+        if self.samples <= params['warmup']:
+            # Riferimento: media e varianza cumulative (Welford)
+            self.mean += delta / self.samples
+            self.variance += (delta * (value - self.mean) - self.variance) / self.samples
+            return None
+
+        z = delta / max(math.sqrt(self.variance), params['min_std'])
+        if self.direction >= 0:
+            self.upper = max(0.0, self.upper + z - params['k'])
+        if self.direction <= 0:
+            self.lower = max(0.0, self.lower - z - params['k'])
+        score = max(self.upper, self.lower)
+
+        if params['alpha'] and not self.alarm:
+            self.mean += params['alpha'] * delta
+            self.variance = (1 - params['alpha']) * (self.variance + params['alpha'] * delta * delta)
+
+        if score > params['h']:
+            return self._transition(True, self.message(value, score))
+        if self.alarm and score == 0.0:
+            return self._transition(False, f"{self.name}: rientrato (valore {value:.3f})")
+        return None
+
+    def status(self) -> dict:
+        return {**super().status(), 'baseline': self.mean, 'score': max(self.upper, self.lower)}
+
+
+class ObstructionCusumDetector(CusumDetector):
+    """Aumento persistente dell'indice di ostruzione rispetto al livello dopo il cambio filtro"""
+
+    name = 'obstruction_cusum'
+    direction = 1
+
+    def value(self, system_data, metrics):
+        return metrics.obstruction_index
+
+    def message(self, value, score):
+        return (f"Intasamento in corso: ostruzione {value:.3f} oltre la baseline {self.mean:.3f} "
+                f"(CUSUM {score:.1f})")
+
+
+class FlowResidualCusumDetector(CusumDetector):
+    """Deriva del residuo flow_calculated - flow_blynk (sensore di portata o pressione anomalo)"""
+
+    name = 'flow_residual_cusum'
+    DEFAULTS = {**CusumDetector.DEFAULTS, 'alpha': 0.001, 'min_std': 5.0, 'min_flow': 0.1}
+
+    def value(self, system_data, metrics):
+        if is_missing(system_data.flow_blynk) or system_data.flow_blynk <= self.params['min_flow']:
+            return None
+        return metrics.flow_calculated - system_data.flow_blynk
+
+    def message(self, value, score):
+        return (f"Residuo portata anomalo: {value:+.0f} m³/h contro baseline {self.mean:+.0f} "
+                f"(CUSUM {score:.1f}), possibile guasto sensore")
+
+
+class PressureBandZScoreDetector(StreamingDetector):
+    """
+    z-score robusto della pressione per fascia PWM
+
+    Per ogni fascia mediana e deviazione assoluta media sono stimate in modo
+    incrementale (approssimazione stocastica), l'allarme scatta dopo
+    `persistence` campioni consecutivi con |z| oltre la soglia.
+    """
+
+    name = 'pressure_band_zscore'
+    DEFAULTS = {'band': 10.0, 'eta': 0.05, 'threshold': 6.0, 'persistence': 3, 'warmup': 20, 'min_mad': 1.0}
+    STATE_FIELDS = StreamingDetector.STATE_FIELDS + ('bands', 'streak')
+
+    def reset(self):
+        super().reset()
+        # fascia -> [mediana, deviazione assoluta, campioni]
+        self.bands = {}
+        self.streak = 0
+
+    def update(self, system_data: SystemData, metrics: CalculatedMetrics):
+        pwm, pressure = system_data.pwm_percentage, system_data.pressure_measured
+        if is_missing(pwm) or is_missing(pressure):
+            return None
+        params = self.params
+        self.samples += 1
+        key = str(int(min(max(pwm, 0.0), 100.0 - params['band']) // params['band']))
+        band = self.bands.get(key)
+        if band is None:
+            self.bands[key] = [pressure, params['min_mad'], 1]
+            return None
+
+        median, mad, count = band
+        scale = max(1.4826 * mad, params['min_mad'])
+        z = (pressure - median) / scale
+        outlier = count >= params['warmup'] and abs(z) > params['threshold']
+
+        if not outlier:
+            # Stime aggiornate solo con campioni plausibili
+            band[0] = median + params['eta'] * scale * float(np.sign(pressure - median))
+            band[1] = mad + params['eta'] * (abs(pressure - median) - mad)
+        band[2] = count + 1
+
+        self.streak = self.streak + 1 if outlier else 0
+        if self.streak >= params['persistence']:
+            return self._transition(True, f"Pressione fuori distribuzione per PWM {pwm:.0f}%: {pressure:.1f} Pa "
+                                          f"(mediana {median:.1f}, z {z:+.1f}), verificare sensore")
+        if self.alarm and not outlier:
+            return self._transition(False, f"{self.name}: pressione rientrata ({pressure:.1f} Pa)")
+        return None
+
+
+DETECTORS = {
+    ObstructionCusumDetector.name: ObstructionCusumDetector,
+    FlowResidualCusumDetector.name: FlowResidualCusumDetector,
+    PressureBandZScoreDetector.name: PressureBandZScoreDetector,
+}
+
+
+class AnomalyDetectors:
+    """Catena di rilevatori eseguita dopo calculate_metrics, con stato serializzabile per nome"""
+
+    def __init__(self, detectors: list = None):
+        self.detectors = detectors or []
+
+    @classmethod
+    def create(cls, names: str, params: dict = None) -> 'AnomalyDetectors':
+        """Rilevatori indicati (nomi separati da virgola); params {nome: {...}} o {nome: false} per disattivarlo"""
+        params = params or {}
+        detectors = []
+        for name in [n.strip() for n in names.split(',') if n.strip()]:
+            if name not in DETECTORS:
+                raise ValueError(f"Rilevatore sconosciuto: {name} (disponibili: {', '.join(DETECTORS)})")
+            if params.get(name) is False:
+                continue
+            detectors.append(DETECTORS[name](**params.get(name, {})))
+        return cls(detectors)
+
+    def __bool__(self):
+        return bool(self.detectors)
+
+    def update(self, system_data: SystemData, metrics: CalculatedMetrics) -> list:
+        """Transizioni [(nome, 'raised'|'cleared', messaggio)] del campione"""
+        transitions = []
+        for detector in self.detectors:
+            result = detector.update(system_data, metrics)
+            if result is not None:
+                transitions.append((detector.name, *result))
+        return transitions
+
+    def reset(self):
+        for detector in self.detectors:
+            detector.reset()
+
+    def state(self) -> dict:
+        return {detector.name: detector.state() for detector in self.detectors}
+
+    def load(self, states: dict):
+        for detector in self.detectors:
+            if detector.name in states:
+                detector.load(states[detector.name])
+
+    def active(self) -> list:
+        return [detector.name for detector in self.detectors if detector.alarm]
+
+    def status(self) -> dict:
+        return {detector.name: detector.status() for detector in self.detectors}
+
+
+def iso_to_epoch(timestamp: str) -> float:
+    """Timestamp ISO (ora locale come datetime.now().isoformat()) -> epoch Unix"""
+    try:
+        return datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class RunningMoments:
+    """Media/varianza online (Welford) con min/max e somma dei valori assoluti"""
+
+    def __init__(self, state: list = None):
+        self.count, self.mean, self.m2, self.abs_sum, self.min, self.max = state or (0, 0.0, 0.0, 0.0, None, None)
+
+    def add(self, value: float, sign: int = 1):
+        """Aggiunge (sign=1) o rimuove (sign=-1) un valore; min/max solo in aggiunta"""
+        if sign > 0:
+            self.count += 1
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (value - self.mean)
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+        elif self.count <= 1:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+        else:
+            self.count -= 1
+            delta = value - self.mean
+            self.mean -= delta / self.count
+            self.m2 = max(0.0, self.m2 - delta * (value - self.mean))
+        self.abs_sum += sign * abs(value)
+
+    def state(self) -> list:
+        return [self.count, self.mean, self.m2, self.abs_sum, self.min, self.max]
+
+    def as_dict(self) -> dict:
+        if not self.count:
+            return {'samples': 0, 'mean': None, 'std': None, 'mae': None, 'rmse': None, 'min': None, 'max': None}
+        variance = self.m2 / self.count
+        return {
+            'samples': self.count,
+            'mean': self.mean,
+            'std': math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0,
+            'mae': self.abs_sum / self.count,
+            'rmse': math.sqrt(variance + self.mean ** 2),
+            'min': self.min,
+            'max': self.max
+        }
+
+
+class RunningStatistics:
+    """
+    Statistiche di test_data di un dispositivo aggiornate ad ogni inserimento
+
+    Conteggi, massimi, allarmi e intervallo temporale come le vecchie query
+    aggregate, più errore di portata (flow_calculated - flow_blynk, Welford) e
+    riepiloghi per fascia PWM. Stato serializzabile in JSON per la persistenza.
+    """
+
+    VERSION = 1
+    PWM_BAND = 10
+    # Portata Blynk minima considerata una misura valida per l'errore
+    MIN_VALID_FLOW = 0.1
+    COLUMNS = ('ts_epoch', 'timestamp', 'pwm_percentage', 'pressure_measured', 'flow_blynk', 'flow_calculated',
+               'obstruction_index', 'filter_wear_percent', 'filter_change_needed', 'system_anomaly_detected')
+
+    def __init__(self, state: dict = None):
+        state = state or {}
+        self.total_points = state.get('total_points', 0)
+        self.missing_points = state.get('missing_points', 0)
+        self.change_alerts = state.get('change_alerts', 0)
+        self.anomalies = state.get('anomalies', 0)
+        self.max_wear = state.get('max_wear')
+        self.max_obstruction = state.get('max_obstruction')
+        self.start = state.get('start')  # [ts_epoch, timestamp]
+        self.end = state.get('end')
+        self.flow_error = RunningMoments(state.get('flow_error'))
+        # fascia (limite inferiore PWM) -> [campioni, somma pressione, n pressione, somma ostruzione, n ostruzione, errore]
+        self.bands = {int(band): values[:5] + [RunningMoments(values[5])]
+                      for band, values in state.get('bands', {}).items()}
+
+    def add(self, row: dict, sign: int = 1):
+        """Aggiunge (sign=1) o toglie (sign=-1) una riga; massimi e intervallo solo in aggiunta"""
+        self.total_points += sign
+        pwm, pressure = row['pwm_percentage'], row['pressure_measured']
+        if is_missing(pwm) or is_missing(pressure):
+            self.missing_points += sign
+        self.change_alerts += sign * int(bool(row['filter_change_needed']))
+        self.anomalies += sign * int(bool(row['system_anomaly_detected']))
+
+        if sign > 0:
+            wear, obstruction = row['filter_wear_percent'], row['obstruction_index']
+            if not is_missing(wear):
+                self.max_wear = wear if self.max_wear is None else max(self.max_wear, wear)
+            if not is_missing(obstruction):
+                self.max_obstruction = obstruction if self.max_obstruction is None else \
+                    max(self.max_obstruction, obstruction)
+            if row['ts_epoch'] is not None:
+                point = [row['ts_epoch'], row['timestamp']]
+                if self.start is None or point[0] < self.start[0]:
+                    self.start = point
+                if self.end is None or point[0] > self.end[0]:
+                    self.end = point
+
+        flow_blynk, flow_calculated = row['flow_blynk'], row['flow_calculated']
+        error = None
+        if not (is_missing(flow_blynk) or is_missing(flow_calculated)) and flow_blynk > self.MIN_VALID_FLOW:
+            error = flow_calculated - flow_blynk
+            self.flow_error.add(error, sign)
+
+        if is_missing(pwm):
+            return
+        band = self.bands.setdefault(self.band(pwm), [0, 0.0, 0, 0.0, 0, RunningMoments()])
+        band[0] += sign
+        if not is_missing(pressure):
+            band[1] += sign * pressure
+            band[2] += sign
+        obstruction = row['obstruction_index']
+        if not is_missing(obstruction):
+            band[3] += sign * obstruction
+            band[4] += sign
+        if error is not None:
+            band[5].add(error, sign)
+
+    @classmethod
+    def band(cls, pwm: float) -> int:
+        return int(min(max(pwm, 0.0), 100.0 - cls.PWM_BAND) // cls.PWM_BAND * cls.PWM_BAND)
+
+    def state(self) -> dict:
+        return {
+            'version': self.VERSION,
+            'total_points': self.total_points,
+            'missing_points': self.missing_points,
+            'change_alerts': self.change_alerts,
+            'anomalies': self.anomalies,
+            'max_wear': self.max_wear,
+            'max_obstruction': self.max_obstruction,
+            'start': self.start,
+            'end': self.end,
+            'flow_error': self.flow_error.state(),
+            'bands': {str(band): values[:5] + [values[5].state()] for band, values in self.bands.items()}
+        }
+
+    def as_dict(self) -> dict:
+        """Statistiche per /api/statistics"""
+        bands = []
+        for band in sorted(self.bands):
+            count, pressure_sum, pressure_n, obstruction_sum, obstruction_n, error = self.bands[band]
+            if count <= 0:
+                continue
+            bands.append({
+                'pwm_min': band,
+                'pwm_max': band + self.PWM_BAND,
+                'samples': count,
+                'pressure_mean': pressure_sum / pressure_n if pressure_n else None,
+                'obstruction_mean': obstruction_sum / obstruction_n if obstruction_n else None,
+                'flow_error': error.as_dict()
+            })
+        return {
+            'total_points': self.total_points,
+            'missing_points': self.missing_points,
+            'max_wear': self.max_wear,
+            'max_obstruction': self.max_obstruction,
+            'change_alerts': self.change_alerts,
+            'anomalies': self.anomalies,
+            'start_time': self.start[1] if self.start else None,
+            'end_time': self.end[1] if self.end else None,
+            'flow_error': self.flow_error.as_dict(),
+            'pwm_bands': bands
+        }
+
 
 class TestDatabase:
     """Database SQLite ottimizzato per Balena"""
 
-    def __init__(self, db_path: str = "/data/test_data.db"):
+    # Pragma connessione scrittura: WAL riduce fsync e scritture ripetute sulla SD
+    WRITER_PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-8000",
+        "PRAGMA wal_autocheckpoint=1000",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    # Rollup multi-risoluzione (secondi per bucket) e colonne aggregate min/media/max
+    ROLLUP_RESOLUTIONS = (60, 900, 3600)
+    ROLLUP_COLUMNS = ('pressure_measured', 'flow_blynk', 'flow_calculated',
+                      'obstruction_index', 'filter_wear_percent')
+
+    # Colonne testuali escluse dagli export colonnari numerici
+    TEXT_COLUMNS = ('timestamp', 'device_id')
+
+    # Connessioni lettura inattive conservate: oltre, quelle restituite vengono chiuse
+    READER_POOL_SIZE = 8
+
+    def __init__(self, db_path: str = "/data/test_data.db", commit_batch_size: int = 20,
+                 commit_interval: float = 60.0, default_device: str = 'default', read_only: bool = False):
         self.db_path = db_path
+        # Sola lettura (worker API): schema e scritture sono del processo campionatore
+        self.read_only = read_only
+        # Dispositivo usato quando device_id non è indicato (e assegnato ai dati pre-flotta)
+        self.default_device = default_device
+        self.commit_batch_size = max(1, commit_batch_size)
+        self.commit_interval = commit_interval
         # Crea directory se non esiste
-        os.makedirs(os.path.dirname(db_path), exist_ok=True)
-        self.init_database()
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+
+        # Connessione scrittura persistente condivisa (protetta da lock)
+        self._write_lock = threading.RLock()
+        self._writer = sqlite3.connect(self.db_path, check_same_thread=False)
+        for pragma in (("PRAGMA busy_timeout=5000", "PRAGMA query_only=1") if read_only else self.WRITER_PRAGMAS):
+            self._writer.execute(pragma)
+        self._pending = 0
+        self._last_commit = time.monotonic()
+        self._flusher = None
+
+        # Statistiche incrementali per dispositivo, salvate in test_statistics ad ogni commit
+        self._statistics = {}
+        self._dirty_statistics = set()
+        # Stato rilevatori anomalie in attesa di scrittura: device_id -> {nome: stato}
+        self._detector_states = {}
+
+        # Pool di connessioni lettura riusate tra richieste (i thread del server sono spesso di breve durata)
+        self._readers = queue.LifoQueue(self.READER_POOL_SIZE)
+
+        if not read_only:
+            self.init_database()
 
     def init_database(self):
         """Inizializza database"""
-        conn = sqlite3.connect(self.db_path)
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS test_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp TEXT,
-                pwm_percentage REAL,
-                pressure_measured REAL,
-                flow_blynk REAL,
-                flow_calculated REAL,
-                temperature REAL,
-                pm_value REAL,
-                pressure_clean REAL,
-                obstruction_index REAL,
-                filter_wear_percent REAL,
-                filter_efficiency REAL,
-                obstruction_trend REAL,
-                hours_since_change REAL,
-                filter_change_needed INTEGER,
-                system_anomaly_detected INTEGER,
-                predicted_hours_remaining REAL
+        with self._write_lock:
+            conn = self._writer
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS test_data (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT,
+                    pwm_percentage REAL,
+                    pressure_measured REAL,
+                    flow_blynk REAL,
+                    flow_calculated REAL,
+                    temperature REAL,
+                    pm_value REAL,
+                    pressure_clean REAL,
+                    obstruction_index REAL,
+                    filter_wear_percent REAL,
+                    filter_efficiency REAL,
+                    obstruction_trend REAL,
+                    hours_since_change REAL,
+                    filter_change_needed INTEGER,
+                    system_anomaly_detected INTEGER,
+                    predicted_hours_remaining REAL,
+                    ts_epoch REAL,
+                    device_id TEXT
+                )
+            ''')
+
+            self._migrate_epoch(conn)
+
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS system_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT,
+                    event_type TEXT,
+                    message TEXT,
+                    severity TEXT,
+                    device_id TEXT
+                )
+            ''')
+
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS calibration_points (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT,
+                    ts_epoch REAL,
+                    pwm REAL,
+                    pressure REAL,
+                    flow REAL,
+                    source TEXT,
+                    device_id TEXT
+                )
+            ''')
+
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS test_statistics (
+                    device_id TEXT PRIMARY KEY,
+                    state TEXT,
+                    updated_at TEXT
+                )
+            ''')
+
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS detector_state (
+                    device_id TEXT,
+                    detector TEXT,
+                    state TEXT,
+                    updated_at TEXT,
+                    PRIMARY KEY (device_id, detector)
+                )
+            ''')
+
+            self._migrate_device(conn)
+            conn.execute('DROP INDEX IF EXISTS idx_test_data_ts_epoch')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_test_data_device_ts ON test_data(device_id, ts_epoch)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_calibration_device ON calibration_points(device_id)')
+
+            aggregate_columns = ',\n'.join(
+                f'{column}_sum REAL, {column}_min REAL, {column}_max REAL, {column}_count INTEGER'
+                for column in self.ROLLUP_COLUMNS
+            )
+            rollup_columns = {row[1] for row in conn.execute('PRAGMA table_info(test_data_rollup)')}
+            expected = {'device_id'} | {f'{column}_count' for column in self.ROLLUP_COLUMNS}
+            if rollup_columns and not expected <= rollup_columns:
+                # Rollup di una versione precedente (senza device_id o conteggi per colonna):
+                # tabella derivata, si ricostruisce
+                conn.execute('DROP TABLE test_data_rollup')
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS test_data_rollup (
+                    device_id TEXT,
+                    resolution INTEGER,
+                    bucket INTEGER,
+                    count INTEGER,
+                    {aggregate_columns},
+                    PRIMARY KEY (device_id, resolution, bucket)
+                ) WITHOUT ROWID
+            ''')
+            self._build_rollup_sql()
+            self._backfill_rollups(conn)
+
+            conn.commit()
+
+    def _build_rollup_sql(self):
+        """Prepara lo statement di upsert incrementale dei rollup (valori mancanti NULL ignorati)"""
+        columns = ', '.join(f'{c}_sum, {c}_min, {c}_max, {c}_count' for c in self.ROLLUP_COLUMNS)
+        placeholders = ', '.join('?, ?, ?, ?' for _ in self.ROLLUP_COLUMNS)
+        updates = ',\n'.join(
+            f'{c}_sum = COALESCE({c}_sum + excluded.{c}_sum, {c}_sum, excluded.{c}_sum), '
+            f'{c}_min = COALESCE(MIN({c}_min, excluded.{c}_min), {c}_min, excluded.{c}_min), '
+            f'{c}_max = COALESCE(MAX({c}_max, excluded.{c}_max), {c}_max, excluded.{c}_max), '
+            f'{c}_count = {c}_count + excluded.{c}_count'
+            for c in self.ROLLUP_COLUMNS
+        )
+        self._rollup_upsert_sql = f'''
+            INSERT INTO test_data_rollup (device_id, resolution, bucket, count, {columns})
+            VALUES (?, ?, ?, ?, {placeholders})
+            ON CONFLICT (device_id, resolution, bucket) DO UPDATE SET
+                count = count + excluded.count,
+                {updates}
+        '''
+
+    def _backfill_rollups(self, conn: sqlite3.Connection):
+        """Costruisce i rollup dai dati grezzi se la tabella è nuova"""
+        if conn.execute('SELECT 1 FROM test_data_rollup LIMIT 1').fetchone():
+            return
+        if not conn.execute('SELECT 1 FROM test_data WHERE ts_epoch IS NOT NULL LIMIT 1').fetchone():
+            return
+
+        columns = ', '.join(f'{c}_sum, {c}_min, {c}_max, {c}_count' for c in self.ROLLUP_COLUMNS)
+        aggregates = ', '.join(f'SUM({c}), MIN({c}), MAX({c}), COUNT({c})' for c in self.ROLLUP_COLUMNS)
+        for resolution in self.ROLLUP_RESOLUTIONS:
+            conn.execute(f'''
+                INSERT INTO test_data_rollup (device_id, resolution, bucket, count, {columns})
+                SELECT device_id, ?, CAST(ts_epoch / ? AS INTEGER) * ?, COUNT(*), {aggregates}
+                FROM test_data
+                WHERE ts_epoch IS NOT NULL
+                GROUP BY device_id, CAST(ts_epoch / ? AS INTEGER)
+            ''', (resolution, resolution, resolution, resolution))
+        logger.info(f"Rollup ricostruiti per risoluzioni {self.ROLLUP_RESOLUTIONS}")
+
+    def _migrate_epoch(self, conn: sqlite3.Connection):
+        """Aggiunge e popola ts_epoch nei database creati prima dell'indice temporale"""
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(test_data)')}
+        if 'ts_epoch' in columns:
+            # Già migrato: niente scansione completa della tabella ad ogni avvio
+            return
+
+        logger.info("Migrazione database: aggiunta colonna ts_epoch")
+        conn.execute('ALTER TABLE test_data ADD COLUMN ts_epoch REAL')
+        conn.create_function('iso_to_epoch', 1, iso_to_epoch)
+        cursor = conn.execute('UPDATE test_data SET ts_epoch = iso_to_epoch(timestamp) WHERE ts_epoch IS NULL')
+        if cursor.rowcount > 0:
+            logger.info(f"Migrazione database: {cursor.rowcount} righe con ts_epoch")
+
+    def _migrate_device(self, conn: sqlite3.Connection):
+        """Aggiunge device_id alle tabelle pre-flotta e assegna le righe esistenti al dispositivo di default"""
+        for table in ('test_data', 'system_events', 'calibration_points'):
+            columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+            if 'device_id' not in columns:
+                logger.info(f"Migrazione database: aggiunta colonna device_id a {table}")
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN device_id TEXT')
+                cursor = conn.execute(f'UPDATE {table} SET device_id = ? WHERE device_id IS NULL',
+                                      (self.default_device,))
+                if cursor.rowcount > 0:
+                    logger.info(f"Migrazione database: {cursor.rowcount} righe di {table} -> {self.default_device}")
+
+    def _device(self, device_id: str = None) -> str:
+        return device_id or self.default_device
+
+    @contextlib.contextmanager
+    def _reader(self):
+        """Connessione in sola lettura presa dal pool per la durata del blocco"""
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("PRAGMA query_only=1")
+        try:
+            yield conn
+        except BaseException:
+            # Stato della connessione incerto (cursore a metà): non torna nel pool
+            conn.close()
+            raise
+        try:
+            self._readers.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _start_flusher(self):
+        """Avvia (una volta) il thread che committa i punti in attesa allo scadere di commit_interval"""
+        if self._flusher is not None or self.commit_interval <= 0:
+            return
+
+        with self._write_lock:
+            # Ricontrollo sotto lock: i worker dello scheduler salvano in parallelo
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name='db-flusher', daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        """Thread db-flusher: commit periodico dei punti in attesa"""
+        while True:
+            time.sleep(self.commit_interval)
+            with self._write_lock:
+                if self._pending and time.monotonic() - self._last_commit >= self.commit_interval:
+                    self._commit()
+
+    def _commit(self):
+        """Commit della transazione corrente (chiamare con _write_lock acquisito)"""
+        if self._dirty_statistics:
+            # Statistiche nella stessa transazione delle righe: sempre coerenti dopo un riavvio
+            updated_at = datetime.now().isoformat()
+            self._writer.executemany(
+                'INSERT OR REPLACE INTO test_statistics (device_id, state, updated_at) VALUES (?, ?, ?)',
+                [(device_id, json.dumps(self._statistics[device_id].state()), updated_at)
+                 for device_id in self._dirty_statistics]
             )
-        ''')
-
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS system_events (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp TEXT,
-                event_type TEXT,
-                message TEXT,
-                severity TEXT
+            self._dirty_statistics.clear()
+        if self._detector_states:
+            updated_at = datetime.now().isoformat()
+            self._writer.executemany(
+                'INSERT OR REPLACE INTO detector_state (device_id, detector, state, updated_at) VALUES (?, ?, ?, ?)',
+                [(device_id, detector, json.dumps(state), updated_at)
+                 for device_id, states in self._detector_states.items() for detector, state in states.items()]
             )
-        ''')
+            self._detector_states.clear()
+        with DB_COMMIT_SECONDS.time():
+            self._writer.commit()
+        DB_COMMITTED_ROWS.inc(amount=self._pending)
+        if self._pending:
+            logger.debug(f"Commit {self._pending} punti dati")
+        self._pending = 0
+        self._last_commit = time.monotonic()
+
+    def flush(self):
+        """Scrive subito su disco i punti in attesa"""
+        with self._write_lock:
+            if self._pending or self._detector_states:
+                self._commit()
+
+    def close(self):
+        """Flush finale e chiusura connessione scrittura"""
+        with self._write_lock:
+            self.flush()
+            self._writer.close()
+
+    def save_data_point(self, system_data: SystemData, metrics: CalculatedMetrics, device_id: str = None):
+        """Salva singolo punto dati (commit a gruppi per numero o tempo)"""
+        device_id = self._device(device_id)
+        ts_epoch = iso_to_epoch(system_data.timestamp)
+        with self._write_lock:
+            statistics = self._statistics_for(device_id)
+            self._writer.execute('''
+                INSERT INTO test_data 
+                (timestamp, pwm_percentage, pressure_measured, flow_blynk, flow_calculated,
+                 temperature, pm_value, pressure_clean, obstruction_index, filter_wear_percent,
+                 filter_efficiency, obstruction_trend, hours_since_change, filter_change_needed,
+                 system_anomaly_detected, predicted_hours_remaining, ts_epoch, device_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                system_data.timestamp, system_data.pwm_percentage, system_data.pressure_measured,
+                system_data.flow_blynk, metrics.flow_calculated, system_data.temperature,
+                system_data.pm_value, metrics.pressure_clean, metrics.obstruction_index,
+                metrics.filter_wear_percent, metrics.filter_efficiency, metrics.obstruction_trend,
+                metrics.hours_since_change, 1 if metrics.filter_change_needed else 0,
+                1 if metrics.system_anomaly_detected else 0, metrics.predicted_hours_remaining,
+                ts_epoch, device_id
+            ))
+            self._update_rollups(ts_epoch, self._rollup_values(system_data, metrics), device_id)
+            statistics.add({'ts_epoch': ts_epoch, 'timestamp': system_data.timestamp,
+                            **asdict(system_data), **asdict(metrics)})
+            self._dirty_statistics.add(device_id)
+            self._after_write(1)
+
+        self._start_flusher()
+
+    def amend_data_point(self, ts_epoch: float, values: dict, device_id: str = None) -> bool:
+        """
+        Completa un punto salvato con valori mancanti (recupero storico dopo un'interruzione)
 
-        conn.commit()
-        conn.close()
+        values: colonna -> valore delle sole colonne prima NULL; i rollup ricevono i
+        nuovi valori senza contare di nuovo il campione. False se il punto non esiste.
+        """
+        device_id = self._device(device_id)
+        values = {column: int(value) if isinstance(value, bool) else value for column, value in values.items()}
+        assignments = ', '.join(f'{column} = ?' for column in values)
+        with self._write_lock:
+            statistics = self._statistics_for(device_id)
+            previous = self._statistics_row(device_id, ts_epoch)
+            cursor = self._writer.execute(
+                f'UPDATE test_data SET {assignments} WHERE device_id = ? AND ts_epoch = ?',
+                (*values.values(), device_id, ts_epoch)
+            )
+            if cursor.rowcount == 0:
+                return False
+            self._update_rollups(ts_epoch, values, device_id, samples=0)
+            statistics.add(previous, sign=-1)
+            statistics.add(self._statistics_row(device_id, ts_epoch))
+            self._dirty_statistics.add(device_id)
+            self._after_write(1)
+
+        self._start_flusher()
+        return True
+
+    def save_columns(self, columns: dict, device_id: str = None, chunk_size: int = 50000) -> int:
+        """
+        Inserimento massivo di campioni in ordine temporale (colonna -> array), es. dati sintetici
+
+        Le colonne di test_data assenti restano NULL (timestamp ricavato da ts_epoch).
+        I rollup sono aggregati per bucket con NumPy e uniti ai bucket esistenti; le
+        statistiche incrementali del dispositivo vengono ricostruite alla prossima lettura.
+        Un commit per blocco, così il lock di scrittura non resta preso a lungo.
+        """
+        device_id = self._device(device_id)
+        ts_epoch = np.asarray(columns['ts_epoch'], dtype=np.float64)
+        names = [c for c in self.get_columns() if c in columns and c not in ('id', 'timestamp', 'device_id')]
+        total = len(ts_epoch)
+
+        for start in range(0, total, chunk_size):
+            end = min(start + chunk_size, total)
+            chunk = {name: np.asarray(columns[name][start:end]) for name in names}
+            values = [chunk[name].astype(np.int64 if chunk[name].dtype == np.bool_ else np.float64).tolist()
+                      for name in names]
+            timestamps = [datetime.fromtimestamp(ts).isoformat() for ts in ts_epoch[start:end].tolist()]
+            with self._write_lock:
+                self._writer.executemany(
+                    f"INSERT INTO test_data (timestamp, device_id, {', '.join(names)}) "
+                    f"VALUES (?, ?, {', '.join('?' for _ in names)})",
+                    zip(timestamps, itertools.repeat(device_id), *values)
+                )
+                self._bulk_rollups(ts_epoch[start:end], chunk, device_id)
+                self._pending += end - start
+                self._commit()
+
+        with self._write_lock:
+            self._statistics.pop(device_id, None)
+            self._dirty_statistics.discard(device_id)
+            self._writer.execute('DELETE FROM test_statistics WHERE device_id = ?', (device_id,))
+            self._writer.commit()
+        logger.info(f"Inserimento massivo: {total} righe per {device_id}")
+        return total
+
+    def _bulk_rollups(self, ts_epoch: np.ndarray, columns: dict, device_id: str):
+        """Aggrega un blocco ordinato per bucket di ogni risoluzione e lo unisce ai rollup (con _write_lock)"""
+        for resolution in self.ROLLUP_RESOLUTIONS:
+            buckets = (ts_epoch // resolution).astype(np.int64) * resolution
+            starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+            aggregates = []
+            for column in self.ROLLUP_COLUMNS:
+                values = np.asarray(columns.get(column, np.full(len(ts_epoch), np.nan)), dtype=np.float64)
+                valid = ~np.isnan(values)
+                counts = np.add.reduceat(valid.astype(np.int64), starts)
+                sums = np.add.reduceat(np.where(valid, values, 0.0), starts)
+                # Bucket senza valori: NaN -> NULL, ignorati dall'upsert
+                aggregates.extend((np.where(counts > 0, sums, np.nan), np.fmin.reduceat(values, starts),
+                                   np.fmax.reduceat(values, starts), counts))
+            samples = np.diff(np.append(starts, len(ts_epoch)))
+            self._writer.executemany(self._rollup_upsert_sql, zip(
+                itertools.repeat(device_id), itertools.repeat(resolution), buckets[starts].tolist(),
+                samples.tolist(), *(array.tolist() for array in aggregates)
+            ))
+
+    def _after_write(self, rows: int):
+        """Conta le righe in attesa e committa a soglia (chiamare con _write_lock acquisito)"""
+        self._pending += rows
+        if (self._pending >= self.commit_batch_size or
+                time.monotonic() - self._last_commit >= self.commit_interval):
+            self._commit()
+
+    def _statistics_for(self, device_id: str) -> RunningStatistics:
+        """Statistiche del dispositivo: dallo stato salvato o ricostruite da test_data (con _write_lock)"""
+        statistics = self._statistics.get(device_id)
+        if statistics is not None:
+            return statistics
+
+        row = self._writer.execute('SELECT state FROM test_statistics WHERE device_id = ?', (device_id,)).fetchone()
+        state = json.loads(row[0]) if row else None
+        if state and state.get('version') == RunningStatistics.VERSION:
+            statistics = RunningStatistics(state)
+        else:
+            # Database precedente alle statistiche incrementali: una sola passata sui dati
+            statistics = RunningStatistics()
+            cursor = self._writer.execute(
+                f"SELECT {', '.join(RunningStatistics.COLUMNS)} FROM test_data WHERE device_id = ? ORDER BY ts_epoch",
+                (device_id,)
+            )
+            for values in cursor:
+                statistics.add(dict(zip(RunningStatistics.COLUMNS, values)))
+            if statistics.total_points:
+                logger.info(f"Statistiche ricostruite per {device_id}: {statistics.total_points} punti")
+            self._dirty_statistics.add(device_id)
+        self._statistics[device_id] = statistics
+        return statistics
+
+    def _statistics_row(self, device_id: str, ts_epoch: float) -> dict:
+        values = self._writer.execute(
+            f"SELECT {', '.join(RunningStatistics.COLUMNS)} FROM test_data WHERE device_id = ? AND ts_epoch = ?",
+            (device_id, ts_epoch)
+        ).fetchone()
+        return dict(zip(RunningStatistics.COLUMNS, values)) if values else None
+
+    def save_detector_state(self, states: dict, device_id: str = None):
+        """Stato dei rilevatori {nome: stato}, scritto al prossimo commit insieme ai punti dati"""
+        with self._write_lock:
+            self._detector_states[self._device(device_id)] = states
+
+    def load_detector_state(self, device_id: str = None) -> dict:
+        """Ultimo stato salvato dei rilevatori del dispositivo {nome: stato}"""
+        with self._write_lock:
+            rows = self._writer.execute('SELECT detector, state FROM detector_state WHERE device_id = ?',
+                                        (self._device(device_id),)).fetchall()
+        return {detector: json.loads(state) for detector, state in rows}
+
+    def log_event(self, event_type: str, message: str, severity: str = 'info', device_id: str = None,
+                  timestamp: str = None):
+        """Registra un evento in system_events (commit a gruppi come i punti dati)"""
+        with self._write_lock:
+            self._writer.execute(
+                'INSERT INTO system_events (timestamp, event_type, message, severity, device_id) VALUES (?, ?, ?, ?, ?)',
+                (timestamp or datetime.now().isoformat(), event_type, message, severity, self._device(device_id))
+            )
+            self._after_write(1)
+
+        self._start_flusher()
+
+    def add_calibration_points(self, points: list, source: str = 'manual', device_id: str = None):
+        """Salva punti di calibrazione [(pwm, pressione, portata), ...] (i manuali subito su disco)"""
+        device_id = self._device(device_id)
+        timestamp = datetime.now().isoformat()
+        ts_epoch = iso_to_epoch(timestamp)
+        with self._write_lock:
+            self._writer.executemany(
+                'INSERT INTO calibration_points (timestamp, ts_epoch, pwm, pressure, flow, source, device_id) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(timestamp, ts_epoch, pwm, pressure, flow, source, device_id) for pwm, pressure, flow in points]
+            )
+            if source == 'manual':
+                self._pending += len(points)
+                self._commit()
+            else:
+                self._after_write(len(points))
+
+        self._start_flusher()
+
+    def get_calibration_points(self, device_id: str = None) -> tuple:
+        """Tutti i punti di calibrazione del dispositivo come array (pwm, pressione, portata)"""
+        with self._reader() as conn:
+            rows = conn.execute(
+                'SELECT pwm, pressure, flow FROM calibration_points WHERE device_id = ? ORDER BY id',
+                (self._device(device_id),)
+            ).fetchall()
+        values = np.array([tuple(row) for row in rows], dtype=np.float64).reshape(-1, 3)
+        return values[:, 0], values[:, 1], values[:, 2]
+
+    def get_calibration_summary(self, pwm_bin: float = 5.0, device_id: str = None) -> list:
+        """Punti di calibrazione mediati per fasce di PWM (default 5%)"""
+        with self._reader() as conn:
+            rows = conn.execute('''
+                SELECT ROUND(pwm / ?) * ? AS pwm_bin, COUNT(*) AS count,
+                       AVG(pwm) AS pwm, AVG(pressure) AS pressure, AVG(flow) AS flow
+                FROM calibration_points
+                WHERE device_id = ?
+                GROUP BY pwm_bin
+                ORDER BY pwm_bin
+            ''', (pwm_bin, pwm_bin, self._device(device_id))).fetchall()
+        return [dict(row) for row in rows]
+
+    def clear_calibration_points(self, device_id: str = None) -> int:
+        """Elimina tutti i punti di calibrazione del dispositivo"""
+        with self._write_lock:
+            cursor = self._writer.execute('DELETE FROM calibration_points WHERE device_id = ?',
+                                          (self._device(device_id),))
+            self._commit()
+        return cursor.rowcount
+
+    @staticmethod
+    def _rollup_values(system_data: SystemData, metrics: CalculatedMetrics) -> dict:
+        return {
+            'pressure_measured': system_data.pressure_measured,
+            'flow_blynk': system_data.flow_blynk,
+            'flow_calculated': metrics.flow_calculated,
+            'obstruction_index': metrics.obstruction_index,
+            'filter_wear_percent': metrics.filter_wear_percent,
+        }
+
+    def _update_rollups(self, ts_epoch: float, values: dict, device_id: str, samples: int = 1):
+        """Aggiorna in modo incrementale i bucket di tutte le risoluzioni (nella stessa transazione)"""
+        if ts_epoch is None:
+            return
+
+        aggregates = []
+        for column in self.ROLLUP_COLUMNS:
+            value = values.get(column)
+            if is_missing(value):
+                aggregates.extend((None, None, None, 0))
+            else:
+                value = float(value)
+                aggregates.extend((value, value, value, 1))
+
+        self._writer.executemany(self._rollup_upsert_sql, [
+            (device_id, resolution, int(ts_epoch // resolution) * resolution, samples, *aggregates)
+            for resolution in self.ROLLUP_RESOLUTIONS
+        ])
+
+    def select_resolution(self, hours: float, target_points: int = 500, sampling_interval: float = None) -> int:
+        """Risoluzione più fine che resta entro target_points (0 = dati grezzi)"""
+        span = hours * 3600
+        if span / max(sampling_interval or SAMPLING_INTERVAL, 1) <= target_points:
+            return 0
+        for resolution in self.ROLLUP_RESOLUTIONS:
+            if span / resolution <= target_points:
+                return resolution
+        return self.ROLLUP_RESOLUTIONS[-1]
+
+    def get_rollup_data(self, resolution: int, hours: float, device_id: str = None) -> list:
+        """Bucket di una risoluzione nelle ultime ore, con min/media/max per colonna"""
+        return rollup_rows(self.get_rollup_columns(resolution, hours, device_id), resolution, self.ROLLUP_COLUMNS)
+
+    def get_rollup_columns(self, resolution: int, hours: float, device_id: str = None) -> dict:
+        """Bucket in ordine temporale come colonna -> lista: count, media (colonna), colonna_min, colonna_max"""
+        start_bucket = int((time.time() - hours * 3600) // resolution) * resolution
+        select = ', '.join(f'{column}_sum, {column}_count, {column}_min, {column}_max'
+                           for column in self.ROLLUP_COLUMNS)
+        with self._reader() as conn:
+            rows = conn.execute(f'''
+                SELECT bucket, count, {select} FROM test_data_rollup
+                WHERE device_id = ? AND resolution = ? AND bucket >= ?
+                ORDER BY bucket
+            ''', (self._device(device_id), resolution, start_bucket)).fetchall()
+
+        values = list(zip(*rows)) or [()] * (2 + 4 * len(self.ROLLUP_COLUMNS))
+        result = {
+            'timestamp': [datetime.fromtimestamp(bucket).isoformat() for bucket in values[0]],
+            'ts_epoch': list(values[0]),
+            'count': list(values[1])
+        }
+        for index, column in enumerate(self.ROLLUP_COLUMNS):
+            sums, counts, lows, highs = values[2 + 4 * index:6 + 4 * index]
+            result[column] = [total / valid if valid and total is not None else None
+                              for total, valid in zip(sums, counts)]
+            result[f'{column}_min'] = list(lows)
+            result[f'{column}_max'] = list(highs)
+        return result
+
+    def get_history(self, hours: float, target_points: int = 500, resolution=None, device_id: str = None,
+                    sampling_interval: float = None) -> tuple:
+        """Storico con risoluzione scelta da intervallo e numero punti desiderato"""
+        if resolution is None:
+            resolution = self.select_resolution(hours, target_points, sampling_interval)
+        if resolution == 0:
+            return 0, self.get_recent_data(hours, device_id=device_id)
+        return resolution, self.get_rollup_data(resolution, hours, device_id)
+
+    def get_recent_data(self, hours: int = 24, limit: int = 1000, device_id: str = None) -> list:
+        """Ottieni dati recenti per dashboard (range su (device_id, ts_epoch) indicizzato)"""
+        with self._reader() as conn:
+            rows = conn.execute('''
+                SELECT * FROM test_data
+                WHERE device_id = ? AND ts_epoch > ?
+                ORDER BY ts_epoch DESC
+                LIMIT ?
+            ''', (self._device(device_id), time.time() - hours * 3600, limit)).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def get_recent_columns(self, hours: float = 24, limit: int = 1000, device_id: str = None) -> dict:
+        """Ultimi campioni come colonna -> lista in ordine temporale (senza un dict per riga)"""
+        with self._reader() as conn:
+            cursor = conn.execute('''
+                SELECT * FROM test_data
+                WHERE device_id = ? AND ts_epoch > ?
+                ORDER BY ts_epoch DESC
+                LIMIT ?
+            ''', (self._device(device_id), time.time() - hours * 3600, limit))
+            names = [description[0] for description in cursor.description]
+            rows = cursor.fetchall()[::-1]
+        values = zip(*rows) if rows else [()] * len(names)
+        return {name: list(column) for name, column in zip(names, values) if name not in ('id', 'device_id')}
+
+    def get_columns(self, table: str = 'test_data') -> list:
+        """Nomi colonne di una tabella (per validare le selezioni dell'utente)"""
+        with self._reader() as conn:
+            return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+    def has_data(self, start_epoch: float = None, end_epoch: float = None, device_id: str = None) -> bool:
+        """True se esiste almeno una riga nell'intervallo"""
+        where, params = self._range_clause(start_epoch, end_epoch, device_id)
+        with self._reader() as conn:
+            return conn.execute(f'SELECT 1 FROM test_data {where} LIMIT 1', params).fetchone() is not None
+
+    def _range_clause(self, start_epoch: float = None, end_epoch: float = None, device_id: str = None) -> tuple:
+        """Clausola WHERE parametrizzata su device_id e ts_epoch"""
+        conditions, params = ['device_id = ?'], [self._device(device_id)]
+        if start_epoch is not None:
+            conditions.append('ts_epoch >= ?')
+            params.append(start_epoch)
+        if end_epoch is not None:
+            conditions.append('ts_epoch <= ?')
+            params.append(end_epoch)
+        return f"WHERE {' AND '.join(conditions)}", params
+
+    def iter_rows(self, start_epoch: float = None, end_epoch: float = None, columns: list = None,
+                  chunk_size: int = 1000, device_id: str = None):
+        """
+        Itera le righe (tuple) in ordine temporale a blocchi di chunk_size
+
+        Usa una connessione dedicata chiusa a fine iterazione, così un export
+        interrotto non lascia cursori aperti sulle connessioni dei thread.
+        """
+        columns = columns or self.get_columns()
+        where, params = self._range_clause(start_epoch, end_epoch, device_id)
+        select = ', '.join(columns)
 
-    def save_data_point(self, system_data: SystemData, metrics: CalculatedMetrics):
-        """Salva singolo punto dati"""
-        conn = sqlite3.connect(self.db_path)
-        conn.execute('''
-            INSERT INTO test_data 
-            (timestamp, pwm_percentage, pressure_measured, flow_blynk, flow_calculated,
-             temperature, pm_value, pressure_clean, obstruction_index, filter_wear_percent,
-             filter_efficiency, obstruction_trend, hours_since_change, filter_change_needed,
-             system_anomaly_detected, predicted_hours_remaining)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            system_data.timestamp, system_data.pwm_percentage, system_data.pressure_measured,
-            system_data.flow_blynk, metrics.flow_calculated, system_data.temperature,
-            system_data.pm_value, metrics.pressure_clean, metrics.obstruction_index,
-            metrics.filter_wear_percent, metrics.filter_efficiency, metrics.obstruction_trend,
-            metrics.hours_since_change, 1 if metrics.filter_change_needed else 0,
-            1 if metrics.system_anomaly_detected else 0, metrics.predicted_hours_remaining
-        ))
-        conn.commit()
-        conn.close()
-
-    def get_recent_data(self, hours: int = 24) -> list:
-        """Ottieni dati recenti per dashboard"""
         conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA query_only=1")
+            cursor = conn.execute(f'SELECT {select} FROM test_data {where} ORDER BY ts_epoch', params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def iter_column_chunks(self, start_epoch: float = None, end_epoch: float = None, columns: list = None,
+                           chunk_size: int = 10000, device_id: str = None):
+        """Itera blocchi di righe in ordine temporale come dict colonna -> np.ndarray (float64)"""
+        columns = [c for c in (columns or self.get_columns()) if c not in self.TEXT_COLUMNS]
+        chunk = []
+        for row in self.iter_rows(start_epoch, end_epoch, columns, chunk_size, device_id):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield self._rows_to_columns(chunk, columns)
+                chunk = []
+        if chunk:
+            yield self._rows_to_columns(chunk, columns)
+
+    @staticmethod
+    def _rows_to_columns(rows: list, columns: list) -> dict:
+        block = np.array(rows, dtype=np.float64).reshape(len(rows), len(columns))
+        return {column: block[:, index] for index, column in enumerate(columns)}
+
+    # Tipi colonne export binario: default float32, flag come bool
+    NPZ_DTYPES = {
+        'id': np.int64,
+        'ts_epoch': np.float64,  # float32 avrebbe risoluzione di ~2 minuti su epoch Unix
+        'filter_change_needed': np.bool_,
+        'system_anomaly_detected': np.bool_,
+    }
 
-        cursor = conn.execute('''
-            SELECT * FROM test_data 
-            WHERE datetime(timestamp) > datetime('now', '-{} hours')
-            ORDER BY timestamp DESC
-            LIMIT 1000
-        '''.format(hours))
+    def export_npz(self, output, start_epoch: float = None, end_epoch: float = None, columns: list = None,
+                   chunk_size: int = 10000, compress: bool = False, device_id: str = None) -> int:
+        """
+        Esporta test_data in formato NumPy .npz colonnare (un array tipizzato per colonna)
 
-        data = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return data
+        Le colonne vengono riempite a blocchi in file .npy mappati su disco accanto al
+        database, quindi la memoria resta limitata a chunk_size righe. Il timestamp
+        testuale è escluso (ts_epoch lo rappresenta in float64), così come device_id.
+
+        Returns:
+            Numero di righe esportate
+        """
+        columns = [c for c in (columns or self.get_columns()) if c not in self.TEXT_COLUMNS]
+        where, params = self._range_clause(start_epoch, end_epoch, device_id)
+        select = ', '.join(columns)
 
-    def get_statistics(self) -> dict:
-        """Statistiche generali"""
         conn = sqlite3.connect(self.db_path)
-        cursor = conn.execute('''
-            SELECT 
-                COUNT(*) as total_points,
-                MAX(filter_wear_percent) as max_wear,
-                MAX(obstruction_index) as max_obstruction,
-                SUM(filter_change_needed) as change_alerts,
-                SUM(system_anomaly_detected) as anomalies,
-                MIN(timestamp) as start_time,
-                MAX(timestamp) as end_time
-            FROM test_data
-        ''')
-
-        stats = dict(cursor.fetchone())
-        conn.close()
-        return stats
-
-
-# Istanze globali con client corretto
-blynk_client = BlynkDirectClient(BLYNK_URLS)
-algorithm = PredictiveAlgorithm()
-database = TestDatabase()
+        try:
+            # Conteggio e lettura nello stesso snapshot WAL
+            conn.execute('BEGIN')
+            total = conn.execute(f'SELECT COUNT(*) FROM test_data {where}', params).fetchone()[0]
+
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(self.db_path) or '.') as tmp_dir:
+                arrays = {
+                    column: np.lib.format.open_memmap(
+                        os.path.join(tmp_dir, f'{column}.npy'), mode='w+',
+                        dtype=self.NPZ_DTYPES.get(column, np.float32), shape=(total,)
+                    )
+                    for column in columns
+                }
+
+                cursor = conn.execute(f'SELECT {select} FROM test_data {where} ORDER BY ts_epoch', params)
+                offset = 0
+                while offset < total:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    # None -> NaN; i flag NULL diventano False
+                    block = np.array(rows, dtype=np.float64).reshape(len(rows), len(columns))
+                    for index, column in enumerate(columns):
+                        values = block[:, index]
+                        if arrays[column].dtype == np.bool_:
+                            values = values > 0
+                        arrays[column][offset:offset + len(rows)] = values
+                    offset += len(rows)
+
+                for array in arrays.values():
+                    array.flush()
+                del arrays
+
+                compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+                with zipfile.ZipFile(output, 'w', compression=compression, allowZip64=True) as archive:
+                    for column in columns:
+                        archive.write(os.path.join(tmp_dir, f'{column}.npy'), arcname=f'{column}.npy')
+        finally:
+            conn.close()
+
+        logger.info(f"Export npz: {total} righe, {len(columns)} colonne")
+        return total
+
+    def get_statistics(self, device_id: str = None) -> dict:
+        """Statistiche generali (aggregati incrementali, costo costante)"""
+        with self._write_lock:
+            return self._statistics_for(self._device(device_id)).as_dict()
+
+
+class LatestSample:
+    """Ultimo campione SystemData/CalculatedMetrics condiviso thread-safe tra campionatore e API"""
+
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._sample = None
+        self._published_at = 0.0
+
+    def publish(self, system_data: SystemData, metrics: CalculatedMetrics,
+                pin_timestamps: dict = None, source: str = 'sampler') -> dict:
+        """Pubblica un nuovo campione (convertito in valori JSON una sola volta)"""
+        flow_blynk, flow_calculated = system_data.flow_blynk, metrics.flow_calculated
+        difference = abs(flow_blynk - flow_calculated)
+        sample = {
+            'system_data': system_data,
+            'metrics': metrics,
+            'system_dict': record_dict(system_data),
+            'metrics_dict': record_dict(metrics),
+            'flow_comparison': {
+                'flow_from_blynk': json_scalar(flow_blynk),
+                'flow_calculated': json_scalar(flow_calculated),
+                'difference': json_scalar(difference),
+                'difference_percent': json_scalar(difference / max(flow_blynk, 0.1) * 100 if flow_blynk > 0.1 else 0)
+            },
+            'pin_timestamps': dict(pin_timestamps or {}),
+            'source': source
+        }
+        with self._lock:
+            self._sample = sample
+            self._published_at = time.monotonic()
+        return sample
+
+    def get(self, max_age: float = None):
+        """Ultimo campione se più recente di max_age, altrimenti None"""
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            sample, published_at = self._sample, self._published_at
+        if sample is None or time.monotonic() - published_at > max_age:
+            return None
+        return sample
+
+    def age(self) -> float:
+        """Secondi dall'ultima pubblicazione (None se mai pubblicato)"""
+        with self._lock:
+            if self._sample is None:
+                return None
+            return time.monotonic() - self._published_at
+
+
+class SampleRing:
+    """
+    Ultimi campioni in memoria a capacità fissa: un array NumPy preallocato per colonna
+
+    Un solo scrittore (il ciclo di campionamento del dispositivo) e letture senza
+    lock: il lettore copia la finestra e poi scarta le posizioni che lo scrittore
+    può aver sovrascritto nel frattempo (confronto del contatore prima/dopo).
+    """
+
+    COLUMNS = ('ts_epoch',) + tuple(PIN_COLUMNS.values()) + tuple(CalculatedMetrics.__dataclass_fields__)
+    FLAG_COLUMNS = ('filter_change_needed', 'system_anomaly_detected')
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, int(capacity))
+        self._data = {column: np.full(self.capacity, np.nan) for column in self.COLUMNS}
+        self._written = 0
+        # Epoch da cui il buffer contiene tutti i campioni del dispositivo (inf = nessuna garanzia)
+        self.complete_since = math.inf
+
+    @property
+    def nbytes(self) -> int:
+        return sum(values.nbytes for values in self._data.values())
+
+    def __len__(self) -> int:
+        return min(self._written, self.capacity)
+
+    def append(self, ts_epoch: float, system_data: SystemData, metrics: CalculatedMetrics):
+        """Aggiunge un campione (solo dal thread di campionamento del dispositivo)"""
+        position = self._written % self.capacity
+        data = self._data
+        data['ts_epoch'][position] = ts_epoch
+        for column in PIN_COLUMNS.values():
+            data[column][position] = getattr(system_data, column)
+        for column in CalculatedMetrics.__dataclass_fields__:
+            data[column][position] = getattr(metrics, column)
+        # Pubblicazione: il campione è visibile ai lettori solo dopo l'incremento
+        self._written += 1
+
+    def extend(self, columns: dict):
+        """Aggiunge blocchi colonna -> array in ordine temporale (precaricamento da SQLite)"""
+        count = len(columns['ts_epoch'])
+        if count > self.capacity:
+            columns = {column: values[-self.capacity:] for column, values in columns.items()}
+            self._written += count - self.capacity
+            count = self.capacity
+        start = self._written % self.capacity
+        head = min(count, self.capacity - start)
+        for column in self.COLUMNS:
+            values = columns.get(column)
+            if values is None:
+                values = np.full(count, np.nan)
+            self._data[column][start:start + head] = values[:head]
+            self._data[column][:count - head] = values[head:]
+        self._written += count
+
+    def amend(self, ts_epoch: float, values: dict) -> bool:
+        """Completa i valori di un campione già nel buffer (recupero storico)"""
+        lo, n = max(0, self._written - self.capacity), self._written
+        index = self._search(lo, n, ts_epoch, 'left')
+        if index >= n:
+            return False
+        position = index % self.capacity
+        if self._data['ts_epoch'][position] != ts_epoch:
+            return False
+        for column, value in values.items():
+            if column in self._data:
+                self._data[column][position] = np.nan if value is None else float(value)
+        return True
+
+    def covers(self, start_epoch: float) -> bool:
+        """True se tutti i campioni da start_epoch in poi sono nel buffer"""
+        if start_epoch < self.complete_since:
+            return False
+        if self._written > self.capacity:
+            # Buffer pieno: i campioni più vecchi del primo conservato sono stati scartati
+            oldest = self._data['ts_epoch'][self._written % self.capacity]
+            return start_epoch >= oldest
+        return True
+
+    def _search(self, lo: int, n: int, value: float, side: str) -> int:
+        """Indice logico (lo..n) di value nei timestamp, cercando sui due segmenti ordinati"""
+        ts = self._data['ts_epoch']
+        count = n - lo
+        start = lo % self.capacity
+        first = ts[start:min(self.capacity, start + count)]
+        index = int(np.searchsorted(first, value, side))
+        if index == len(first):
+            index += int(np.searchsorted(ts[:count - len(first)], value, side))
+        return lo + index
+
+    def _take(self, column: str, a: int, b: int) -> np.ndarray:
+        """Copia delle posizioni logiche a..b di una colonna"""
+        values = self._data[column]
+        start, count = a % self.capacity, b - a
+        if start + count <= self.capacity:
+            return values[start:start + count].copy()
+        return np.concatenate((values[start:], values[:start + count - self.capacity]))
+
+    def window(self, start_epoch: float = None, end_epoch: float = None, columns: list = None,
+               limit: int = None) -> dict:
+        """Campioni con start_epoch < ts_epoch <= end_epoch come colonna -> array (ordine temporale)"""
+        columns = ['ts_epoch'] + [c for c in (columns or self.COLUMNS) if c != 'ts_epoch']
+        n = self._written
+        lo = max(0, n - self.capacity)
+        a = self._search(lo, n, start_epoch, 'right') if start_epoch is not None else lo
+        b = self._search(lo, n, end_epoch, 'right') if end_epoch is not None else n
+        if limit is not None:
+            a = max(a, b - limit)
+        result = {column: self._take(column, a, b) for column in columns}
+
+        # Posizioni riscritte durante la copia: scartate
+        unsafe = self._written - self.capacity + 1 - a
+        if unsafe > 0:
+            result = {column: values[unsafe:] for column, values in result.items()}
+        return result
+
+    def columns(self, start_epoch: float = None, limit: int = None) -> dict:
+        """Ultimi campioni come colonna -> lista JSON in ordine temporale (NaN -> None, flag 0/1 come SQLite)"""
+        window = self.window(start_epoch, limit=limit)
+        columns = {'timestamp': [datetime.fromtimestamp(ts).isoformat() for ts in window['ts_epoch'].tolist()]}
+        for column, values in window.items():
+            if column in self.FLAG_COLUMNS:
+                missing = np.isnan(values)
+                values = np.where(missing, 0, values).astype(np.int64)
+                columns[column] = np.where(missing, None, values).tolist() if missing.any() else values.tolist()
+            else:
+                columns[column] = column_list(values)
+        return columns
+
+    def rows(self, start_epoch: float = None, limit: int = None, device_id: str = None) -> list:
+        """Campioni come dict (stesso formato di TestDatabase.get_recent_data, più recenti per primi)"""
+        columns = self.columns(start_epoch, limit)
+        columns['device_id'] = [device_id] * len(columns['ts_epoch'])
+        names = list(columns)
+        return [dict(zip(names, row)) for row in zip(*columns.values())][::-1]
+
+    def aggregate_columns(self, resolution: int, start_epoch: float, columns: tuple) -> dict:
+        """Bucket in ordine temporale come colonna -> lista: count, media (colonna), colonna_min, colonna_max"""
+        window = self.window(start_epoch // resolution * resolution - 1e-6, columns=list(columns))
+        ts = window['ts_epoch']
+        if not len(ts):
+            result = {'timestamp': [], 'ts_epoch': [], 'count': []}
+            for column in columns:
+                result.update({column: [], f'{column}_min': [], f'{column}_max': []})
+            return result
+        buckets = (ts // resolution).astype(np.int64) * resolution
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        bucket_starts = buckets[starts].tolist()
+
+        result = {
+            'timestamp': [datetime.fromtimestamp(bucket).isoformat() for bucket in bucket_starts],
+            'ts_epoch': bucket_starts,
+            'count': np.diff(np.append(starts, len(ts))).tolist()
+        }
+        for column in columns:
+            values = window[column]
+            valid = ~np.isnan(values)
+            valid_counts = np.add.reduceat(valid.astype(np.int64), starts)
+            sums = np.add.reduceat(np.where(valid, values, 0.0), starts)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[column] = column_list(sums / valid_counts)
+            result[f'{column}_min'] = column_list(np.fmin.reduceat(values, starts))
+            result[f'{column}_max'] = column_list(np.fmax.reduceat(values, starts))
+        return result
+
+    def aggregate(self, resolution: int, start_epoch: float, columns: tuple) -> list:
+        """Bucket min/media/max per colonna (stesso formato di TestDatabase.get_rollup_data)"""
+        return rollup_rows(self.aggregate_columns(resolution, start_epoch, columns), resolution, columns)
+
+
+def rollup_rows(buckets: dict, resolution: int, columns: tuple) -> list:
+    """Rollup colonnari (ordine temporale) -> righe dict più recenti per prime, con colonna_mean"""
+    data = []
+    for index in range(len(buckets['ts_epoch']) - 1, -1, -1):
+        point = {
+            'timestamp': buckets['timestamp'][index],
+            'ts_epoch': buckets['ts_epoch'][index],
+            'resolution': resolution,
+            'count': buckets['count'][index]
+        }
+        for column in columns:
+            mean = buckets[column][index]
+            point[column] = mean
+            point[f'{column}_min'] = buckets[f'{column}_min'][index]
+            point[f'{column}_mean'] = mean
+            point[f'{column}_max'] = buckets[f'{column}_max'][index]
+        data.append(point)
+    return data
+
+
+class SampleBroadcaster:
+    """Distribuisce i nuovi campioni ai client SSE, una coda limitata per client"""
+
+    def __init__(self, queue_size: int = 10):
+        self.queue_size = max(1, queue_size)
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self.dropped = 0
+
+    def subscribe(self) -> queue.Queue:
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        logger.info(f"Client stream connesso ({self.subscriber_count()} attivi)")
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+        logger.info(f"Client stream disconnesso ({self.subscriber_count()} attivi)")
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, message: str):
+        """Accoda il messaggio a tutti i client senza mai bloccare il campionatore"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.put_nowait(message)
+                    break
+                except queue.Full:
+                    # Client lento: scarta il campione più vecchio
+                    try:
+                        subscriber.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
 
-# Flask app
-app = Flask(__name__)
 
-# Variabili stato globali
-test_running = False
-test_stats = {"start_time": None, "data_points": 0, "last_update": None}
+class ScheduleStats:
+    """Puntualità del campionamento: ritardo di avvio sullo slot (jitter), durata cicli, overrun, slot saltati"""
 
+    def __init__(self):
+        self.cycles = 0
+        self.overruns = 0
+        self.missed_slots = 0
+        self.jitter_last = self.jitter_max = self.jitter_total = 0.0
+        self.duration_last = self.duration_max = self.duration_total = 0.0
+
+    def record(self, jitter: float, duration: float, interval: float, missed: int):
+        """Registra un ciclo (chiamato solo dal ciclo del dispositivo, mai in parallelo)"""
+        self.cycles += 1
+        self.jitter_last = jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+        self.jitter_total += jitter
+        self.duration_last = duration
+        self.duration_max = max(self.duration_max, duration)
+        self.duration_total += duration
+        if duration > interval:
+            self.overruns += 1
+        self.missed_slots += missed
+
+    def as_dict(self) -> dict:
+        cycles = max(self.cycles, 1)
+        return {
+            'cycles': self.cycles,
+            'overruns': self.overruns,
+            'missed_slots': self.missed_slots,
+            'jitter_last': self.jitter_last,
+            'jitter_mean': self.jitter_total / cycles,
+            'jitter_max': self.jitter_max,
+            'duration_last': self.duration_last,
+            'duration_mean': self.duration_total / cycles,
+            'duration_max': self.duration_max
+        }
 
-def data_collection_loop():
-    """Loop principale raccolta dati"""
-    global test_running, test_stats
 
-    logger.info("Avvio raccolta dati...")
-    test_running = True
-    test_stats["start_time"] = datetime.now().isoformat()
+class Device:
+    """Unità monitorata: client Blynk, stato algoritmo, calibrazione e ultimo campione propri"""
+
+    def __init__(self, device_id: str, blynk_client: BlynkDirectClient, database: TestDatabase,
+                 sampling_interval: float = SAMPLING_INTERVAL, params: dict = None,
+                 use_empirical_curves: bool = False, phase: float = 0.0, detectors: AnomalyDetectors = None,
+                 replica: bool = False):
+        self.device_id = device_id
+        self.blynk_client = blynk_client
+        self.database = database
+        self.sampling_interval = sampling_interval
+        # Slot di campionamento: epoch = phase + k * sampling_interval
+        self.phase = phase % sampling_interval if sampling_interval > 0 else 0.0
+
+        self.algorithm = PredictiveAlgorithm()
+        if params:
+            self.algorithm.configure(**params)
+
+        # Calibrazione empirica costruita dai punti salvati, poi aggiornata in modo incrementale
+        self.calibration = EmpiricalCalibration(CALIBRATION_MAX_PRESSURE, CALIBRATION_PRESSURE_STEP)
+        self.algorithm.calibration = self.calibration
+        self.algorithm.USE_EMPIRICAL_CURVES = use_empirical_curves
+
+        # Replica in un worker API: legge lo storico da SQLite, lo stato live resta nel campionatore
+        self.replica = replica
+        self.detectors = detectors if detectors is not None else AnomalyDetectors()
+        if not replica:
+            self.calibration.fit(*database.get_calibration_points(device_id))
+            # Rilevatori anomalie in streaming, ripresi dallo stato salvato
+            self.detectors.load(database.load_detector_state(device_id))
+
+        self.latest_sample = LatestSample(max(SNAPSHOT_MAX_AGE, sampling_interval * 2))
+        # Ultime RING_BUFFER_HOURS in memoria (più un bucket rollup orario), precaricate da SQLite;
+        # una replica non riceve campioni: buffer minimo che non copre mai l'intervallo richiesto
+        span = RING_BUFFER_HOURS * 3600 + max(TestDatabase.ROLLUP_RESOLUTIONS)
+        self.ring = SampleRing(1 if replica else math.ceil(span / sampling_interval))
+        if not replica:
+            horizon = time.time() - span
+            for chunk in database.iter_column_chunks(horizon, None, list(SampleRing.COLUMNS), device_id=device_id):
+                self.ring.extend(chunk)
+            self.ring.complete_since = horizon
+        self.broadcaster = SampleBroadcaster(STREAM_QUEUE_SIZE)
+        self.live_fetch_lock = threading.Lock()
+        # Un ciclo alla volta per dispositivo: lo stato dell'algoritmo non è thread-safe
+        self.sample_lock = threading.Lock()
+
+        self.running = False
+        self.generation = 0
+        self.stats = {"start_time": None, "data_points": 0, "last_update": None, "errors": 0,
+                      "missing_samples": 0, "backfilled": 0}
+        self.schedule_stats = ScheduleStats()
+        # Istante (monotonic) dell'ultimo campione: le ore filtro si integrano sul tempo misurato
+        self._last_sample_at = None
+
+        # Interruzione in corso (epoch del primo campione senza dati) e campioni incompleti da recuperare
+        self._outage_since = None
+        self._outage_samples = 0
+        self._gaps = deque(maxlen=BACKFILL_MAX_SLOTS)
+
+    def next_slot(self, after: float) -> float:
+        """Primo slot (epoch) non precedente ad after"""
+        return self.phase + math.ceil((after - self.phase) / self.sampling_interval) * self.sampling_interval
+
+    def read_system_data(self, timestamp: str = None) -> tuple:
+        """Legge tutti i pin in un solo round-trip e costruisce SystemData (timestamp = slot se indicato)"""
+        snapshot = self.blynk_client.get_pins_snapshot(SAMPLING_PINS)
+        blynk_data = snapshot.values
+
+        # Pin non letti restano NaN: salvati come NULL, mai come misure a zero
+        system_data = SystemData(
+            timestamp=timestamp or snapshot.timestamp,
+            **{column: float(blynk_data.get(pin, math.nan)) for pin, column in PIN_COLUMNS.items()}
+        )
+        return system_data, snapshot
 
-    while test_running:
-        try:
-            # Ottieni dati da Blynk con nuovo client
-            blynk_data = blynk_client.get_multiple_pins(['pressure', 'flow', 'pwm', 'temperature', 'pm_value'])
-
-            # Crea oggetto dati sistema
-            system_data = SystemData(
-                timestamp=datetime.now().isoformat(),
-                pwm_percentage=blynk_data.get('pwm', 0),
-                pressure_measured=blynk_data.get('pressure', 0),
-                flow_blynk=blynk_data.get('flow', 0),
-                temperature=blynk_data.get('temperature', 20),
-                pm_value=blynk_data.get('pm_value', 0)
-            )
+    def sample(self, slot: float = None) -> dict:
+        """Un ciclo di raccolta: lettura, metriche, pubblicazione e salvataggio"""
+        with self.sample_lock:
+            # Ottieni dati da Blynk in un solo round-trip; timestamp allineato allo slot per il dataset ML
+            timestamp = datetime.fromtimestamp(slot).isoformat() if slot is not None else None
+            system_data, snapshot = self.read_system_data(timestamp)
+            ts_epoch = iso_to_epoch(system_data.timestamp)
+
+            self._track_outage(snapshot, ts_epoch)
+            if self._gaps and len(snapshot.missing) < len(SAMPLING_PINS):
+                # Connettività tornata: recupera i campioni incompleti prima del nuovo (stato in ordine)
+                self._backfill(snapshot.missing)
 
             # Calcola metriche
-            metrics = algorithm.calculate_metrics(system_data)
+            with CALCULATE_METRICS_SECONDS.time(self.device_id):
+                metrics = self.algorithm.calculate_metrics(system_data)
+            anomalies = self._detect_anomalies(system_data, metrics)
+
+            # Pubblica ultimo campione per /api/current e storico recente in memoria
+            sample = self.latest_sample.publish(system_data, metrics, snapshot.timestamps)
+            self.ring.append(ts_epoch, system_data, metrics)
 
             # Salva in database
-            database.save_data_point(system_data, metrics)
+            with DB_SAVE_SECONDS.time(self.device_id):
+                self.database.save_data_point(system_data, metrics, self.device_id)
+            if snapshot.missing:
+                self.stats["missing_samples"] += 1
+                if self.blynk_client.history_url:
+                    self._gaps.append((ts_epoch, system_data, set(snapshot.missing),
+                                       self.algorithm.hours_since_change))
+
+            # Punto di calibrazione automatico dal sensore di portata
+            point = (system_data.pwm_percentage, system_data.pressure_measured, system_data.flow_blynk)
+            if CALIBRATION_AUTO_COLLECT and not any(map(is_missing, point)) and system_data.flow_blynk > 0.1:
+                self.database.add_calibration_points([point], source='auto', device_id=self.device_id)
+                self.calibration.add_points(*point)
+
+            # Aggiorna statistiche; ore filtro dal tempo realmente trascorso dal campione precedente
+            self.stats["data_points"] += 1
+            self.stats["last_update"] = datetime.now().isoformat()
+            now = time.monotonic()
+            if self._last_sample_at is not None:
+                self.algorithm.hours_since_change += (now - self._last_sample_at) / 3600
+            self._last_sample_at = now
+
+        # Push ai client /api/stream
+        if self.broadcaster.subscriber_count():
+            self.broadcaster.publish(dumps_json(build_current_payload(sample, self)))
+
+        self._log_sample(system_data, metrics, snapshot.missing)
+        for name, transition, message in anomalies:
+            if transition == 'raised':
+                logger.warning(f"[{self.device_id}] ANOMALY {name}: {message}")
+            else:
+                logger.info(f"[{self.device_id}] {message}")
+        return sample
+
+    def _detect_anomalies(self, system_data: SystemData, metrics: CalculatedMetrics) -> list:
+        """Aggiorna i rilevatori in streaming e registra in system_events solo le transizioni"""
+        if not self.detectors:
+            return []
+        transitions = self.detectors.update(system_data, metrics)
+        for name, transition, message in transitions:
+            self.database.log_event(f'anomaly_{name}', message, 'warning' if transition == 'raised' else 'info',
+                                    self.device_id, timestamp=system_data.timestamp)
+        self.database.save_detector_state(self.detectors.state(), self.device_id)
+        return transitions
+
+    def _track_outage(self, snapshot: PinSnapshot, ts_epoch: float):
+        """Registra in system_events inizio e fine delle interruzioni (nessun pin letto)"""
+        if len(snapshot.missing) == len(SAMPLING_PINS):
+            if self._outage_since is None:
+                self._outage_since = ts_epoch
+                self._outage_samples = 0
+                message = "Blynk non raggiungibile: campioni salvati come mancanti"
+                logger.warning(f"[{self.device_id}] {message}")
+                self.database.log_event('blynk_outage', message, 'warning', self.device_id)
+            self._outage_samples += 1
+        elif self._outage_since is not None:
+            message = (f"Connessione Blynk ripristinata dopo {ts_epoch - self._outage_since:.0f}s "
+                       f"({self._outage_samples} campioni mancanti)")
+            logger.info(f"[{self.device_id}] {message}")
+            self.database.log_event('blynk_restored', message, 'info', self.device_id)
+            self._outage_since = None
+
+    def _backfill(self, still_missing: list):
+        """
+        Completa i campioni incompleti con lo storico del server, in un'unica richiesta per pin
 
-            # Aggiorna statistiche
-            test_stats["data_points"] += 1
-            test_stats["last_update"] = datetime.now().isoformat()
-            algorithm.hours_since_change += SAMPLING_INTERVAL / 3600
+        I pin ancora non leggibili ora non sono recuperabili e vengono tralasciati.
+        Se mancavano PWM o pressione le metriche vengono ricalcolate in ordine
+        cronologico (lo storico ostruzione non era stato aggiornato).
+        """
+        gaps = [(ts, data, missing - set(still_missing), hours) for ts, data, missing, hours in self._gaps]
+        gaps = [gap for gap in gaps if gap[2]]
+        self._gaps.clear()
+        if not gaps:
+            return
+
+        tolerance = self.sampling_interval / 2
+        pins = sorted(set().union(*(missing for _, _, missing, _ in gaps)))
+        history = self.blynk_client.get_pin_history(pins, gaps[0][0] - tolerance, gaps[-1][0] + tolerance)
+        series = {pin: np.array(points, dtype=np.float64).reshape(-1, 2) for pin, points in history.items()}
+
+        filled = 0
+        hours_now = self.algorithm.hours_since_change
+        try:
+            for ts_epoch, system_data, missing, hours in gaps:
+                values = {}
+                for pin in missing:
+                    points = series.get(pin)
+                    if points is None or not len(points):
+                        continue
+                    nearest = int(np.argmin(np.abs(points[:, 0] - ts_epoch)))
+                    if abs(points[nearest, 0] - ts_epoch) <= tolerance:
+                        values[PIN_COLUMNS[pin]] = float(points[nearest, 1])
+                if not values:
+                    continue
+
+                if missing & {'pwm', 'pressure'}:
+                    # Metriche mancanti: ricalcolate con le ore filtro dell'istante del campione
+                    self.algorithm.hours_since_change = hours
+                    amended = replace(system_data, **values)
+                    if not (is_missing(amended.pwm_percentage) or is_missing(amended.pressure_measured)):
+                        values.update(asdict(self.algorithm.calculate_metrics(amended)))
+                if self.database.amend_data_point(ts_epoch, values, self.device_id):
+                    self.ring.amend(ts_epoch, values)
+                    filled += 1
+        finally:
+            self.algorithm.hours_since_change = hours_now
+
+        self.stats["backfilled"] += filled
+        message = f"Recupero storico: {filled}/{len(gaps)} campioni completati ({', '.join(pins)})"
+        logger.info(f"[{self.device_id}] {message}")
+        self.database.log_event('backfill', message, 'info' if filled else 'warning', self.device_id)
+
+    def _log_sample(self, system_data: SystemData, metrics: CalculatedMetrics, missing: list = None):
+        """Log eventi importanti e, in debug, confronto portate"""
+        if is_missing(metrics.obstruction_index):
+            if DEBUG_MODE:
+                logger.info(f"[{self.device_id}] Campione senza metriche, pin mancanti: {', '.join(missing or [])}")
+            return
+
+        if metrics.filter_change_needed:
+            logger.warning(f"[{self.device_id}] ALERT: Cambio filtro necessario - "
+                           f"Usura: {metrics.filter_wear_percent:.1f}%")
+
+        if metrics.system_anomaly_detected:
+            logger.error(f"[{self.device_id}] ANOMALY: Anomalia sistema - Ostruzione: {metrics.obstruction_index:.2f}")
+
+        if DEBUG_MODE:
+            algorithm = self.algorithm
+            real_speed = algorithm.convert_blynk_pwm_to_real_speed(system_data.pwm_percentage)
+            physical_pwm = ((algorithm.map_value(system_data.pwm_percentage, 1, 100, 64,
+                                                 153) / 255.0) * 100) if system_data.pwm_percentage > 0 else 0
+
+            # CONFRONTO CHIARO tra i due flow
+            flow_diff = abs(metrics.flow_calculated - system_data.flow_blynk)
+            flow_diff_pct = (
+                        flow_diff / max(system_data.flow_blynk, 0.1) * 100) if system_data.flow_blynk > 0.1 else 0
+
+            logger.info(f"[{self.device_id}] "
+                        f"PWM_Blynk: {system_data.pwm_percentage:.0f}% | "
+                        f"PWM_Physical: {physical_pwm:.1f}% | "
+                        f"Curve_Scale: {real_speed:.1f}% | "
+                        f"P: {system_data.pressure_measured:.1f}Pa | "
+                        f"Q_calc: {metrics.flow_calculated:.0f}m³/h | "
+                        f"Q_blynk: {system_data.flow_blynk:.0f}m³/h | "
+                        f"ΔQ: {flow_diff:.0f}m³/h ({flow_diff_pct:.1f}%) | "
+                        f"Wear: {metrics.filter_wear_percent:.1f}%")
+
+    def load_columns(self, start_epoch: float, end_epoch: float = None, columns: list = None) -> tuple:
+        """(colonna -> array in ordine temporale, sorgente): dal buffer se copre l'inizio, altrimenti SQLite a blocchi"""
+        columns = ['ts_epoch'] + [c for c in (columns or SampleRing.COLUMNS) if c != 'ts_epoch']
+        if start_epoch is not None and self.ring.covers(start_epoch):
+            return self.ring.window(start_epoch, end_epoch, columns), 'memory'
+        parts = {column: [] for column in columns}
+        for chunk in self.database.iter_column_chunks(start_epoch, end_epoch, columns, device_id=self.device_id):
+            for column in columns:
+                parts[column].append(chunk[column])
+        return {column: np.concatenate(values) if values else np.empty(0) for column, values in parts.items()}, 'sqlite'
+
+    def get_history(self, hours: float, target_points: int = 500, resolution=None, limit: int = 1000,
+                    columnar: bool = False) -> tuple:
+        """
+        (risoluzione, dati, sorgente) dello storico: buffer in memoria se copre l'intervallo
 
-            # Log eventi importanti
-            if metrics.filter_change_needed:
-                logger.warning(f"ALERT: Cambio filtro necessario - Usura: {metrics.filter_wear_percent:.1f}%")
+        Dati come righe dict (più recenti per prime) o, con columnar=True, come
+        colonna -> lista in ordine temporale.
+        """
+        if resolution is None:
+            resolution = self.database.select_resolution(hours, target_points, self.sampling_interval)
+        start = time.time() - hours * 3600
+        if resolution == 0:
+            if self.ring.covers(start):
+                if columnar:
+                    return 0, self.ring.columns(start, limit), 'memory'
+                return 0, self.ring.rows(start, limit, self.device_id), 'memory'
+            if columnar:
+                return 0, self.database.get_recent_columns(hours, limit, self.device_id), 'sqlite'
+            return 0, self.database.get_recent_data(hours, limit, self.device_id), 'sqlite'
+        if self.ring.covers(start // resolution * resolution):
+            if columnar:
+                return resolution, self.ring.aggregate_columns(resolution, start, TestDatabase.ROLLUP_COLUMNS), 'memory'
+            return resolution, self.ring.aggregate(resolution, start, TestDatabase.ROLLUP_COLUMNS), 'memory'
+        if columnar:
+            return resolution, self.database.get_rollup_columns(resolution, hours, self.device_id), 'sqlite'
+        return resolution, self.database.get_rollup_data(resolution, hours, self.device_id), 'sqlite'
+
+    def reset_filter(self):
+        """Azzera timer e storico ostruzione dopo il cambio filtro"""
+        with self.sample_lock:
+            self.algorithm.hours_since_change = 0
+            self.algorithm.obstruction_history = [1.0] * 10
+            # Nuovo filtro: baseline dei rilevatori da ricostruire
+            self.detectors.reset()
+            self.database.save_detector_state(self.detectors.state(), self.device_id)
+        self.database.flush()
+        logger.info(f"[{self.device_id}] Timer filtro resettato")
+
+    def status(self) -> dict:
+        """Riepilogo stato per /api/devices"""
+        return {
+            'device_id': self.device_id,
+            'status': 'running' if self.running else 'stopped',
+            'sampling_interval': self.sampling_interval,
+            'sample_age': self.latest_sample.age(),
+            'hours_since_change': self.algorithm.hours_since_change,
+            'calibration_points': self.calibration.points,
+            'empirical_curves': self.algorithm.empirical_active(),
+            'stream_clients': self.broadcaster.subscriber_count(),
+            'test_stats': dict(self.stats),
+            'schedule': self.schedule_stats.as_dict(),
+            'ring': {'samples': len(self.ring), 'capacity': self.ring.capacity, 'bytes': self.ring.nbytes},
+            'detectors': self.detectors.status(),
+            'blynk': {
+                'outage_since': self._outage_since,
+                'pending_backfill': len(self._gaps),
+                'breakers': self.blynk_client.breaker_status()
+            }
+        }
 
-            if metrics.system_anomaly_detected:
-                logger.error(f"ANOMALY: Anomalia sistema - Ostruzione: {metrics.obstruction_index:.2f}")
 
-            if DEBUG_MODE:
-                real_speed = algorithm.convert_blynk_pwm_to_real_speed(system_data.pwm_percentage)
-                physical_pwm = ((algorithm.map_value(system_data.pwm_percentage, 1, 100, 64,
-                                                     153) / 255.0) * 100) if system_data.pwm_percentage > 0 else 0
-
-                # CONFRONTO CHIARO tra i due flow
-                flow_diff = abs(metrics.flow_calculated - system_data.flow_blynk)
-                flow_diff_pct = (
-                            flow_diff / max(system_data.flow_blynk, 0.1) * 100) if system_data.flow_blynk > 0.1 else 0
-
-                logger.info(f"PWM_Blynk: {system_data.pwm_percentage:.0f}% | "
-                            f"PWM_Physical: {physical_pwm:.1f}% | "
-                            f"Curve_Scale: {real_speed:.1f}% | "
-                            f"P: {system_data.pressure_measured:.1f}Pa | "
-                            f"Q_calc: {metrics.flow_calculated:.0f}m³/h | "
-                            f"Q_blynk: {system_data.flow_blynk:.0f}m³/h | "
-                            f"ΔQ: {flow_diff:.0f}m³/h ({flow_diff_pct:.1f}%) | "
-                            f"Wear: {metrics.filter_wear_percent:.1f}%")
+class SamplerLockError(RuntimeError):
+    """Un altro processo sta già campionando sullo stesso database"""
+
+
+class SamplerLock:
+    """
+    Lock esclusivo (flock) accanto al database: un solo processo campionatore per DB_PATH
+
+    Preso al primo avvio del campionamento e rilasciato dal sistema all'uscita del
+    processo, anche in caso di crash; il file contiene il pid del proprietario.
+    """
 
+    def __init__(self, path: str):
+        self.path = path
+        self._handle = None
+
+    def acquire(self):
+        if self._handle is not None:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        handle = open(self.path, 'a+')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.seek(0)
+            owner = handle.read().strip() or '?'
+            handle.close()
+            raise SamplerLockError(f"Campionatore già attivo su questo database (pid {owner}, lock {self.path})")
+        handle.seek(0)
+        handle.truncate()
+        handle.write(str(os.getpid()))
+        handle.flush()
+        self._handle = handle
+
+
+class FleetScheduler:
+    """
+    Scheduler unico per tutti i dispositivi, su scadenze assolute
+
+    Ogni dispositivo campiona sugli slot phase + k * intervallo (epoch), quindi il
+    periodo non deriva con la durata dei cicli e i timestamp restano allineati.
+    Le scadenze stanno in un heap: un solo thread attende la più vicina e affida il
+    ciclo a un pool limitato di worker, al massimo un ciclo in corso per dispositivo.
+    Uno slot raggiunto con più di tolerance × intervallo di ritardo viene saltato
+    e registrato (stats e system_events) invece di accumulare ritardo.
+    """
+
+    def __init__(self, workers: int = 8, tolerance: float = 0.5, lock: SamplerLock = None):
+        self.workers = max(1, workers)
+        self.tolerance = min(max(tolerance, 0.0), 1.0)
+        self.lock = lock
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = None
+        self._thread = None
+
+    def start(self, device: Device) -> bool:
+        """
+        Avvia il campionamento periodico di un dispositivo dal prossimo slot; False se già attivo
+
+        Solleva SamplerLockError se un altro processo campiona sullo stesso database.
+        """
+        with self._condition:
+            if device.running:
+                return False
+            self._ensure_thread()
+            device.running = True
+            device.generation += 1
+            device._last_sample_at = None
+            device.stats["start_time"] = datetime.now().isoformat()
+            self._schedule(device, device.next_slot(time.time()))
+        logger.info(f"[{device.device_id}] Avvio raccolta dati...")
+        return True
+
+    def start_all(self, devices: list):
+        """Avvia tutti i dispositivi (le fasi li distribuiscono nell'intervallo)"""
+        for device in devices:
+            self.start(device)
+
+    def stop(self, device: Device) -> bool:
+        """Ferma il campionamento di un dispositivo; False se già fermo"""
+        with self._condition:
+            was_running = device.running
+            device.running = False
+            self._condition.notify()
+        if was_running:
+            # Punti ancora in transazione scritti subito allo stop
+            device.database.flush()
+            logger.info(f"[{device.device_id}] Raccolta dati terminata")
+        return was_running
+
+    def pending(self) -> int:
+        """Cicli pianificati in attesa"""
+        with self._condition:
+            return len(self._heap)
+
+    def _schedule(self, device: Device, slot: float):
+        """Inserisce lo slot (epoch) come scadenza monotonic (chiamare con _condition acquisita)"""
+        due = time.monotonic() + (slot - time.time())
+        heapq.heappush(self._heap, (due, next(self._sequence), device.generation, slot, device))
+        self._condition.notify()
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            if self.lock is not None:
+                self.lock.acquire()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sampler')
+            self._thread = threading.Thread(target=self._run, name='fleet-scheduler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    due, _, generation, slot, device = self._heap[0]
+                    if not device.running or generation != device.generation:
+                        # Dispositivo fermato (o riavviato) dopo la pianificazione
+                        heapq.heappop(self._heap)
+                        continue
+                    delay = due - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(self._heap)
+                        break
+                    self._condition.wait(delay)
+            self._executor.submit(self._sample, device, generation, slot)
+
+    def _sample(self, device: Device, generation: int, slot: float):
+        started = time.time()
+        try:
+            device.sample(slot)
+        except Exception as e:
+            device.stats["errors"] += 1
+            SAMPLE_ERRORS.inc(device.device_id)
+            logger.error(f"[{device.device_id}] Errore raccolta dati: {e}")
+        finally:
+            finished = time.time()
+            interval = device.sampling_interval
+            next_slot, missed = self.next_slot(slot, interval, finished)
+            device.schedule_stats.record(started - slot, finished - started, interval, missed)
+            SAMPLE_CYCLE_SECONDS.observe(finished - started, device.device_id)
+            if finished - started > interval:
+                SAMPLE_OVERRUNS.inc(device.device_id)
+            if missed:
+                SAMPLE_MISSED_SLOTS.inc(device.device_id, amount=missed)
+                self._report_missed(device, slot + interval, missed, finished - started)
+
+            with self._condition:
+                if device.running and generation == device.generation:
+                    self._schedule(device, next_slot)
+
+    def next_slot(self, slot: float, interval: float, now: float) -> tuple:
+        """Slot successivo a slot e numero di slot saltati perché già scaduti oltre la tolleranza"""
+        next_slot = slot + interval
+        late = now - next_slot
+        if late <= self.tolerance * interval:
+            return next_slot, 0
+        missed = int((late - self.tolerance * interval) // interval) + 1
+        return next_slot + missed * interval, missed
+
+    def _report_missed(self, device: Device, first_missed: float, missed: int, duration: float):
+        """Slot saltati registrati esplicitamente nel log e in system_events"""
+        message = (f"{missed} slot saltati da {datetime.fromtimestamp(first_missed).isoformat()} "
+                   f"(ciclo di {duration:.1f}s, intervallo {device.sampling_interval}s)")
+        logger.warning(f"[{device.device_id}] Overrun campionamento: {message}")
+        try:
+            device.database.log_event('missed_slots', message, 'warning', device.device_id)
         except Exception as e:
-            logger.error(f"Errore raccolta dati: {e}")
+            logger.error(f"[{device.device_id}] Errore registrazione evento: {e}")
+
+
+def load_fleet_config(path: str) -> list:
+    """Voci dispositivo dal file FLEET_CONFIG: lista o {"defaults": {...}, "devices": [...]}"""
+    with open(path) as handle:
+        config = json.load(handle)
+
+    defaults = {}
+    if isinstance(config, dict):
+        defaults = config.get('defaults', {})
+        config = config.get('devices')
+    if not isinstance(config, list) or not config:
+        raise ValueError(f"{path}: nessun dispositivo configurato")
+
+    entries, seen = [], set()
+    for index, item in enumerate(config):
+        entry = {**defaults, **item}
+        device_id = str(entry.get('device_id') or '').strip()
+        if not device_id:
+            raise ValueError(f"{path}: dispositivo #{index} senza device_id")
+        if device_id in seen:
+            raise ValueError(f"{path}: device_id duplicato '{device_id}'")
+        if not entry.get('token'):
+            raise ValueError(f"{path}: dispositivo '{device_id}' senza token")
+        seen.add(device_id)
+        entry['device_id'] = device_id
+        entries.append(entry)
+    return entries
+
+
+def create_devices(database: TestDatabase, replica: bool = False) -> dict:
+    """Registro dispositivi: flotta da FLEET_CONFIG oppure il singolo dispositivo delle variabili BLYNK_*"""
+    rate_limiter = RateLimiter(BLYNK_RATE_LIMIT)
+
+    if not FLEET_CONFIG:
+        client = BlynkDirectClient(BLYNK_URLS, BLYNK_FETCH_MODE, BLYNK_MAX_CONCURRENCY,
+                                   rate_limiter=rate_limiter, name=DEVICE_ID, history_url=BLYNK_HISTORY_URL)
+        return {DEVICE_ID: Device(DEVICE_ID, client, database, SAMPLING_INTERVAL,
+                                  use_empirical_curves=USE_EMPIRICAL_CURVES,
+                                  detectors=AnomalyDetectors.create(ANOMALY_DETECTORS), replica=replica)}
+
+    # Una sola sessione HTTP (pool keep-alive) per tutta la flotta
+    session = BlynkDirectClient.create_session(FLEET_WORKERS * BLYNK_MAX_CONCURRENCY)
+    devices = {}
+    entries = load_fleet_config(FLEET_CONFIG)
+    for index, entry in enumerate(entries):
+        device_id = entry['device_id']
+        interval = float(entry.get('sampling_interval', SAMPLING_INTERVAL))
+        urls = build_blynk_urls(entry['token'], entry.get('server', BLYNK_SERVER),
+                                {**BLYNK_PINS, **entry.get('pins', {})})
+        # Politiche tentativi per pin (o 'batch'): {"pressure": {"retries": 4, "backoff": 1.0}}
+        pin_policies = {pin: RetryPolicy(**policy) for pin, policy in entry.get('retry', {}).items()}
+        client = BlynkDirectClient(urls, entry.get('fetch_mode', BLYNK_FETCH_MODE), BLYNK_MAX_CONCURRENCY,
+                                   session=session, rate_limiter=rate_limiter, name=device_id,
+                                   pin_policies=pin_policies,
+                                   history_url=entry.get('history_url', BLYNK_HISTORY_URL))
+        devices[device_id] = Device(
+            device_id, client, database,
+            sampling_interval=interval,
+            params=entry.get('params'),
+            use_empirical_curves=bool(entry.get('use_empirical_curves', USE_EMPIRICAL_CURVES)),
+            # Fasi distribuite uniformemente nell'intervallo: niente raffiche di richieste sullo stesso istante
+            phase=float(entry.get('phase', index / len(entries) * interval)),
+            # Parametri per rilevatore: {"obstruction_cusum": {"h": 10}, "pressure_band_zscore": false}
+            detectors=AnomalyDetectors.create(ANOMALY_DETECTORS, entry.get('detectors')),
+            replica=replica
+        )
+    logger.info(f"Flotta: {len(devices)} dispositivi da {FLEET_CONFIG}")
+    return devices
+
 
-        time.sleep(SAMPLING_INTERVAL)
+class SamplerProxy:
+    """
+    Inoltro HTTP dal worker API (APP_ROLE=api) al processo campionatore
 
-    logger.info("Raccolta dati terminata")
+    Il campionatore è l'unico proprietario dello stato live (ultimo campione, algoritmo,
+    statistiche, calibrazione, rilevatori) e l'unico che esegue start/stop/reset_filter:
+    i worker gli inoltrano queste richieste e restituiscono la risposta così com'è
+    (gzip ed ETag compresi). Lo stream SSE è ritrasmesso man mano che arriva.
+    """
+
+    REQUEST_HEADERS = ('Accept', 'Accept-Encoding', 'Content-Type', 'If-None-Match')
+    # Header legati alla connessione col campionatore, ricalcolati dal server del worker
+    HOP_HEADERS = frozenset(('connection', 'keep-alive', 'transfer-encoding', 'content-length', 'date', 'server'))
+
+    def __init__(self, base_url: str, timeout: float = 10.0, pool_size: int = 32):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.trust_env = False
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def forward(self, incoming, stream: bool = False):
+        """Inoltra la richiesta Flask corrente; 503 se il campionatore non risponde"""
+        url = self.base_url + incoming.path
+        if incoming.query_string:
+            url += '?' + incoming.query_string.decode('latin-1')
+        headers = {name: incoming.headers[name] for name in self.REQUEST_HEADERS if name in incoming.headers}
+        # Senza Accept-Encoding del client, requests chiederebbe gzip per conto suo
+        headers.setdefault('Accept-Encoding', 'identity')
+        try:
+            upstream = self.session.request(incoming.method, url, data=incoming.get_data(), headers=headers,
+                                            stream=True, timeout=(self.timeout, None if stream else self.timeout))
+        except requests.RequestException as e:
+            logger.error(f"Campionatore non raggiungibile ({self.base_url}): {e}")
+            return jsonify({'error': f'Sampler unavailable: {e.__class__.__name__}'}), 503
+
+        response_headers = [(name, value) for name, value in upstream.headers.items()
+                            if name.lower() not in self.HOP_HEADERS]
+        if not stream:
+            try:
+                body = upstream.raw.read(decode_content=False)
+            finally:
+                upstream.close()
+            return Response(body, status=upstream.status_code, headers=response_headers)
+
+        def relay():
+            try:
+                while True:
+                    # read1: i byte già arrivati, senza attendere un blocco pieno (eventi SSE)
+                    chunk = upstream.raw.read1(65536, decode_content=False)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                upstream.close()
+
+        return Response(relay(), status=upstream.status_code, headers=response_headers)
+
+    def flush(self) -> bool:
+        """Chiede al campionatore il commit dei punti in attesa; False se non risponde"""
+        try:
+            self.session.post(self.base_url + '/api/flush', timeout=self.timeout).raise_for_status()
+            return True
+        except requests.RequestException as e:
+            logger.warning(f"Commit dal campionatore fallito, dati recenti forse incompleti: {e}")
+            return False
+
+    def fetch_text(self, path: str):
+        """GET di un testo dal campionatore; None se non risponde o risponde con errore"""
+        try:
+            response = self.session.get(self.base_url + path, timeout=self.timeout)
+            response.raise_for_status()
+            return response.text
+        except requests.RequestException as e:
+            logger.warning(f"Lettura {path} dal campionatore fallita: {e}")
+            return None
+
+
+# Istanze globali create da init_server(): database condiviso, registro dispositivi e scheduler unico
+# (worker API: database in sola lettura e dispositivi replica, stato live inoltrato al campionatore)
+sampler_lock = None
+database = None
+devices = {}
+default_device_id = DEVICE_ID
+scheduler = None
+sampler_proxy = None
+
+# Flask app
+app = Flask(__name__)
+
+
+def init_server():
+    """
+    Crea database, dispositivi, scheduler e proxy secondo APP_ROLE; idempotente
+
+    La chiamano solo gli entry point del server (python app.py, gunicorn "app:create_app()",
+    benchmark): importare il modulo non apre né migra DB_PATH, così replay, sweep, export
+    e simulate usano le classi senza toccare il database di produzione.
+    """
+    global sampler_lock, database, devices, default_device_id, scheduler, sampler_proxy
+    if database is not None:
+        return
+
+    sampler_lock = SamplerLock(f'{DB_PATH}.sampler.lock')
+    if APP_ROLE == 'sampler':
+        # Un secondo campionatore sullo stesso database si ferma subito, prima di aprirlo in scrittura
+        sampler_lock.acquire()
+    database = TestDatabase(DB_PATH, DB_COMMIT_BATCH_SIZE, DB_COMMIT_INTERVAL, DEVICE_ID,
+                            read_only=APP_ROLE == 'api')
+    atexit.register(database.flush)
+    devices = create_devices(database, replica=APP_ROLE == 'api')
+    default_device_id = DEVICE_ID if DEVICE_ID in devices else next(iter(devices))
+    scheduler = FleetScheduler(FLEET_WORKERS, SLOT_TOLERANCE, sampler_lock)
+    sampler_proxy = SamplerProxy(SAMPLER_URL, SAMPLER_TIMEOUT) if APP_ROLE == 'api' else None
+
+    # Gauge letti a ogni scrape di /metrics
+    metrics_registry.gauge('sampling_device_running', 'Campionamento attivo (1) o fermo (0)',
+                           lambda: {(('device', d.device_id),): int(d.running) for d in devices.values()})
+    metrics_registry.gauge('stream_clients', 'Client /api/stream connessi',
+                           lambda: {(('device', d.device_id),): d.broadcaster.subscriber_count()
+                                    for d in devices.values()})
+    metrics_registry.gauge('blynk_breaker_open', 'Circuit breaker Blynk non chiuso (1) per pin o batch',
+                           lambda: {(('device', d.device_id), ('key', key)): int(state['state'] != 'closed')
+                                    for d in devices.values()
+                                    for key, state in d.blynk_client.breaker_status().items()})
+    metrics_registry.gauge('db_pending_rows', 'Righe in transazione non ancora committate',
+                           lambda: {(): database._pending})
+    if profiler is not None:
+        profiler.start()
+
+
+def create_app() -> Flask:
+    """Factory per gunicorn ("app:create_app()"): istanze globali del ruolo e app Flask"""
+    init_server()
+    return app
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    """Durata per route (template della regola, non il path: cardinalità limitata)"""
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+    return response
+
+
+def with_device(view):
+    """Risolve il dispositivo (?device= o campo JSON "device", default il principale); 404 se sconosciuto"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        device_id = request.args.get('device')
+        if not device_id and request.is_json:
+            body = request.get_json(silent=True)
+            device_id = body.get('device') if isinstance(body, dict) else None
+        device = devices.get(device_id or default_device_id)
+        if device is None:
+            return jsonify({'error': f'Unknown device: {device_id}'}), 404
+        return view(*args, device=device, **kwargs)
+    return wrapper
+
+
+def forward_to_sampler(view=None, stream: bool = False):
+    """Nei worker API la route è servita dal processo campionatore (stato live e comandi)"""
+    if view is None:
+        return functools.partial(forward_to_sampler, stream=stream)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if sampler_proxy is not None:
+            return sampler_proxy.forward(request, stream)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def flush_pending_rows() -> bool:
+    """Commit dei punti in attesa prima di leggere SQLite (nei worker API lo esegue il campionatore)"""
+    if sampler_proxy is not None:
+        return sampler_proxy.flush()
+    database.flush()
+    return True
 
 
 # Routes Flask per dashboard web
@@ -511,13 +3832,13 @@ def dashboard():
 
 
 def convert_numpy_types(obj):
-    """Converte tipi numpy in tipi Python nativi per JSON"""
+    """Converte tipi numpy in tipi Python nativi per JSON (NaN -> None, non valido in JSON)"""
     if isinstance(obj, np.bool_):
         return bool(obj)
     elif isinstance(obj, (np.int_, np.intc, np.intp, np.int8, np.int16, np.int32, np.int64)):
         return int(obj)
-    elif isinstance(obj, (np.float_, np.float16, np.float32, np.float64)):
-        return float(obj)
+    elif isinstance(obj, (float, np.float16, np.float32, np.float64)):
+        return None if math.isnan(obj) else float(obj)
     elif isinstance(obj, dict):
         return {key: convert_numpy_types(value) for key, value in obj.items()}
     elif isinstance(obj, list):
@@ -525,207 +3846,646 @@ def convert_numpy_types(obj):
     return obj
 
 
+def json_scalar(value):
+    """Scalare Python/NumPy -> valore JSON nativo (NaN -> None)"""
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, float):
+        return None if value != value else float(value)
+    if isinstance(value, np.generic):
+        return json_scalar(value.item())
+    return value
+
+
+def record_dict(record) -> dict:
+    """Record piatto (SystemData, CalculatedMetrics) -> dict JSON nativo, senza la copia ricorsiva di asdict"""
+    return {name: json_scalar(getattr(record, name)) for name in record.__dataclass_fields__}
+
+
+def column_list(values: np.ndarray) -> list:
+    """Colonna NumPy -> lista JSON (NaN -> None)"""
+    if values.dtype.kind == 'f':
+        missing = np.isnan(values)
+        if missing.any():
+            return np.where(missing, None, values).tolist()
+    return values.tolist()
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return column_list(value)
+    if isinstance(value, np.generic):
+        return json_scalar(value.item())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# Encoder compatto condiviso: payload già nativi, NumPy residui convertiti da _json_default
+_json_encoder = json.JSONEncoder(separators=(',', ':'), default=_json_default)
+
+
+def dumps_json(payload) -> str:
+    """JSON compatto dei payload API (array NumPy e scalari NumPy ammessi)"""
+    return _json_encoder.encode(payload)
+
+
+def json_response(payload, status: int = 200, etag: bool = False) -> Response:
+    """
+    Risposta JSON compatta, con gzip se accettato dal client e oltre GZIP_MIN_BYTES
+
+    Con etag=True l'ETag (debole, valido per tutte le codifiche) è l'hash del corpo:
+    a una richiesta con If-None-Match uguale si risponde 304 senza corpo.
+    """
+    body = dumps_json(payload).encode('utf-8')
+    response = Response(body, status=status, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if etag:
+        response.set_etag(hashlib.blake2b(body, digest_size=16).hexdigest(), weak=True)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+    if GZIP_MIN_BYTES and len(body) >= GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def build_current_payload(sample: dict, device: Device) -> dict:
+    """Payload unificato di un campione per /api/current e /api/stream"""
+    system_dict = sample['system_dict']
+
+    # SOLUZIONE: Crea un oggetto unificato con entrambi i flow facilmente accessibili
+    return {
+        'device_id': device.device_id,
+        'timestamp': system_dict['timestamp'],
+        'system_data': system_dict,
+        'pin_timestamps': sample['pin_timestamps'],
+        'sample_source': sample['source'],
+        'sample_age': device.latest_sample.age(),
+        'metrics': sample['metrics_dict'],
+        'test_stats': dict(device.stats),
+        'status': 'running' if device.running else 'stopped',
+        'anomalies': device.detectors.active(),
+
+        # Sezione dedicata per confronto flussi (calcolata alla pubblicazione del campione)
+        'flow_comparison': sample['flow_comparison']
+    }
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """
+    Metriche in formato Prometheus
+
+    Nei worker API: serie HTTP del worker che risponde (etichetta worker=pid) più tutte
+    le serie del campionatore tranne le sue HTTP (solo le richieste inoltrate).
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    if sampler_proxy is None:
+        return Response(metrics_registry.render(), content_type=content_type)
+
+    body = metrics_registry.render(API_WORKER_METRICS, (('worker', str(os.getpid())),))
+    sampler_metrics = sampler_proxy.fetch_text('/metrics')
+    if sampler_metrics is not None:
+        body += drop_metric_families(sampler_metrics, API_WORKER_METRICS)
+    body += ('# HELP sampler_up Campionatore raggiungibile dal worker API (1) o no (0)\n'
+             '# TYPE sampler_up gauge\n'
+             f'sampler_up {int(sampler_metrics is not None)}\n')
+    return Response(body, content_type=content_type)
+
+
+@app.route('/debug/profile')
+@forward_to_sampler
+def debug_profile():
+    """Stack aggregati del profiler a campionamento (?thread=sampler filtra, ?reset=1 azzera); 404 se spento"""
+    if profiler is None:
+        return jsonify({'error': 'Profiler disattivato (PROFILER_HZ=0)'}), 404
+    body = profiler.folded(request.args.get('thread', ''),
+                           reset=request.args.get('reset', 'false').lower() in ('1', 'true'))
+    return Response(body, mimetype='text/plain', headers={'X-Profile-Samples': str(profiler.samples)})
+
+
+@app.route('/api/devices')
+@forward_to_sampler
+def api_devices():
+    """Dispositivi della flotta con stato di campionamento"""
+    return jsonify({
+        'default_device': default_device_id,
+        'pending_cycles': scheduler.pending(),
+        'overruns': sum(device.schedule_stats.overruns for device in devices.values()),
+        'missed_slots': sum(device.schedule_stats.missed_slots for device in devices.values()),
+        'devices': [convert_numpy_types(device.status()) for device in devices.values()]
+    })
+
+
 @app.route('/api/current')
-def api_current():
+@forward_to_sampler
+@with_device
+def api_current(device: Device):
     """API dati attuali con unificazione flow data"""
     try:
-        # Ottieni dati Blynk
-        blynk_data = blynk_client.get_multiple_pins(['pressure', 'flow', 'pwm', 'temperature', 'pm_value'])
-
-        system_data = SystemData(
-            timestamp=datetime.now().isoformat(),
-            pwm_percentage=float(blynk_data.get('pwm', 0)),
-            pressure_measured=float(blynk_data.get('pressure', 0)),
-            flow_blynk=float(blynk_data.get('flow', 0)),
-            temperature=float(blynk_data.get('temperature', 20)),
-            pm_value=float(blynk_data.get('pm_value', 0))
-        )
+        # Ultimo campione del loop di raccolta; lettura live solo se obsoleto
+        sample = device.latest_sample.get()
+        if sample is None:
+            with device.live_fetch_lock:
+                # Una sola lettura live anche con molte dashboard aperte
+                sample = device.latest_sample.get()
+                if sample is None:
+                    system_data, snapshot = device.read_system_data()
+                    # Non altera lo storico ostruzione: l'algoritmo è guidato solo dal campionatore
+                    metrics = device.algorithm.calculate_metrics(system_data, update_state=False)
+                    sample = device.latest_sample.publish(system_data, metrics, snapshot.timestamps, source='live')
+
+        return json_response(build_current_payload(sample, device))
 
-        metrics = algorithm.calculate_metrics(system_data)
+    except Exception as e:
+        logger.error(f"Errore API current: {e}")
+        return jsonify({'error': str(e)}), 500
 
-        # Converti tutti i dati
-        system_dict = convert_numpy_types(asdict(system_data))
-        metrics_dict = convert_numpy_types(asdict(metrics))
 
-        # SOLUZIONE: Crea un oggetto unificato con entrambi i flow facilmente accessibili
-        response_data = {
-            'timestamp': system_dict['timestamp'],
-            'system_data': system_dict,
-            'metrics': metrics_dict,
-            'test_stats': convert_numpy_types(test_stats),
-            'status': 'running' if test_running else 'stopped',
+@app.route('/api/stream')
+@forward_to_sampler(stream=True)
+@with_device
+def api_stream(device: Device):
+    """Stream Server-Sent Events dei nuovi campioni del loop di raccolta"""
 
-            # Aggiungi sezione dedicata per confronto flussi
-            'flow_comparison': {
-                'flow_from_blynk': system_dict['flow_blynk'],
-                'flow_calculated': metrics_dict['flow_calculated'],
-                'difference': abs(system_dict['flow_blynk'] - metrics_dict['flow_calculated']),
-                'difference_percent': (abs(system_dict['flow_blynk'] - metrics_dict['flow_calculated']) /
-                                       max(system_dict['flow_blynk'], 0.1) * 100) if system_dict[
-                                                                                         'flow_blynk'] > 0.1 else 0
-            }
-        }
+    def event_stream():
+        subscriber = device.broadcaster.subscribe()
+        try:
+            # Ultimo campione disponibile subito alla connessione
+            sample = device.latest_sample.get()
+            if sample is not None:
+                yield f"data: {dumps_json(build_current_payload(sample, device))}\n\n"
 
-        return jsonify(response_data)
+            while True:
+                try:
+                    message = subscriber.get(timeout=STREAM_KEEPALIVE)
+                    yield f"data: {message}\n\n"
+                except queue.Empty:
+                    # Keepalive per proxy/tunnel Balena
+                    yield ": keepalive\n\n"
+        finally:
+            device.broadcaster.unsubscribe(subscriber)
 
-    except Exception as e:
-        logger.error(f"Errore API current: {e}")
-        return jsonify({'error': str(e)}), 500
+    response = Response(stream_with_context(event_stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @app.route('/api/history/<int:hours>')
-def api_history(hours):
-    """API dati storici"""
+@with_device
+def api_history(hours, device: Device):
+    """API dati storici (grezzi o rollup in base all'intervallo richiesto; ?format=columns per colonne)"""
     try:
-        data = database.get_recent_data(hours)
-        return jsonify(data)
+        target_points = request.args.get('points', 500, type=int)
+        resolution = request.args.get('resolution', 'auto')
+        if resolution == 'auto':
+            resolution = None
+        elif resolution == 'raw':
+            resolution = 0
+        else:
+            resolution = int(resolution)
+            if resolution and resolution not in TestDatabase.ROLLUP_RESOLUTIONS:
+                return jsonify({'error': f'Invalid resolution, use raw, auto or {TestDatabase.ROLLUP_RESOLUTIONS}'}), 400
+
+        history_format = request.args.get('format', 'rows')
+        if history_format not in ('rows', 'columns'):
+            return jsonify({'error': 'Invalid format, use rows or columns'}), 400
+
+        limit = request.args.get('limit', 1000, type=int)
+        if sampler_proxy is not None:
+            # Worker API: storico sempre da SQLite, gli ultimi punti sono ancora nel campionatore
+            flush_pending_rows()
+        resolution, data, source = device.get_history(hours, target_points, resolution, limit,
+                                                      columnar=history_format == 'columns')
+        if history_format == 'columns':
+            data = {'device_id': device.device_id, 'resolution': resolution, 'source': source,
+                    'count': len(data['ts_epoch']), 'columns': data}
+        # Storico invariato: 304 senza corpo a chi ha già l'ETag
+        response = json_response(data, etag=True)
+        response.headers['X-History-Resolution'] = str(resolution)
+        response.headers['X-History-Source'] = source
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/statistics')
-def api_statistics():
+@forward_to_sampler
+@with_device
+def api_statistics(device: Device):
     """API statistiche"""
     try:
-        stats = database.get_statistics()
-        return jsonify(stats)
+        stats = database.get_statistics(device.device_id)
+        return json_response(stats, etag=True)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+FLOW_ANALYSIS_COLUMNS = ('pwm_percentage', 'flow_blynk', 'flow_calculated')
+FLOW_ANALYSIS_PERCENTILES = (50, 90, 95, 99)
+
+
+def analyze_flow(data: dict, min_flow: float = 0.1, band_width: float = 10.0, details: int = 50) -> dict:
+    """
+    Confronto vettoriale flow_calculated vs flow_blynk su colonne NumPy
+
+    Esclude i campioni con letture mancanti o flow_blynk <= min_flow. Ritorna
+    riepilogo (errore medio assoluto/percentuale, bias, RMSE, percentili),
+    errore per fascia PWM e gli ultimi `details` confronti in ordine temporale.
+    """
+    flow_blynk, flow_calculated = data['flow_blynk'], data['flow_calculated']
+    with np.errstate(invalid='ignore'):
+        valid = ~np.isnan(flow_calculated) & (flow_blynk > min_flow)
+    ts = data['ts_epoch'][valid]
+    pwm = data['pwm_percentage'][valid]
+    flow_blynk, flow_calculated = flow_blynk[valid], flow_calculated[valid]
+
+    error = flow_calculated - flow_blynk
+    absolute = np.abs(error)
+    percent = absolute / flow_blynk * 100
+    count = len(error)
+
+    def percentiles(values):
+        if not count:
+            return {f'p{q}': None for q in FLOW_ANALYSIS_PERCENTILES}
+        return dict(zip((f'p{q}' for q in FLOW_ANALYSIS_PERCENTILES),
+                        np.percentile(values, FLOW_ANALYSIS_PERCENTILES).tolist()))
+
+    summary = {
+        'total_points': count,
+        'average_difference': float(absolute.mean()) if count else 0,
+        'max_difference': float(absolute.max()) if count else 0,
+        'average_percent_difference': float(percent.mean()) if count else 0,
+        'bias': float(error.mean()) if count else None,
+        'rmse': float(np.sqrt(np.mean(error ** 2))) if count else None,
+        'std': float(error.std(ddof=1)) if count > 1 else None,
+        'percentiles': {'absolute': percentiles(absolute), 'percent': percentiles(percent)}
+    }
+
+    # Errore per fascia PWM: somme per fascia con bincount
+    bands = []
+    pwm_known = ~np.isnan(pwm)
+    if pwm_known.any():
+        top = max(0.0, 100.0 - band_width)
+        band_index = (np.clip(pwm[pwm_known], 0.0, top) // band_width).astype(np.int64)
+        band_error = error[pwm_known]
+        samples = np.bincount(band_index)
+        sums = {
+            'error': np.bincount(band_index, band_error),
+            'squared': np.bincount(band_index, band_error ** 2),
+            'absolute': np.bincount(band_index, np.abs(band_error)),
+            'percent': np.bincount(band_index, percent[pwm_known])
+        }
+        for index in np.flatnonzero(samples):
+            n = samples[index]
+            bands.append({
+                'pwm_min': float(index * band_width),
+                'pwm_max': float(min((index + 1) * band_width, 100.0)),
+                'samples': int(n),
+                'bias': float(sums['error'][index] / n),
+                'mae': float(sums['absolute'][index] / n),
+                'rmse': float(np.sqrt(sums['squared'][index] / n)),
+                'average_percent_difference': float(sums['percent'][index] / n)
+            })
+
+    # Ultimi confronti (i più recenti, in ordine temporale)
+    recent = slice(max(0, count - details), count) if details > 0 else slice(0, 0)
+    detail_rows = [
+        {
+            'timestamp': datetime.fromtimestamp(epoch).isoformat(),
+            'flow_blynk': blynk,
+            'flow_calculated': calculated,
+            'absolute_diff': diff,
+            'percent_diff': pct
+        }
+        for epoch, blynk, calculated, diff, pct in zip(
+            ts[recent].tolist(), flow_blynk[recent].tolist(), flow_calculated[recent].tolist(),
+            absolute[recent].tolist(), percent[recent].tolist())
+    ]
+
+    return {'summary': summary, 'pwm_bands': bands, 'details': detail_rows}
+
+
 @app.route('/api/flow_analysis')
-def api_flow_analysis():
-    """Analisi dettagliata confronto flow_blynk vs flow_calculated"""
+@with_device
+def api_flow_analysis(device: Device):
+    """Analisi confronto flow_blynk vs flow_calculated su una finestra configurabile"""
     try:
-        # Prendi ultimi 100 punti
-        data = database.get_recent_data(hours=24)
+        end_epoch = parse_time_param(request.args.get('to'))
+        start_epoch = parse_time_param(request.args.get('from'))
+        if start_epoch is None:
+            hours = request.args.get('hours', 24, type=float)
+            start_epoch = (end_epoch or time.time()) - hours * 3600
+        band_width = request.args.get('band', 10, type=float)
+        details = request.args.get('details', 50, type=int)
+        min_flow = request.args.get('min_flow', RunningStatistics.MIN_VALID_FLOW, type=float)
+        if band_width <= 0 or details < 0:
+            raise ValueError("band deve essere > 0 e details >= 0")
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        if not data:
+    try:
+        if sampler_proxy is not None:
+            flush_pending_rows()
+        data, source = device.load_columns(start_epoch, end_epoch, FLOW_ANALYSIS_COLUMNS)
+        if not len(data['ts_epoch']):
             return jsonify({'error': 'No data available'}), 404
 
-        # Calcola statistiche confronto
-        differences = []
-        for point in data:
-            if point['flow_blynk'] > 0:
-                diff = abs(point['flow_calculated'] - point['flow_blynk'])
-                diff_pct = (diff / point['flow_blynk']) * 100
-                differences.append({
-                    'timestamp': point['timestamp'],
-                    'flow_blynk': point['flow_blynk'],
-                    'flow_calculated': point['flow_calculated'],
-                    'absolute_diff': diff,
-                    'percent_diff': diff_pct
-                })
-
-        if differences:
-            avg_diff = sum(d['absolute_diff'] for d in differences) / len(differences)
-            max_diff = max(d['absolute_diff'] for d in differences)
-            avg_pct = sum(d['percent_diff'] for d in differences) / len(differences)
-        else:
-            avg_diff = max_diff = avg_pct = 0
-
-        return jsonify({
-            'summary': {
-                'total_points': len(differences),
-                'average_difference': avg_diff,
-                'max_difference': max_diff,
-                'average_percent_difference': avg_pct
-            },
-            'details': differences[-50:]  # Ultimi 50 per non sovraccaricare
-        })
+        result = analyze_flow(data, min_flow, band_width, details)
+        result['window'] = {
+            'from': datetime.fromtimestamp(start_epoch).isoformat(),
+            'to': datetime.fromtimestamp(end_epoch).isoformat() if end_epoch is not None else None,
+            'samples': len(data['ts_epoch']),
+            'source': source
+        }
+        return json_response(result, etag=True)
 
     except Exception as e:
         logger.error(f"Errore flow analysis: {e}")
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/control', methods=['POST'])
-def api_control():
-    """Controllo test"""
-    global test_running
+@app.route('/api/flush', methods=['POST'])
+@forward_to_sampler
+def api_flush():
+    """Commit immediato dei punti in attesa (chiamato dai worker API prima di leggere SQLite)"""
+    database.flush()
+    return jsonify({'status': 'flushed'})
+
 
+@app.route('/api/control', methods=['POST'])
+@forward_to_sampler
+@with_device
+def api_control(device: Device):
+    """Controllo test del dispositivo"""
     action = request.json.get('action')
 
-    if action == 'start' and not test_running:
-        # Avvia thread raccolta dati
-        thread = threading.Thread(target=data_collection_loop, daemon=True)
-        thread.start()
-        return jsonify({'status': 'started'})
+    if action == 'start' and not device.running:
+        # Campionamento periodico affidato allo scheduler unico
+        try:
+            scheduler.start(device)
+        except SamplerLockError as e:
+            return jsonify({'error': str(e)}), 409
+        return jsonify({'status': 'started', 'device_id': device.device_id})
 
     elif action == 'stop':
-        test_running = False
-        return jsonify({'status': 'stopped'})
+        scheduler.stop(device)
+        return jsonify({'status': 'stopped', 'device_id': device.device_id})
 
     elif action == 'reset_filter':
-        algorithm.hours_since_change = 0
-        algorithm.obstruction_history = [1.0] * 10
-        logger.info("Timer filtro resettato")
-        return jsonify({'status': 'filter_reset'})
+        device.reset_filter()
+        return jsonify({'status': 'filter_reset', 'device_id': device.device_id})
 
     return jsonify({'error': 'Invalid action'}), 400
 
 
-@app.route('/api/export')
-def api_export():
-    """Export dati CSV"""
+def parse_calibration_points(data) -> list:
+    """Punti dal body JSON: {pwm, pressure, flow} oppure {points: [{pwm, pressure, flow}, ...]}"""
+    if not isinstance(data, dict):
+        raise ValueError("Body JSON mancante")
+    items = data.get('points', [data])
+    if not isinstance(items, list) or not items:
+        raise ValueError("Nessun punto di calibrazione")
+    try:
+        points = [(float(item['pwm']), float(item['pressure']), float(item['flow'])) for item in items]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Ogni punto richiede pwm, pressure e flow numerici")
+    if any(math.isnan(value) or math.isinf(value) for point in points for value in point):
+        raise ValueError("Valori di calibrazione non finiti")
+    return points
+
+
+@app.route('/api/calibration/add_point', methods=['POST'])
+@forward_to_sampler
+@with_device
+def api_calibration_add(device: Device):
+    """Aggiungi punti di calibrazione (salvati su SQLite e applicati subito al modello)"""
+    try:
+        points = parse_calibration_points(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        database.add_calibration_points(points, device_id=device.device_id)
+        pwm, pressure, flow = zip(*points)
+        device.calibration.add_points(pwm, pressure, flow)
+        return jsonify({'status': 'added', 'added': len(points), 'total_points': device.calibration.points,
+                        'points': points})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/calibration/points', methods=['GET', 'DELETE'])
+@forward_to_sampler
+@with_device
+def api_calibration_points(device: Device):
+    """Punti di calibrazione (?binned=1 per medie ogni 5% PWM); DELETE li elimina"""
     try:
-        import io
-        from flask import make_response
+        if request.method == 'DELETE':
+            removed = database.clear_calibration_points(device.device_id)
+            device.calibration.reset()
+            logger.info(f"[{device.device_id}] Calibrazione azzerata: {removed} punti eliminati")
+            return jsonify({'status': 'cleared', 'removed': removed})
+
+        # Include i punti automatici ancora in transazione
+        database.flush()
+        if request.args.get('binned', '').lower() in ('1', 'true'):
+            return jsonify(database.get_calibration_summary(device_id=device.device_id))
+
+        pwm, pressure, flow = database.get_calibration_points(device.device_id)
+        return jsonify([{'pwm': p, 'pressure': pr, 'flow': f}
+                        for p, pr, f in zip(pwm.tolist(), pressure.tolist(), flow.tolist())])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        data = database.get_recent_data(24 * 7)  # 1 settimana
 
-        if not data:
-            return jsonify({'error': 'No data available'}), 404
+@app.route('/api/calibration/apply', methods=['GET', 'POST'])
+@forward_to_sampler
+@with_device
+def api_calibration_apply(device: Device):
+    """Ricostruisce il modello dai punti salvati e attiva la calibrazione ({"enabled": false} disattiva)"""
+    try:
+        data = request.get_json(silent=True) or {}
+        enabled = data.get('enabled', True) is not False
+
+        if enabled:
+            database.flush()
+            calibration = device.calibration
+            calibration.fit(*database.get_calibration_points(device.device_id))
+            if not calibration.ready:
+                return jsonify({'error': f'Servono almeno {calibration.K_NEAREST} punti di calibrazione',
+                                'points': calibration.points}), 400
 
-        # Crea CSV
-        output = io.StringIO()
+        device.algorithm.USE_EMPIRICAL_CURVES = enabled
+        logger.info(f"[{device.device_id}] Calibrazione empirica {'attiva' if enabled else 'disattivata'} "
+                    f"({device.calibration.points} punti)")
+
+        return jsonify({
+            'status': 'calibrated' if enabled else 'disabled',
+            'points': device.calibration.points,
+            'data': database.get_calibration_summary(device_id=device.device_id)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def parse_time_param(value: str):
+    """Parametro temporale da query string: epoch Unix o timestamp ISO"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        epoch = iso_to_epoch(value)
+        if epoch is None:
+            raise ValueError(f"Invalid time value: {value}")
+        return epoch
+
+
+def parse_export_request(args, source: TestDatabase = None) -> tuple:
+    """Intervallo (from/to) e colonne (columns=a,b,c) di una richiesta di export (default: database del server)"""
+    start_epoch = parse_time_param(args.get('from'))
+    end_epoch = parse_time_param(args.get('to'))
+
+    available = (source or database).get_columns()
+    columns = [c.strip() for c in args.get('columns', '').split(',') if c.strip()] or available
+    invalid = [c for c in columns if c not in available]
+    if invalid:
+        raise ValueError(f"Invalid columns: {', '.join(invalid)}")
+
+    return start_epoch, end_epoch, columns
+
+
+def generate_csv(rows, columns: list, chunk_rows: int = 500):
+    """Genera CSV quotato correttamente a blocchi di righe"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_stream(chunks):
+    """Compressione gzip al volo di un generatore di stringhe"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
         if data:
-            # Header
-            headers = list(data[0].keys())
-            output.write(','.join(headers) + '\n')
+            yield data
+    yield compressor.flush()
 
-            # Data rows
-            for row in data:
-                values = [str(row[h]) for h in headers]
-                output.write(','.join(values) + '\n')
 
-        response = make_response(output.getvalue())
-        response.headers['Content-Type'] = 'text/csv'
-        response.headers[
-            'Content-Disposition'] = f'attachment; filename=test_data_{datetime.now().strftime("%Y%m%d")}.csv'
+@app.route('/api/export')
+@with_device
+def api_export(device: Device):
+    """Export dati CSV in streaming (?from=&to=&columns=&gzip=1), senza limite righe"""
+    try:
+        start_epoch, end_epoch, columns = parse_export_request(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
+    try:
+        # Punti ancora in transazione inclusi nell'export (e nel controllo dati presenti)
+        flush_pending_rows()
+        if not database.has_data(start_epoch, end_epoch, device.device_id):
+            return jsonify({'error': 'No data available'}), 404
+
+        rows = database.iter_rows(start_epoch, end_epoch, columns, device_id=device.device_id)
+        body = generate_csv(rows, columns)
+        filename = f'test_data_{device.device_id}_{datetime.now().strftime("%Y%m%d")}.csv'
+
+        if request.args.get('gzip', 'false').lower() in ('1', 'true'):
+            body = gzip_stream(body)
+            filename += '.gz'
+            response = Response(body, mimetype='application/gzip')
+        else:
+            response = Response(body, mimetype='text/csv')
+
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
         return response
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/export/npz')
+@with_device
+def api_export_npz(device: Device):
+    """Export colonnare NumPy .npz per la pipeline ML (?from=&to=&columns=&compress=1)"""
+    try:
+        start_epoch, end_epoch, columns = parse_export_request(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        flush_pending_rows()
+        if not database.has_data(start_epoch, end_epoch, device.device_id):
+            return jsonify({'error': 'No data available'}), 404
+
+        # File temporaneo anonimo accanto al database, eliminato alla chiusura
+        output = tempfile.TemporaryFile(dir=os.path.dirname(database.db_path) or '.')
+        try:
+            database.export_npz(output, start_epoch, end_epoch, columns,
+                                compress=request.args.get('compress', 'false').lower() in ('1', 'true'),
+                                device_id=device.device_id)
+            output.seek(0)
+        except Exception:
+            output.close()
+            raise
+
+        return send_file(output, mimetype='application/octet-stream', as_attachment=True,
+                         download_name=f'test_data_{device.device_id}_{datetime.now().strftime("%Y%m%d")}.npz')
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 if __name__ == '__main__':
+    init_server()
+
     # Log configurazione all'avvio
     logger.info("=== AVVIO SISTEMA TEST MANUTENZIONE PREDITTIVA ===")
     logger.info(f"Sampling Interval: {SAMPLING_INTERVAL}s")
     logger.info(f"Debug Mode: {DEBUG_MODE}")
-    logger.info(f"URL Mapping configurato per {len(BLYNK_URLS)} pin")
+    logger.info(f"Ruolo processo: {APP_ROLE}")
+    logger.info(f"Dispositivi configurati: {len(devices)} (worker campionamento: {FLEET_WORKERS})")
 
-    # Test connettività completo
-    connectivity_results = blynk_client.test_connectivity()
+    if APP_ROLE != 'api' and len(devices) == 1:
+        # Test connettività completo
+        connectivity_results = devices[default_device_id].blynk_client.test_connectivity()
 
-    # Verifica se almeno pressure e pwm funzionano (minimi per algoritmo)
-    critical_pins = ['pressure', 'pwm']
-    critical_ok = all(connectivity_results.get(pin, {}).get('status') == 'OK' for pin in critical_pins)
+        # Verifica se almeno pressure e pwm funzionano (minimi per algoritmo)
+        critical_pins = ['pressure', 'pwm']
+        critical_ok = all(connectivity_results.get(pin, {}).get('status') == 'OK' for pin in critical_pins)
 
-    if critical_ok:
-        logger.info("✓ Pin critici OK - Sistema pronto")
-    else:
-        logger.warning("⚠️  Alcuni pin critici non rispondono - Funzionamento limitato")
+        if critical_ok:
+            logger.info("✓ Pin critici OK - Sistema pronto")
+        else:
+            logger.warning("⚠️  Alcuni pin critici non rispondono - Funzionamento limitato")
+
+    # Avvia raccolta dati automaticamente se configurato (mai nei worker API)
+    if APP_ROLE != 'api' and os.environ.get('AUTO_START', 'true').lower() == 'true':
+        try:
+            scheduler.start_all(list(devices.values()))
+            logger.info("🚀 Raccolta dati avviata automaticamente")
+        except SamplerLockError as e:
+            logger.error(f"Raccolta dati non avviata: {e}")
 
-    # Avvia raccolta dati automaticamente se configurato
-    if os.environ.get('AUTO_START', 'true').lower() == 'true':
-        thread = threading.Thread(target=data_collection_loop, daemon=True)
-        thread.start()
-        logger.info("🚀 Raccolta dati avviata automaticamente")
+    # SIGTERM (stop del container o di serve.py) come uscita normale: atexit scrive i punti in attesa
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-    # Avvia server Flask
+    # Avvia server Flask (senza reloader: il processo osservatore avvierebbe un secondo campionatore)
+    host = os.environ.get('HOST', '0.0.0.0')
     port = int(os.environ.get('PORT', 80))
-    logger.info(f"🌐 Avvio server Flask su porta {port}")
-    app.run(host='0.0.0.0', port=port, debug=DEBUG_MODE)
+    logger.info(f"🌐 Avvio server Flask su {host}:{port}")
+    # Il campionatore di produzione non espone mai il debugger Werkzeug (esecuzione di codice remota)
+    app.run(host=host, port=port, debug=DEBUG_MODE and APP_ROLE == 'all', threaded=True, use_reloader=False)
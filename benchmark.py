@@ -0,0 +1,389 @@
+"""
+Benchmark riproducibili dell'app contro un server Blynk emulato (fake_blynk.py)
+
+Suite:
+    micro  calculate_metrics (singolo e batch)
+    db     TestDatabase: inserimento, storico recente, rollup, statistiche, scansione colonnare
+    json   convert_numpy_types e serializzazione dei payload API
+    blynk  lettura di tutti i pin per modalità (batch, concurrent, sequential)
+    cycle  ciclo di campionamento completo Device.sample()
+    load   API Flask sotto N client dashboard concorrenti, con campionamento attivo
+
+Tutto gira in una directory temporanea (database incluso), senza dispositivo né
+token reali. I risultati vanno in un file JSON confrontabile tra versioni:
+--compare segnala le voci peggiorate oltre --threshold e termina con codice 1.
+
+Esempi:
+    python benchmark.py --output bench.json
+    python benchmark.py --suite micro,db --quick --output bench.json --compare baseline.json
+    python benchmark.py --suite load --clients 20 --duration 30 --latency 0.05 --output load.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import logging
+import platform
+import tempfile
+import argparse
+import threading
+import subprocess
+from datetime import datetime
+from dataclasses import asdict
+
+import numpy as np
+
+from fake_blynk import FakeBlynkServer
+
+SUITES = ('micro', 'db', 'json', 'blynk', 'cycle', 'load')
+
+# Endpoint interrogati da ogni client dashboard simulato e ogni quante iterazioni
+LOAD_ENDPOINTS = (
+    ('/api/current', 1),
+    ('/api/history/1', 5),
+    ('/api/statistics', 10),
+    ('/api/flow_analysis?hours=1', 20),
+)
+
+
+def summarize(samples: list, operations: int = None) -> dict:
+    """Statistiche di una serie di durate (secondi per operazione)"""
+    values = np.asarray(samples, dtype=np.float64)
+    return {
+        'unit': 's/op',
+        'samples': int(len(values)),
+        'operations': int(operations if operations is not None else len(values)),
+        'mean': float(values.mean()),
+        'median': float(np.median(values)),
+        'min': float(values.min()),
+        'p95': float(np.percentile(values, 95)),
+        'p99': float(np.percentile(values, 99)),
+        'ops_per_s': float(1.0 / values.mean()) if values.mean() > 0 else math.inf
+    }
+
+
+def measure(fn, number: int, repeat: int, warmup: int = 1) -> dict:
+    """Esegue fn number volte per repeat ripetizioni; statistiche sul tempo medio per chiamata"""
+    for _ in range(warmup):
+        fn()
+    rounds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - started) / number)
+    return summarize(rounds, number * repeat)
+
+
+def random_system_data(app, count: int, start_epoch: float, interval: float, seed: int = 0) -> list:
+    """Campioni sintetici plausibili (PWM a gradini, pressione da filtro pulito con rumore)"""
+    rng = random.Random(seed)
+    samples = []
+    for i in range(count):
+        pwm = rng.choice((30.0, 50.0, 70.0, 90.0))
+        samples.append(app.SystemData(
+            timestamp=datetime.fromtimestamp(start_epoch + i * interval).isoformat(),
+            pwm_percentage=pwm,
+            pressure_measured=35 + rng.gauss(0, 3),
+            flow_blynk=400 + pwm * 12 + rng.gauss(0, 20),
+            temperature=22 + rng.gauss(0, 1),
+            pm_value=rng.uniform(5, 25)
+        ))
+    return samples
+
+
+def bench_micro(app, scale: float) -> dict:
+    results = {}
+    samples = random_system_data(app, 1000, time.time(), 5)
+    algorithm = app.PredictiveAlgorithm()
+    cycle = iter(samples * 1000)
+    results['micro.calculate_metrics'] = measure(lambda: algorithm.calculate_metrics(next(cycle)),
+                                                 int(200 * scale) or 1, 10)
+
+    rows = int(10000 * scale) or 100
+    pwm = np.array([s.pwm_percentage for s in samples] * (rows // len(samples) + 1))[:rows]
+    pressure = np.array([s.pressure_measured for s in samples] * (rows // len(samples) + 1))[:rows]
+    batch = measure(lambda: algorithm.calculate_metrics_batch(pwm, pressure), 1, 5)
+    results['micro.calculate_metrics_batch'] = {**batch, 'rows': rows, 'rows_per_s': rows / batch['median']}
+    return results
+
+
+def bench_db(app, workdir: str, scale: float) -> dict:
+    results = {}
+    database = app.TestDatabase(os.path.join(workdir, 'bench_db.db'), app.DB_COMMIT_BATCH_SIZE,
+                                app.DB_COMMIT_INTERVAL, 'bench')
+    algorithm = app.PredictiveAlgorithm()
+    rows = int(20000 * scale) or 200
+    interval = 5.0
+    samples = random_system_data(app, rows, time.time() - rows * interval, interval)
+    points = [(system_data, algorithm.calculate_metrics(system_data)) for system_data in samples]
+
+    durations = []
+    for system_data, metrics in points:
+        started = time.perf_counter()
+        database.save_data_point(system_data, metrics)
+        durations.append(time.perf_counter() - started)
+    database.flush()
+    results['db.save_data_point'] = summarize(durations)
+
+    results['db.get_recent_data_1h'] = measure(lambda: database.get_recent_data(1, 1000), 5, 5)
+    results['db.get_rollup_data_900s_24h'] = measure(lambda: database.get_rollup_data(900, 24), 5, 5)
+    results['db.get_statistics'] = measure(database.get_statistics, 100, 5)
+
+    def scan():
+        for _ in database.iter_column_chunks(None, None, ['ts_epoch', 'pwm_percentage', 'pressure_measured']):
+            pass
+    scanned = measure(scan, 1, 5)
+    results['db.iter_column_chunks'] = {**scanned, 'rows': rows, 'rows_per_s': rows / scanned['median']}
+    database.close()
+    return results
+
+
+def bench_json(app, scale: float) -> dict:
+    results = {}
+    device = app.devices[app.default_device_id]
+    system_data = random_system_data(app, 1, time.time(), 5)[0]
+    metrics = device.algorithm.calculate_metrics(system_data, update_state=False)
+    sample = device.latest_sample.publish(system_data, metrics, {})
+    number = int(200 * scale) or 1
+
+    results['json.current_payload'] = measure(lambda: json.dumps(app.build_current_payload(sample, device)),
+                                              number, 10)
+    status = device.status()
+    results['json.convert_numpy_types_status'] = measure(lambda: app.convert_numpy_types(status), number, 10)
+
+    rows = [{**asdict(s), **asdict(metrics), 'ts_epoch': float(i)}
+            for i, s in enumerate(random_system_data(app, 1000, time.time(), 5))]
+    results['json.dumps_1000_rows'] = measure(lambda: json.dumps(app.convert_numpy_types(rows)),
+                                              max(1, number // 50), 10)
+    # Serializzazione compatta delle API: payload nativo e storico colonnare
+    results['json.dumps_json_current_payload'] = measure(
+        lambda: app.dumps_json(app.build_current_payload(sample, device)), number, 10)
+    arrays = {name: np.array([row[name] for row in rows], dtype=np.float64)
+              for name in rows[0] if name != 'timestamp'}
+    results['json.dumps_json_1000_columns'] = measure(
+        lambda: app.dumps_json({name: app.column_list(values) for name, values in arrays.items()}),
+        max(1, number // 50), 10)
+    return results
+
+
+def bench_blynk(app, server: FakeBlynkServer, scale: float) -> dict:
+    results = {}
+    device = app.devices[app.default_device_id]
+    session = app.BlynkDirectClient.create_session(app.BLYNK_MAX_CONCURRENCY)
+    for mode in ('batch', 'concurrent', 'sequential'):
+        client = app.BlynkDirectClient(device.blynk_client.urls, mode, app.BLYNK_MAX_CONCURRENCY,
+                                       session=session, name=f'bench-{mode}')
+        before = server.stats['requests']
+        result = measure(lambda: client.get_pins_snapshot(app.SAMPLING_PINS), int(20 * scale) or 1, 5)
+        result['http_requests_per_op'] = (server.stats['requests'] - before) / (result['operations'] + 1)
+        results[f'blynk.snapshot_{mode}'] = result
+    return results
+
+
+def bench_cycle(app, scale: float) -> dict:
+    device = app.devices[app.default_device_id]
+    slot = math.floor(time.time()) - 100000
+    slots = iter(range(slot, slot + 10 ** 7, int(device.sampling_interval) or 1))
+    return {'cycle.device_sample': measure(lambda: device.sample(next(slots)), int(20 * scale) or 1, 5)}
+
+
+def bench_load(app, clients: int, duration: float) -> dict:
+    """Client dashboard concorrenti sulle API reali (server WSGI threaded) con campionamento attivo"""
+    import requests
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-http', daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    device = app.devices[app.default_device_id]
+    app.scheduler.start(device)
+
+    latencies = {path: [] for path, _ in LOAD_ENDPOINTS}
+    errors = {path: 0 for path, _ in LOAD_ENDPOINTS}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(index: int):
+        session = requests.Session()
+        local = {path: [] for path, _ in LOAD_ENDPOINTS}
+        local_errors = dict.fromkeys(local, 0)
+        iteration = index
+        while time.monotonic() < deadline:
+            for path, every in LOAD_ENDPOINTS:
+                if iteration % every:
+                    continue
+                started = time.perf_counter()
+                try:
+                    ok = session.get(base + path, timeout=30).status_code < 500
+                except requests.exceptions.RequestException:
+                    ok = False
+                local[path].append(time.perf_counter() - started)
+                if not ok:
+                    local_errors[path] += 1
+            iteration += 1
+        with lock:
+            for path in local:
+                latencies[path].extend(local[path])
+                errors[path] += local_errors[path]
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,), name=f'bench-client-{i}') for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    app.scheduler.stop(device)
+    server.shutdown()
+
+    results = {}
+    total = 0
+    for path, values in latencies.items():
+        if not values:
+            continue
+        total += len(values)
+        results[f'load.{path.split("?")[0]}'] = {**summarize(values), 'errors': errors[path],
+                                                 'requests_per_s': len(values) / elapsed}
+    results['load.total'] = {'unit': 'req/s', 'clients': clients, 'duration': elapsed, 'requests': total,
+                             'errors': sum(errors.values()), 'requests_per_s': total / elapsed,
+                             'samples_collected': device.stats['data_points'],
+                             'overruns': device.schedule_stats.overruns}
+    return results
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ''
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'git_commit': commit or None,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def compare(results: dict, baseline_path: str, threshold: float) -> list:
+    """Voci peggiorate rispetto al file di riferimento oltre threshold (%)"""
+    with open(baseline_path) as handle:
+        baseline = json.load(handle)['results']
+    regressions = []
+    print(f"\nConfronto con {baseline_path} (mediana, soglia {threshold:.0f}%):")
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if result.get('unit') == 'req/s':
+            current, reference, higher_is_better = result['requests_per_s'], (previous or {}).get('requests_per_s'), True
+        else:
+            current, reference, higher_is_better = result['median'], (previous or {}).get('median'), False
+        if not reference:
+            continue
+        change = (current - reference) / reference * 100
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > threshold:
+            flag = '  REGRESSIONE'
+            regressions.append(name)
+        print(f"  {name:40s} {reference:12.6g} -> {current:12.6g}  {change:+7.1f}%{flag}")
+    return regressions
+
+
+def print_results(results: dict):
+    for name, result in results.items():
+        if result.get('unit') == 'req/s':
+            print(f"  {name:40s} {result['requests_per_s']:10.1f} req/s  {result['requests']} richieste, "
+                  f"{result['errors']} errori, {result['clients']} client")
+        else:
+            print(f"  {name:40s} mediana {result['median'] * 1e3:10.4f} ms  p95 {result['p95'] * 1e3:10.4f} ms  "
+                  f"({result['ops_per_s']:.0f} op/s)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark app manutenzione predittiva con Blynk emulato")
+    parser.add_argument('--suite', default=','.join(SUITES), help=f"Suite separate da virgola ({', '.join(SUITES)})")
+    parser.add_argument('--quick', action='store_true', help="Dimensioni ridotte (verifica rapida)")
+    parser.add_argument('--latency', type=float, default=0.02, help="Latenza Blynk emulata (s)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Jitter latenza Blynk emulata (s)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Frazione risposte Blynk con errore")
+    parser.add_argument('--clients', type=int, default=10, help="Client dashboard concorrenti (suite load)")
+    parser.add_argument('--duration', type=float, default=10.0, help="Durata test di carico (s)")
+    parser.add_argument('--interval', type=int, default=1, help="Intervallo campionamento nel test di carico (s)")
+    parser.add_argument('--output', help="File JSON dei risultati")
+    parser.add_argument('--compare', help="File JSON di riferimento per il confronto")
+    parser.add_argument('--threshold', type=float, default=10.0, help="Peggioramento (%%) considerato regressione")
+    parser.add_argument('--keep', action='store_true', help="Conserva la directory temporanea con i database")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    suites = [suite.strip() for suite in args.suite.split(',') if suite.strip()]
+    unknown = [suite for suite in suites if suite not in SUITES]
+    if unknown:
+        print(f"Errore: suite sconosciute {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    scale = 0.1 if args.quick else 1.0
+
+    server = FakeBlynkServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=0).start()
+    workdir = tempfile.mkdtemp(prefix='bench-')
+
+    # app legge la configurazione all'import: database temporaneo e Blynk emulato
+    os.environ.update({
+        'DB_PATH': os.path.join(workdir, 'test_data.db'),
+        'BLYNK_SERVER': server.url,
+        'BLYNK_TOKEN': 'benchmark',
+        'SAMPLING_INTERVAL': str(args.interval),
+        'DEBUG_MODE': 'false',
+        'BLYNK_RATE_LIMIT': '0',
+        'FLEET_CONFIG': '',
+        'PROFILER_HZ': '0'
+    })
+    # Solo avvisi ed errori: i log INFO dell'app (e una riga per richiesta di werkzeug) falserebbero i tempi
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    import app
+    app.init_server()
+
+    print(f"Benchmark su Blynk emulato {server.url} (latenza {args.latency * 1e3:.0f} ms), dati in {workdir}")
+    results = {}
+    runners = {
+        'micro': lambda: bench_micro(app, scale),
+        'db': lambda: bench_db(app, workdir, scale),
+        'json': lambda: bench_json(app, scale),
+        'blynk': lambda: bench_blynk(app, server, scale),
+        'cycle': lambda: bench_cycle(app, scale),
+        'load': lambda: bench_load(app, args.clients, args.duration * (0.3 if args.quick else 1.0)),
+    }
+    for suite in suites:
+        print(f"[{suite}]")
+        suite_results = runners[suite]()
+        print_results(suite_results)
+        results.update(suite_results)
+
+    report = {'version': 1, 'environment': environment(), 'config': vars(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+        print(f"Risultati in {args.output}")
+
+    server.stop()
+    app.database.flush()
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressioni oltre il {args.threshold:.0f}%", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""
+Export dati test_data da riga di comando (CSV o NumPy .npz colonnare)
+
+Esempi:
+    python export_data.py --db /data/test_data.db --format npz -o dataset.npz
+    python export_data.py --db test_data.db --from 2025-10-01 --to 2025-10-08 --columns ts_epoch,pwm_percentage,pressure_measured,flow_blynk -o week.npz
+    python export_data.py --db test_data.db --format csv --gzip -o dataset.csv.gz
+"""
+import os
+import sys
+import argparse
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export dati test manutenzione predittiva")
+    parser.add_argument('--db', default=os.environ.get('DB_PATH', '/data/test_data.db'), help="Percorso database SQLite")
+    parser.add_argument('--device', default=None, help="Dispositivo della flotta (default: DEVICE_ID)")
+    parser.add_argument('--format', choices=['npz', 'csv'], default='npz', help="Formato output")
+    parser.add_argument('--from', dest='start', help="Inizio intervallo (epoch o ISO)")
+    parser.add_argument('--to', dest='end', help="Fine intervallo (epoch o ISO)")
+    parser.add_argument('--columns', default='', help="Colonne separate da virgola (default: tutte)")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="Righe lette per blocco")
+    parser.add_argument('--compress', action='store_true', help="npz compresso (ZIP deflate)")
+    parser.add_argument('--gzip', action='store_true', help="CSV compresso gzip")
+    parser.add_argument('-o', '--output', required=True, help="File di output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if not os.path.exists(args.db):
+        print(f"Errore: database {args.db} inesistente", file=sys.stderr)
+        return 2
+
+    import app
+
+    # Sola lettura: niente migrazioni né scritture sul database esportato
+    database = app.TestDatabase(args.db, default_device=app.DEVICE_ID, read_only=True)
+    try:
+        start_epoch, end_epoch, columns = app.parse_export_request({
+            'from': args.start,
+            'to': args.end,
+            'columns': args.columns
+        }, database)
+    except ValueError as e:
+        print(f"Errore: {e}", file=sys.stderr)
+        return 2
+
+    if args.format == 'npz':
+        with open(args.output, 'wb') as output:
+            total = database.export_npz(output, start_epoch, end_epoch, columns,
+                                        chunk_size=args.chunk_size, compress=args.compress, device_id=args.device)
+        print(f"Esportate {total} righe in {args.output}")
+        return 0
+
+    rows = database.iter_rows(start_epoch, end_epoch, columns, args.chunk_size, device_id=args.device)
+    chunks = app.generate_csv(rows, columns)
+    if args.gzip:
+        with open(args.output, 'wb') as output:
+            for chunk in app.gzip_stream(chunks):
+                output.write(chunk)
+    else:
+        with open(args.output, 'w', newline='') as output:
+            for chunk in chunks:
+                output.write(chunk)
+    print(f"Export CSV scritto in {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""
+Server HTTP locale che emula l'endpoint Blynk external/api/get
+
+Serve letture singole (/external/api/get?token=...&v19) e multi-pin
+(...&v19&v10&v26 -> {"v19": ..., "v10": ...}) e lo storico per il recupero buchi
+(/history?token=...&pin=v19&start=...&end=..., da usare con
+BLYNK_HISTORY_URL="{base}/history?token={token}&pin={pin}&start={start}&end={end}").
+Latenza, jitter, errori e generatori di valori sono configurabili: permette di
+provare e misurare l'app senza dispositivo né token reali.
+
+Generatori (--pin v19=SPEC, ripetibile):
+    const:42            valore fisso
+    uniform:0:100       casuale uniforme
+    sine:200:50:600     media, ampiezza, periodo (s)
+    ramp:150:2          valore iniziale, incremento per ora (intasamento filtro)
+    choice:30,50,70,90  valore casuale dall'elenco, cambia ogni --hold secondi
+
+Esempi:
+    python fake_blynk.py --port 18080 --latency 0.05 --jitter 0.02 --error-rate 0.05
+    BLYNK_SERVER=http://127.0.0.1:18080 python app.py
+"""
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# Pin dell'impianto (come BLYNK_PINS in app.py) e valori plausibili
+DEFAULT_GENERATORS = {
+    'v19': 'sine:35:5:900',  # pressione (Pa, filtro pulito)
+    'v10': 'uniform:1100:1400',  # portata (m³/h)
+    'v26': 'choice:30,50,70,90',  # PWM (%)
+    'v8': 'sine:22:3:3600',  # temperatura (°C)
+    'v4': 'uniform:5:25'  # PM
+}
+
+
+class ValueGenerator:
+    """Valore di un pin in funzione del tempo secondo una specifica kind:parametri"""
+
+    KINDS = ('const', 'uniform', 'sine', 'ramp', 'choice')
+
+    def __init__(self, spec: str, hold: float = 60.0, seed: int = None):
+        kind, _, args = spec.partition(':')
+        if kind not in self.KINDS:
+            raise ValueError(f"Generatore sconosciuto '{kind}' (disponibili: {', '.join(self.KINDS)})")
+        self.kind = kind
+        self.spec = spec
+        self.hold = hold
+        self.started = time.time()
+        self._random = random.Random(seed)
+        try:
+            if kind == 'choice':
+                self.args = [float(value) for value in args.split(',')]
+            else:
+                self.args = [float(value) for value in args.split(':')] if args else []
+        except ValueError:
+            raise ValueError(f"Parametri non numerici nel generatore '{spec}'")
+        expected = {'const': 1, 'uniform': 2, 'sine': 3, 'ramp': 2}.get(kind)
+        if (expected and len(self.args) != expected) or not self.args:
+            raise ValueError(f"Numero di parametri errato nel generatore '{spec}'")
+
+    def value(self, at: float = None) -> float:
+        at = time.time() if at is None else at
+        args = self.args
+        if self.kind == 'const':
+            return args[0]
+        if self.kind == 'uniform':
+            return self._random.uniform(args[0], args[1])
+        if self.kind == 'sine':
+            return args[0] + args[1] * math.sin(2 * math.pi * at / args[2])
+        if self.kind == 'ramp':
+            return args[0] + args[1] * (at - self.started) / 3600
+        # choice: stesso valore per tutta la finestra di hold secondi
+        return random.Random(int(at // self.hold)).choice(args)
+
+
+class FakeBlynkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Header e corpo sono scritti separatamente: senza TCP_NODELAY il client attende l'ACK ritardato
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.count('requests')
+        delay = server.latency + (random.uniform(-server.jitter, server.jitter) if server.jitter else 0.0)
+        if random.random() < server.timeout_rate:
+            # Risposta oltre il timeout del client
+            server.count('timeouts')
+            time.sleep(server.timeout_delay)
+            return self._reply(504, {'error': 'timeout'})
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < server.error_rate:
+            server.count('errors')
+            return self._reply(server.error_status, {'error': {'message': 'emulated failure'}})
+
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query, keep_blank_values=True)
+        token = query.pop('token', [''])[0]
+        if server.token and token != server.token:
+            server.count('invalid_token')
+            return self._reply(400, {'error': {'message': 'Invalid token.'}})
+
+        if parts.path == '/history':
+            return self._history(query)
+        if parts.path != '/external/api/get':
+            return self._reply(404, {'error': {'message': 'not found'}})
+
+        pins = [pin.lower() for pin in query]
+        unknown = [pin for pin in pins if pin not in server.generators]
+        if not pins or unknown:
+            return self._reply(400, {'error': {'message': f"Wrong pin {','.join(unknown)}"}})
+        if len(pins) == 1:
+            return self._reply(200, f"{server.generators[pins[0]].value():.3f}")
+        if not server.batch:
+            return self._reply(400, {'error': {'message': 'multi-pin not supported'}})
+        return self._reply(200, {pin: f"{server.generators[pin].value():.3f}" for pin in pins})
+
+    def _history(self, query: dict):
+        pin = query.get('pin', [''])[0].lower()
+        generator = self.server.generators.get(pin)
+        try:
+            start, end = float(query['start'][0]), float(query['end'][0])
+        except (KeyError, ValueError):
+            return self._reply(400, {'error': {'message': 'start/end required'}})
+        if generator is None:
+            return self._reply(400, {'error': {'message': f"Wrong pin {pin}"}})
+        step = self.server.history_step
+        first = int(start // step + 1) * step
+        points = [[int(ts * 1000), round(generator.value(ts), 3)]
+                  for ts in (first + i * step for i in range(int((end - first) // step) + 1))]
+        return self._reply(200, points)
+
+    def _reply(self, status: int, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeBlynkServer(ThreadingHTTPServer):
+    """Server emulato; le opzioni sono attributi modificabili anche a server avviato"""
+
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, generators: dict = None, latency: float = 0.0,
+                 jitter: float = 0.0, error_rate: float = 0.0, error_status: int = 503, timeout_rate: float = 0.0,
+                 timeout_delay: float = 20.0, batch: bool = True, token: str = '', history_step: float = 1.0,
+                 hold: float = 60.0, seed: int = None):
+        super().__init__((host, port), FakeBlynkHandler)
+        specs = {**DEFAULT_GENERATORS, **(generators or {})}
+        self.generators = {pin.lower(): ValueGenerator(spec, hold, seed) for pin, spec in specs.items()}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.timeout_rate = timeout_rate
+        self.timeout_delay = timeout_delay
+        self.batch = batch
+        self.token = token
+        self.history_step = history_step
+        self.stats = {'requests': 0, 'errors': 0, 'timeouts': 0, 'invalid_token': 0}
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, key: str):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def start(self) -> 'FakeBlynkServer':
+        """Avvia il server in un thread daemon"""
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-blynk', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def parse_generators(items: list) -> dict:
+    """Specifiche --pin v19=sine:200:50:600 -> {pin: spec}"""
+    generators = {}
+    for item in items:
+        pin, separator, spec = item.partition('=')
+        if not separator or not pin or not spec:
+            raise ValueError(f"Formato --pin atteso PIN=SPEC, ricevuto '{item}'")
+        generators[pin.strip().lower()] = spec.strip()
+    return generators
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Server Blynk emulato per test e benchmark")
+    parser.add_argument('--host', default='127.0.0.1', help="Indirizzo di ascolto")
+    parser.add_argument('--port', type=int, default=18080, help="Porta (0 = libera)")
+    parser.add_argument('--pin', dest='pins', action='append', default=[], help="Generatore PIN=SPEC (ripetibile)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Latenza di risposta (s)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Variazione casuale ± della latenza (s)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Frazione di risposte con errore HTTP")
+    parser.add_argument('--error-status', type=int, default=503, help="Stato HTTP delle risposte con errore")
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help="Frazione di risposte oltre il timeout")
+    parser.add_argument('--timeout-delay', type=float, default=20.0, help="Attesa (s) delle risposte in timeout")
+    parser.add_argument('--no-batch', action='store_true', help="Rifiuta le richieste multi-pin")
+    parser.add_argument('--token', default='', help="Token accettato (default: qualsiasi)")
+    parser.add_argument('--history-step', type=float, default=1.0, help="Passo (s) dei punti storico")
+    parser.add_argument('--hold', type=float, default=60.0, help="Durata (s) di un valore dei generatori choice")
+    parser.add_argument('--seed', type=int, default=None, help="Seme dei generatori casuali")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        server = FakeBlynkServer(args.host, args.port, parse_generators(args.pins), args.latency, args.jitter,
+                                 args.error_rate, args.error_status, args.timeout_rate, args.timeout_delay,
+                                 not args.no_batch, args.token, args.history_step, args.hold, args.seed)
+    except (ValueError, OSError) as e:
+        print(f"Errore: {e}", file=sys.stderr)
+        return 2
+
+    print(f"Blynk emulato su {server.url} (pin: {', '.join(sorted(server.generators))})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Richieste servite: {server.stats}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,400 @@
+"""
+Replay offline dei dati storici attraverso PredictiveAlgorithm
+
+Rilegge test_data (database SQLite) o un file esportato (.npz / .csv) alla massima
+velocità, senza attese, ricalcola le metriche con parametri configurabili e
+ricostruisce la timeline degli alert (filter_change_needed, system_anomaly_detected).
+
+Esempi:
+    python replay.py --source /data/test_data.db --set MAX_OBSTRUCTION_CRITICAL=1.8 --report report.json
+    python replay.py --source dataset.npz --params curve_v2.json --output replay.db --table replay_v2
+    python replay.py --source /data/test_data.db --from 2025-10-01 --output replay.npz
+"""
+import os
+import csv
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+# Colonne lette dalla sorgente (ts_epoch, pwm e pressione obbligatorie)
+INPUT_COLUMNS = ('ts_epoch', 'pwm_percentage', 'pressure_measured', 'flow_blynk', 'hours_since_change',
+                 'filter_change_needed', 'system_anomaly_detected')
+REQUIRED_COLUMNS = ('ts_epoch', 'pwm_percentage', 'pressure_measured')
+METRIC_COLUMNS = ('pressure_clean', 'obstruction_index', 'filter_wear_percent', 'filter_efficiency',
+                  'obstruction_trend', 'hours_since_change', 'filter_change_needed', 'system_anomaly_detected',
+                  'predicted_hours_remaining', 'flow_calculated')
+ALERT_COLUMNS = ('filter_change_needed', 'system_anomaly_detected')
+
+
+def _to_epoch(timestamp: str) -> float:
+    try:
+        return datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def iter_sqlite_chunks(path: str, start_epoch: float = None, end_epoch: float = None, chunk_size: int = 10000,
+                       device_id: str = None):
+    """Blocchi di test_data da database SQLite (sola lettura) come dict colonna -> array"""
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        available = {row[1] for row in conn.execute('PRAGMA table_info(test_data)')}
+        columns = [c for c in INPUT_COLUMNS if c in available]
+        legacy = 'ts_epoch' not in available
+        if legacy:
+            # Database mai aperto dalla versione con ts_epoch: ricava epoch dal timestamp ISO
+            columns = ['timestamp'] + columns
+
+        conditions, params = [], []
+        if device_id is not None and 'device_id' in available:
+            # Database flotta: solo le righe del dispositivo richiesto
+            conditions.append('device_id = ?')
+            params.append(device_id)
+        if not legacy and start_epoch is not None:
+            conditions.append('ts_epoch >= ?')
+            params.append(start_epoch)
+        if not legacy and end_epoch is not None:
+            conditions.append('ts_epoch <= ?')
+            params.append(end_epoch)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        order = 'id' if legacy else 'ts_epoch'
+
+        cursor = conn.execute(f"SELECT {', '.join(columns)} FROM test_data {where} ORDER BY {order}", params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            if legacy:
+                rows = [(_to_epoch(row[0]),) + tuple(row[1:]) for row in rows]
+                names = ['ts_epoch'] + columns[1:]
+            else:
+                names = columns
+            block = np.array(rows, dtype=np.float64).reshape(len(rows), len(names))
+            chunk = {name: block[:, index] for index, name in enumerate(names)}
+            if legacy:
+                chunk = _filter_range(chunk, start_epoch, end_epoch)
+            if len(chunk['ts_epoch']):
+                yield chunk
+    finally:
+        conn.close()
+
+
+def iter_npz_chunks(path: str, start_epoch: float = None, end_epoch: float = None, chunk_size: int = 10000):
+    """Blocchi da file .npz esportato (export_data.py / /api/export/npz)"""
+    with np.load(path) as data:
+        columns = {c: data[c] for c in INPUT_COLUMNS if c in data.files}
+    chunk = _filter_range({c: np.asarray(v, dtype=np.float64) for c, v in columns.items()}, start_epoch, end_epoch)
+    total = len(chunk['ts_epoch'])
+    for offset in range(0, total, chunk_size):
+        yield {c: v[offset:offset + chunk_size] for c, v in chunk.items()}
+
+
+def iter_csv_chunks(path: str, start_epoch: float = None, end_epoch: float = None, chunk_size: int = 10000):
+    """Blocchi da CSV esportato (/api/export), anche compresso .gz"""
+    import gzip
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='') as handle:
+        reader = csv.DictReader(handle)
+        columns = [c for c in INPUT_COLUMNS if c in reader.fieldnames]
+        derive_epoch = 'ts_epoch' not in reader.fieldnames
+
+        rows = []
+        for record in reader:
+            values = [_csv_float(record[c]) for c in columns]
+            if derive_epoch:
+                values = [_to_epoch(record.get('timestamp'))] + values
+            rows.append(values)
+            if len(rows) >= chunk_size:
+                chunk = _csv_chunk(rows, columns, derive_epoch, start_epoch, end_epoch)
+                if len(chunk['ts_epoch']):
+                    yield chunk
+                rows = []
+        if rows:
+            chunk = _csv_chunk(rows, columns, derive_epoch, start_epoch, end_epoch)
+            if len(chunk['ts_epoch']):
+                yield chunk
+
+
+def _csv_float(value: str) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _csv_chunk(rows: list, columns: list, derive_epoch: bool, start_epoch, end_epoch) -> dict:
+    names = (['ts_epoch'] if derive_epoch else []) + columns
+    block = np.array(rows, dtype=np.float64).reshape(len(rows), len(names))
+    return _filter_range({name: block[:, index] for index, name in enumerate(names)}, start_epoch, end_epoch)
+
+
+def _filter_range(chunk: dict, start_epoch: float = None, end_epoch: float = None) -> dict:
+    mask = np.ones(len(chunk['ts_epoch']), dtype=bool)
+    if start_epoch is not None:
+        mask &= chunk['ts_epoch'] >= start_epoch
+    if end_epoch is not None:
+        mask &= chunk['ts_epoch'] <= end_epoch
+    if mask.all():
+        return chunk
+    return {c: v[mask] for c, v in chunk.items()}
+
+
+def iter_source_chunks(source: str, start_epoch: float = None, end_epoch: float = None, chunk_size: int = 10000,
+                       device_id: str = None):
+    """Sceglie il lettore in base all'estensione: .npz, .csv/.csv.gz, altrimenti database SQLite (device_id)"""
+    lower = source.lower()
+    if lower.endswith('.npz'):
+        chunks = iter_npz_chunks(source, start_epoch, end_epoch, chunk_size)
+    elif lower.endswith('.csv') or lower.endswith('.csv.gz'):
+        chunks = iter_csv_chunks(source, start_epoch, end_epoch, chunk_size)
+    else:
+        chunks = iter_sqlite_chunks(source, start_epoch, end_epoch, chunk_size, device_id)
+
+    for chunk in chunks:
+        missing = [c for c in REQUIRED_COLUMNS if c not in chunk]
+        if missing:
+            raise ValueError(f"Colonne mancanti nella sorgente: {', '.join(missing)}")
+        yield chunk
+
+
+class NpzReplayWriter:
+    """Metriche ricalcolate in un file .npz (float32, flag bool, ts_epoch float64)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.parts = {c: [] for c in ('ts_epoch',) + METRIC_COLUMNS}
+
+    def write(self, ts_epoch: np.ndarray, metrics: dict):
+        self.parts['ts_epoch'].append(np.asarray(ts_epoch, dtype=np.float64))
+        for column in METRIC_COLUMNS:
+            dtype = np.bool_ if column in ALERT_COLUMNS else np.float32
+            self.parts[column].append(np.asarray(metrics[column], dtype=dtype))
+
+    def close(self):
+        np.savez(self.path, **{c: np.concatenate(v) if v else np.array([]) for c, v in self.parts.items()})
+
+
+class CsvReplayWriter:
+    """Metriche ricalcolate in CSV"""
+
+    def __init__(self, path: str):
+        self.handle = open(path, 'w', newline='')
+        self.writer = csv.writer(self.handle)
+        self.writer.writerow(('ts_epoch',) + METRIC_COLUMNS)
+
+    def write(self, ts_epoch: np.ndarray, metrics: dict):
+        columns = [ts_epoch] + [metrics[c].astype(np.int8) if c in ALERT_COLUMNS else metrics[c]
+                                for c in METRIC_COLUMNS]
+        self.writer.writerows(zip(*(c.tolist() for c in columns)))
+
+    def close(self):
+        self.handle.close()
+
+
+class SqliteReplayWriter:
+    """Metriche ricalcolate in una tabella separata (default replay_metrics), una run per run_id"""
+
+    def __init__(self, path: str, table: str = 'replay_metrics', run_id: str = None):
+        if not table.replace('_', '').isalnum():
+            raise ValueError(f"Nome tabella non valido: {table}")
+        self.table = table
+        self.run_id = run_id or datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        columns = ', '.join(
+            f"{c} {'INTEGER' if c in ALERT_COLUMNS else 'REAL'}" for c in METRIC_COLUMNS
+        )
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (run_id TEXT, ts_epoch REAL, {columns})')
+        self.conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_run ON {table}(run_id, ts_epoch)')
+        self.sql = f"INSERT INTO {table} (run_id, ts_epoch, {', '.join(METRIC_COLUMNS)}) " \
+                   f"VALUES (?, ?, {', '.join('?' for _ in METRIC_COLUMNS)})"
+
+    def write(self, ts_epoch: np.ndarray, metrics: dict):
+        columns = [np.full(len(ts_epoch), self.run_id, dtype=object), ts_epoch] + [
+            metrics[c].astype(np.int8) if c in ALERT_COLUMNS else metrics[c] for c in METRIC_COLUMNS
+        ]
+        self.conn.executemany(self.sql, zip(*(c.tolist() for c in columns)))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def open_writer(path: str, table: str = 'replay_metrics', run_id: str = None):
+    """Writer in base all'estensione del file di output"""
+    lower = path.lower()
+    if lower.endswith('.npz'):
+        return NpzReplayWriter(path)
+    if lower.endswith('.csv'):
+        return CsvReplayWriter(path)
+    return SqliteReplayWriter(path, table, run_id)
+
+
+def run_replay(chunks, algorithm, hours_mode: str = 'recorded', writer=None, max_events: int = 1000) -> dict:
+    """
+    Ricalcola le metriche blocco per blocco e ricostruisce la timeline degli alert
+
+    Args:
+        chunks: Iteratore di dict colonna -> array (vedi iter_source_chunks)
+        algorithm: PredictiveAlgorithm configurato (lo stato trend viene aggiornato)
+        hours_mode: 'recorded' usa hours_since_change salvato, 'integrate' lo integra
+            dai ts_epoch partendo da algorithm.hours_since_change
+        writer: Destinazione opzionale delle metriche ricalcolate
+        max_events: Numero massimo di transizioni riportate per alert
+
+    Returns:
+        Report con conteggi, timeline alert e confronto con gli alert registrati
+    """
+    started = time.perf_counter()
+    rows = 0
+    first_epoch = last_epoch = None
+    previous_state = {alert: False for alert in ALERT_COLUMNS}
+    alerts = {alert: {'samples': 0, 'recorded_samples': 0, 'disagreements': 0, 'first_fired': None, 'events': []}
+              for alert in ALERT_COLUMNS}
+
+    for chunk in chunks:
+        ts_epoch = chunk['ts_epoch']
+        if not len(ts_epoch):
+            continue
+
+        if hours_mode == 'integrate' or 'hours_since_change' not in chunk:
+            previous = last_epoch if last_epoch is not None else ts_epoch[0]
+            elapsed = np.diff(np.concatenate(([previous], ts_epoch)))
+            hours = algorithm.hours_since_change + np.cumsum(np.clip(elapsed, 0, None)) / 3600.0
+            algorithm.hours_since_change = float(hours[-1])
+        else:
+            hours = chunk['hours_since_change']
+
+        metrics = algorithm.calculate_metrics_batch(chunk['pwm_percentage'], chunk['pressure_measured'], hours,
+                                                    update_state=True)
+        if writer is not None:
+            writer.write(ts_epoch, metrics)
+
+        for alert in ALERT_COLUMNS:
+            state = metrics[alert]
+            report = alerts[alert]
+            report['samples'] += int(state.sum())
+            if alert in chunk:
+                recorded = chunk[alert] > 0
+                report['recorded_samples'] += int(recorded.sum())
+                report['disagreements'] += int((recorded != state).sum())
+
+            # Transizioni off->on / on->off, continuando dallo stato del blocco precedente
+            padded = np.concatenate(([previous_state[alert]], state)).astype(np.int8)
+            for index in np.flatnonzero(np.diff(padded)):
+                fired = bool(state[index])
+                if fired and report['first_fired'] is None:
+                    report['first_fired'] = datetime.fromtimestamp(ts_epoch[index]).isoformat()
+                if len(report['events']) < max_events:
+                    report['events'].append({
+                        'timestamp': datetime.fromtimestamp(ts_epoch[index]).isoformat(),
+                        'ts_epoch': float(ts_epoch[index]),
+                        'state': 'on' if fired else 'off',
+                        'obstruction_index': float(metrics['obstruction_index'][index]),
+                        'hours_since_change': float(metrics['hours_since_change'][index])
+                    })
+            previous_state[alert] = bool(state[-1])
+
+        if first_epoch is None:
+            first_epoch = float(ts_epoch[0])
+        last_epoch = float(ts_epoch[-1])
+        rows += len(ts_epoch)
+
+    elapsed = time.perf_counter() - started
+    return {
+        'rows': rows,
+        'elapsed_s': elapsed,
+        'rows_per_s': rows / elapsed if elapsed > 0 else None,
+        'start_time': datetime.fromtimestamp(first_epoch).isoformat() if first_epoch is not None else None,
+        'end_time': datetime.fromtimestamp(last_epoch).isoformat() if last_epoch is not None else None,
+        'alerts': alerts
+    }
+
+
+def parse_params(params_file: str = None, overrides: list = None) -> dict:
+    """Parametri algoritmo da file JSON e da override NOME=VALORE (valore in JSON)"""
+    params = {}
+    if params_file:
+        with open(params_file) as handle:
+            params.update(json.load(handle))
+    for override in overrides or []:
+        name, _, value = override.partition('=')
+        if not value:
+            raise ValueError(f"Override non valido (atteso NOME=VALORE): {override}")
+        try:
+            params[name.strip()] = json.loads(value)
+        except json.JSONDecodeError:
+            params[name.strip()] = value
+    return params
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay offline dati test attraverso PredictiveAlgorithm")
+    parser.add_argument('--source', default=os.environ.get('DB_PATH', '/data/test_data.db'),
+                        help="Database SQLite, file .npz o .csv[.gz]")
+    parser.add_argument('--device', default=os.environ.get('DEVICE_ID', 'default'),
+                        help="Dispositivo della flotta (solo sorgente SQLite)")
+    parser.add_argument('--from', dest='start', help="Inizio intervallo (epoch o ISO)")
+    parser.add_argument('--to', dest='end', help="Fine intervallo (epoch o ISO)")
+    parser.add_argument('--params', help="File JSON con parametri algoritmo")
+    parser.add_argument('--set', dest='overrides', action='append', default=[],
+                        help="Override parametro, es. MAX_OBSTRUCTION_CRITICAL=1.8 (ripetibile)")
+    parser.add_argument('--hours', choices=['recorded', 'integrate'], default='recorded',
+                        help="Ore filtro: valori registrati o integrate dai timestamp")
+    parser.add_argument('--output', help="Metriche ricalcolate: .npz, .csv o database SQLite")
+    parser.add_argument('--table', default='replay_metrics', help="Tabella di output (database SQLite)")
+    parser.add_argument('--run-id', help="Identificativo run nella tabella di output")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="Righe per blocco")
+    parser.add_argument('--report', help="File JSON per il report (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def parse_time(value: str):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    from app import PredictiveAlgorithm
+
+    try:
+        params = parse_params(args.params, args.overrides)
+        algorithm = PredictiveAlgorithm().configure(**params)
+    except ValueError as e:
+        print(f"Errore: {e}", file=sys.stderr)
+        return 2
+
+    chunks = iter_source_chunks(args.source, parse_time(args.start), parse_time(args.end), args.chunk_size,
+                                args.device)
+    writer = open_writer(args.output, args.table, args.run_id) if args.output else None
+    try:
+        report = run_replay(chunks, algorithm, args.hours, writer)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    report['params'] = params
+    text = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, 'w') as handle:
+            handle.write(text)
+        print(f"Replay: {report['rows']} righe in {report['elapsed_s']:.2f}s, report in {args.report}")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+Avvio di produzione multi-processo: un solo campionatore e più worker API
+
+Il campionatore (APP_ROLE=sampler, server Flask in ascolto solo in locale) è l'unico
+processo che legge Blynk, calcola le metriche e scrive su SQLite. I worker gunicorn
+(APP_ROLE=api) servono dashboard, storico, analisi ed export leggendo il database in
+parallelo su più core, e inoltrano al campionatore stato live, stream SSE e comandi
+(start/stop/reset_filter, calibrazione). I worker partono solo quando il campionatore
+accetta connessioni, cioè dopo che ha creato o migrato lo schema del database. Se uno dei
+due processi termina viene fermato anche l'altro, così il riavvio del container riparte da
+uno stato coerente.
+
+Esempi:
+    python serve.py
+    python serve.py --workers 4 --threads 16 --port 80 --sampler-port 8081
+"""
+import os
+import sys
+import time
+import socket
+import signal
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Campionatore unico + worker API gunicorn")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_WORKERS', '0')) or os.cpu_count() or 1,
+                        help="Processi worker API (default: WEB_WORKERS o numero di core)")
+    parser.add_argument('--threads', type=int, default=16,
+                        help="Thread per worker (ogni client /api/stream ne occupa uno)")
+    parser.add_argument('--host', default='0.0.0.0', help="Indirizzo di ascolto delle API")
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', '80')), help="Porta delle API")
+    parser.add_argument('--sampler-port', type=int, default=8081, help="Porta locale del campionatore")
+    parser.add_argument('--startup-timeout', type=float, default=120.0,
+                        help="Attesa massima (s) del campionatore prima di avviare i worker")
+    return parser.parse_args(argv)
+
+
+def wait_for_sampler(process: subprocess.Popen, port: int, timeout: float) -> bool:
+    """Attende che il campionatore accetti connessioni; False se termina o scade il timeout"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1.0):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sampler_env = {**os.environ, 'APP_ROLE': 'sampler', 'HOST': '127.0.0.1', 'PORT': str(args.sampler_port)}
+    api_env = {**os.environ, 'APP_ROLE': 'api', 'SAMPLER_URL': f'http://127.0.0.1:{args.sampler_port}'}
+
+    processes = {
+        'campionatore': subprocess.Popen([sys.executable, os.path.join(HERE, 'app.py')], env=sampler_env, cwd=HERE)
+    }
+    stopping = []
+
+    def terminate(signum=None, frame=None):
+        stopping.append(signum)
+        for process in processes.values():
+            if process.poll() is None:
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    exit_code = 0
+    try:
+        # I worker aprono il database in sola lettura: lo schema deve esistere prima di loro
+        sampler = processes['campionatore']
+        if not wait_for_sampler(sampler, args.sampler_port, args.startup_timeout):
+            if stopping:
+                return 0
+            if sampler.poll() is not None:
+                print(f"Processo campionatore terminato all'avvio (codice {sampler.returncode})", file=sys.stderr)
+                return sampler.returncode or 1
+            print(f"Campionatore non in ascolto su 127.0.0.1:{args.sampler_port} "
+                  f"entro {args.startup_timeout:.0f} s", file=sys.stderr)
+            return 1
+        processes['worker API'] = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--workers', str(args.workers),
+                                                    '--worker-class', 'gthread', '--threads', str(args.threads),
+                                                    '--bind', f'{args.host}:{args.port}', 'app:create_app()'],
+                                                   env=api_env, cwd=HERE)
+        print(f"Campionatore su 127.0.0.1:{args.sampler_port}, {args.workers} worker API su {args.host}:{args.port}")
+
+        while all(process.poll() is None for process in processes.values()):
+            time.sleep(0.5)
+        if not stopping:
+            for name, process in processes.items():
+                if process.poll() is not None:
+                    exit_code = exit_code or process.returncode or 1
+                    print(f"Processo {name} terminato (codice {process.returncode})", file=sys.stderr)
+    finally:
+        terminate()
+        for process in processes.values():
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+"""
+Generatore di serie sintetiche di degrado filtri per dataset ML su scala flotta
+
+Simula per ogni dispositivo PWM a fasce orarie, intasamento progressivo del filtro
+fino al cambio, rumore dei sensori, guasti e interruzioni Blynk. Il punto di lavoro
+(portata e pressione) è l'incrocio tra la curva ventole scalata per il PWM e la curva
+del filtro moltiplicata per l'ostruzione, con le curve e il mapping PWM di
+PredictiveAlgorithm; le metriche sono poi calcolate da calculate_metrics_batch come
+nell'app. Ogni dispositivo è generato in modo vettoriale da un processo del pool.
+
+Uscite:
+    database SQLite  righe in test_data (con rollup) come dal campionatore, per device_id
+    file .npz        un array per colonna più le etichette di verità: ostruzione reale,
+                     ore al cambio filtro, indice filtro, anomalia iniettata, interruzione;
+                     più dispositivi nello stesso file sono distinti da device_index
+
+Esempi:
+    python simulate.py --devices 50 --days 14 --interval 30 --output synthetic.npz
+    python simulate.py --devices 5 --days 90 --output /data/test_data.db --prefix sim
+    python simulate.py --devices 200 --days 30 --workers 8 --seed 7 --set PRESSURE_OFFSET=15 -o fleet.npz
+"""
+import os
+import sys
+import time
+import zipfile
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+import replay
+
+# Iterazioni di bisezione per il punto di lavoro (errore < portata massima / 2^40)
+BISECTION_STEPS = 40
+
+# Colonne sensore prodotte (NaN durante interruzioni e letture perse, come nell'app)
+SENSOR_COLUMNS = ('pwm_percentage', 'pressure_measured', 'flow_blynk', 'temperature', 'pm_value')
+
+# Etichette di verità (solo nei file colonnari)
+LABEL_COLUMNS = ('obstruction_true', 'flow_true', 'hours_to_change', 'filter_index', 'injected_anomaly', 'outage')
+
+DEFAULTS = {
+    'interval': 30.0,  # secondi tra campioni
+    'filter_life_hours': 1500.0,  # ore medie per arrivare all'ostruzione di cambio
+    'life_spread': 0.3,  # dispersione log-normale della durata filtro
+    'change_obstruction': (1.8, 2.3),  # ostruzione alla sostituzione (ritardi di manutenzione)
+    'clog_exponent': (1.3, 2.2),  # forma della curva di intasamento (accelera verso fine vita)
+    'pwm_hold_minutes': 45.0,  # durata media di un livello PWM
+    'day_pwm': (50, 100),  # PWM nelle ore diurne (8-20)
+    'night_pwm': (30, 60),  # PWM nelle ore notturne
+    'off_probability': 0.03,  # probabilità che un livello sia ventole spente
+    'pressure_noise': 1.5,  # Pa
+    'flow_noise': 0.03,  # relativo
+    'flow_gain_spread': 0.05,  # errore di guadagno del flussimetro per dispositivo
+    'spike_rate': 0.0005,  # probabilità per campione di picco di pressione (guasto sensore)
+    'dropout_rate': 0.002,  # probabilità per pin e campione di lettura persa
+    'outages_per_day': 0.3,  # interruzioni Blynk (tutti i pin) al giorno
+    'outage_minutes': 20.0,  # durata media interruzione
+}
+
+
+def operating_point(algorithm, pwm: np.ndarray, obstruction: np.ndarray) -> tuple:
+    """
+    (portata, pressione filtro) all'incrocio tra curva ventole scalata e filtro ostruito
+
+    Risolve p_ventole(Q) - PRESSURE_OFFSET = ostruzione × p_filtro(Q) per bisezione
+    vettoriale; a ventole ferme portata e pressione sono nulle.
+    """
+    scale = algorithm.convert_blynk_pwm_to_real_speed_batch(pwm) / 100.0
+    running = scale > 0
+    scale = np.where(running, scale, 1.0)
+    fan_flow = np.asarray(algorithm.fan_flow_total, dtype=np.float64)
+    fan_pressure = np.asarray(algorithm.fan_pressure, dtype=np.float64)
+    filter_flow = np.asarray(algorithm.filter_flow, dtype=np.float64)
+    filter_pressure = np.asarray(algorithm.filter_pressure, dtype=np.float64)
+    offset = float(algorithm.PRESSURE_OFFSET)
+
+    low = np.zeros_like(scale)
+    high = scale * fan_flow[-1]
+    for _ in range(BISECTION_STEPS):
+        middle = (low + high) / 2
+        excess = (scale * scale * np.interp(middle / scale, fan_flow, fan_pressure) - offset
+                  - obstruction * np.interp(middle, filter_flow, filter_pressure))
+        low = np.where(excess > 0, middle, low)
+        high = np.where(excess > 0, high, middle)
+
+    # Pressione dal lato ventole: all'equilibrio coincide col filtro, in stallo (portata nulla) è la prevalenza
+    flow = np.where(running, (low + high) / 2, 0.0)
+    pressure = np.where(running, scale * scale * np.interp(flow / scale, fan_flow, fan_pressure) - offset, 0.0)
+    return flow, np.maximum(pressure, 0.0)
+
+
+def pwm_schedule(rng: np.random.Generator, hours: np.ndarray, hour_of_day: np.ndarray, config: dict) -> np.ndarray:
+    """Livelli PWM interi a tratti: durate esponenziali, fasce diurne/notturne, spegnimenti"""
+    hold = config['pwm_hold_minutes'] / 60
+    changes = np.cumsum(rng.exponential(hold, size=int(hours[-1] / hold * 1.5) + 16))
+    while changes[-1] < hours[-1]:
+        changes = np.concatenate((changes, changes[-1] + np.cumsum(rng.exponential(hold, size=len(changes)))))
+    segment = np.searchsorted(changes, hours)
+    day_levels = rng.integers(config['day_pwm'][0], config['day_pwm'][1] + 1, size=len(changes) + 1)
+    night_levels = rng.integers(config['night_pwm'][0], config['night_pwm'][1] + 1, size=len(changes) + 1)
+    off = rng.random(len(changes) + 1) < config['off_probability']
+    daytime = (hour_of_day >= 8) & (hour_of_day < 20)
+    levels = np.where(daytime, day_levels[segment], night_levels[segment])
+    return np.where(off[segment], 0, levels).astype(np.float64)
+
+
+def filter_lifecycle(rng: np.random.Generator, hours: np.ndarray, config: dict) -> dict:
+    """Ostruzione reale per campione: filtri successivi, ognuno intasato fino alla sostituzione"""
+    mean_life = config['filter_life_hours']
+    count = int(hours[-1] / mean_life * 2) + 4
+    lives = mean_life * rng.lognormal(-config['life_spread'] ** 2 / 2, config['life_spread'], size=count)
+    ends = rng.uniform(*config['change_obstruction'], size=count)
+    exponents = rng.uniform(*config['clog_exponent'], size=count)
+    # Il primo filtro è già in uso da una frazione casuale della sua vita
+    installed = np.concatenate(([-rng.uniform(0, 0.9) * lives[0]], -rng.uniform(0, 0.9) * lives[0] + np.cumsum(lives)))
+    index = np.searchsorted(installed, hours, side='right') - 1
+    age = hours - installed[index]
+    obstruction = 1.0 + (ends[index] - 1.0) * (age / lives[index]) ** exponents[index]
+    return {
+        'obstruction_true': obstruction,
+        'hours_since_change': age,
+        'hours_to_change': installed[index + 1] - hours,
+        'filter_index': index.astype(np.int32),
+    }
+
+
+def simulate_device(task: dict) -> dict:
+    """Serie completa di un dispositivo (colonne test_data + etichette), generata in modo vettoriale"""
+    from app import PredictiveAlgorithm
+
+    config = {**DEFAULTS, **task.get('config', {})}
+    rng = np.random.default_rng(task['seed'])
+    algorithm = PredictiveAlgorithm().configure(**task.get('params', {}))
+
+    interval = float(config['interval'])
+    count = int(task['hours'] * 3600 // interval)
+    ts_epoch = task['start'] + rng.uniform(0, interval) + np.arange(count) * interval
+    hours = (ts_epoch - ts_epoch[0]) / 3600
+    hour_of_day = ((ts_epoch - time.timezone) % 86400) / 3600
+
+    columns = filter_lifecycle(rng, hours, config)
+    columns['ts_epoch'] = ts_epoch
+    pwm = pwm_schedule(rng, hours, hour_of_day, config)
+    flow, pressure = operating_point(algorithm, pwm, columns['obstruction_true'])
+    columns['flow_true'] = flow
+
+    # Sensori: rumore, guadagno del flussimetro per dispositivo, picchi di pressione
+    spikes = rng.random(count) < config['spike_rate']
+    pressure = pressure + rng.normal(0, config['pressure_noise'], count)
+    pressure = np.maximum(0.0, np.where(spikes, pressure + rng.uniform(150, 400, count), pressure))
+    gain = 1.0 + rng.normal(0, config['flow_gain_spread'])
+    flow_blynk = np.maximum(0.0, flow * gain * (1.0 + rng.normal(0, config['flow_noise'], count)))
+    temperature = 21 + 4 * np.sin(2 * np.pi * (hour_of_day - 9) / 24) + rng.normal(rng.normal(0, 1.5), 0.3, count)
+    pm_value = rng.lognormal(np.log(12), 0.4, count)
+    sensors = dict(zip(SENSOR_COLUMNS, (pwm, pressure, flow_blynk, temperature, pm_value)))
+
+    # Interruzioni (tutti i pin mancanti) e letture perse per singolo pin
+    outage = np.zeros(count, dtype=bool)
+    days = count * interval / 86400
+    for start in rng.uniform(0, count, size=rng.poisson(config['outages_per_day'] * days)).astype(np.int64):
+        outage[start:start + int(rng.exponential(config['outage_minutes']) * 60 / interval) + 1] = True
+    for name, values in sensors.items():
+        lost = outage | (rng.random(count) < config['dropout_rate'])
+        columns[name] = np.where(lost, np.nan, values)
+    columns['outage'] = outage
+    columns['injected_anomaly'] = spikes & ~outage
+
+    # Metriche come nell'app, con il timer filtro del campione (storico ostruzione continuo)
+    metrics = algorithm.calculate_metrics_batch(columns['pwm_percentage'], columns['pressure_measured'],
+                                                columns['hours_since_change'], update_state=True)
+    columns.update(metrics)
+    return {'device_id': task['device_id'], 'columns': columns}
+
+
+def build_tasks(args, params: dict) -> list:
+    start = replay.parse_time(args.start) if args.start else time.time() - args.days * 86400
+    config = {'interval': args.interval, 'filter_life_hours': args.filter_life}
+    return [{'device_id': f'{args.prefix}-{index:04d}', 'seed': args.seed * 100003 + index, 'start': start,
+             'hours': args.days * 24, 'params': params, 'config': config}
+            for index in range(args.devices)]
+
+
+def write_npz(path: str, results: list, compress: bool = False) -> int:
+    """Un array per colonna (dispositivi concatenati, device_index) più l'elenco device_ids"""
+    results = sorted(results, key=lambda result: result['device_id'])
+    names = list(results[0]['columns'])
+    total = sum(len(result['columns']['ts_epoch']) for result in results)
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp_dir, \
+            zipfile.ZipFile(path, 'w', compression=compression, allowZip64=True) as archive:
+        # Una colonna alla volta su file .npy: memoria limitata a una colonna della flotta
+        arrays = {'device_index': np.concatenate([np.full(len(result['columns']['ts_epoch']), index, dtype=np.int32)
+                                                  for index, result in enumerate(results)]),
+                  'device_ids': np.array([result['device_id'] for result in results])}
+        for name in names:
+            arrays[name] = None
+        for name in arrays:
+            values = arrays[name]
+            if values is None:
+                values = np.concatenate([result['columns'][name] for result in results])
+                if values.dtype == np.float64 and name != 'ts_epoch':
+                    values = values.astype(np.float32)
+            file_path = os.path.join(tmp_dir, f'{name}.npy')
+            np.save(file_path, values)
+            archive.write(file_path, arcname=f'{name}.npy')
+            os.remove(file_path)
+    return total
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generatore dati sintetici di degrado filtri per la flotta")
+    parser.add_argument('--devices', type=int, default=10, help="Dispositivi simulati")
+    parser.add_argument('--days', type=float, default=14.0, help="Giorni simulati per dispositivo")
+    parser.add_argument('--interval', type=float, default=30.0, help="Secondi tra campioni")
+    parser.add_argument('--from', dest='start', help="Inizio simulazione (epoch o ISO, default: ora - giorni)")
+    parser.add_argument('--filter-life', type=float, default=DEFAULTS['filter_life_hours'],
+                        help="Ore medie di vita filtro fino al cambio")
+    parser.add_argument('--params', help="File JSON con parametri PredictiveAlgorithm")
+    parser.add_argument('--set', dest='overrides', action='append', default=[],
+                        help="Parametro algoritmo NOME=VALORE (ripetibile)")
+    parser.add_argument('--prefix', default='sim', help="Prefisso device_id (sim-0000, sim-0001, ...)")
+    parser.add_argument('--seed', type=int, default=0, help="Seme: stessa flotta a parità di argomenti")
+    parser.add_argument('--workers', type=int, default=None, help="Processi (default: tutti i core)")
+    parser.add_argument('--compress', action='store_true', help="npz compresso (ZIP deflate)")
+    parser.add_argument('-o', '--output', required=True, help="File .npz o database SQLite (test_data)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    columnar = args.output.lower().endswith('.npz')
+
+    import app
+
+    try:
+        params = replay.parse_params(args.params, args.overrides)
+        app.PredictiveAlgorithm().configure(**params)
+        if args.devices < 1 or args.days <= 0 or args.interval <= 0:
+            raise ValueError("--devices, --days e --interval devono essere positivi")
+    except ValueError as e:
+        print(f"Errore: {e}", file=sys.stderr)
+        return 2
+
+    tasks = build_tasks(args, params)
+    workers = max(1, min(args.workers or os.cpu_count() or 1, len(tasks)))
+    print(f"Simulazione: {len(tasks)} dispositivi × {args.days:g} giorni ogni {args.interval:g}s "
+          f"({workers} processi)")
+    started = time.perf_counter()
+    database = None if columnar else app.TestDatabase(args.output)
+    results, total = [], 0
+    with multiprocessing.Pool(workers) as pool:
+        # I dispositivi pronti vengono scritti mentre gli altri sono ancora in generazione
+        for result in pool.imap_unordered(simulate_device, tasks):
+            rows = len(result['columns']['ts_epoch'])
+            if columnar:
+                results.append(result)
+            else:
+                database.save_columns(result['columns'], result['device_id'])
+            total += rows
+            print(f"  {result['device_id']}: {rows} campioni, "
+                  f"{int(result['columns']['filter_index'].max() - result['columns']['filter_index'].min()) + 1} filtri")
+
+    if columnar:
+        write_npz(args.output, results, args.compress)
+    elapsed = time.perf_counter() - started
+    print(f"{total} campioni in {elapsed:.1f}s ({total / elapsed:,.0f} campioni/s) -> {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
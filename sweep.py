@@ -0,0 +1,231 @@
+"""
+Sweep parallelo dei parametri di PredictiveAlgorithm sui dati registrati
+
+Valuta ogni combinazione di una griglia di parametri (soglie ostruzione,
+PRESSURE_OFFSET, mapping PWM, curve ventole/filtri) sull'intero storico usando
+tutti i core. Lo storico viene caricato una volta in memoria condivisa e letto
+dai worker senza copie né pickling per task; ogni task riceve solo i parametri.
+I risultati sono ordinati per errore di portata rispetto a flow_blynk e per
+stabilità degli alert (numero di transizioni on/off).
+
+Esempi:
+    python sweep.py --source /data/test_data.db --grid grid.json --output sweep.json
+    python sweep.py --source dataset.npz --set PRESSURE_OFFSET=[0,10,20,30] --set MAX_FAN_SPEED_PWM=[140,153,165]
+
+grid.json:
+    {"PRESSURE_OFFSET": [0, 15, 25], "MAX_OBSTRUCTION_CRITICAL": [1.8, 2.0],
+     "fan_pressure": [[450, 320, 240, 180, 120, 70, 20], [480, 340, 250, 185, 125, 72, 22]]}
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import replay
+
+# Colonne storico necessarie alla valutazione
+HISTORY_COLUMNS = ('ts_epoch', 'pwm_percentage', 'pressure_measured', 'flow_blynk', 'hours_since_change')
+
+# Minimo flow_blynk considerato una misura valida per l'errore di portata
+MIN_VALID_FLOW = 0.1
+
+RANK_KEYS = {
+    'mae': lambda r: (r['flow_mae'], r['alert_transitions']),
+    'rmse': lambda r: (r['flow_rmse'], r['alert_transitions']),
+    'stability': lambda r: (r['alert_transitions'], r['flow_mae']),
+}
+
+# Storico visto dal worker (viste NumPy sulla memoria condivisa)
+_history = None
+_shared_blocks = []
+
+
+def load_history(source: str, start_epoch: float = None, end_epoch: float = None, device_id: str = None) -> dict:
+    """Carica lo storico completo (db, .npz o .csv) come dict colonna -> array float64"""
+    parts = {column: [] for column in HISTORY_COLUMNS}
+    for chunk in replay.iter_source_chunks(source, start_epoch, end_epoch, device_id=device_id):
+        for column in HISTORY_COLUMNS:
+            if column in chunk:
+                parts[column].append(chunk[column])
+    history = {column: np.concatenate(values) for column, values in parts.items() if values}
+    if 'flow_blynk' not in history:
+        raise ValueError("La sorgente non contiene flow_blynk: impossibile valutare l'errore di portata")
+    return history
+
+
+def share_history(history: dict) -> tuple:
+    """Copia lo storico in blocchi di memoria condivisa; ritorna (blocchi, descrittori per i worker)"""
+    blocks, layout = [], {}
+    for column, values in history.items():
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=np.float64, buffer=block.buf)[:] = values
+        blocks.append(block)
+        layout[column] = (block.name, values.shape)
+    return blocks, layout
+
+
+def init_worker(layout: dict):
+    """Initializer del pool: aggancia lo storico condiviso una sola volta per processo"""
+    global _history
+    _history = {}
+    for column, (name, shape) in layout.items():
+        block = shared_memory.SharedMemory(name=name)
+        _shared_blocks.append(block)
+        view = np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+        view.flags.writeable = False
+        _history[column] = view
+
+
+def count_transitions(state: np.ndarray) -> int:
+    """Numero di cambi on/off di un alert (partendo da off)"""
+    padded = np.concatenate(([False], state)).astype(np.int8)
+    return int(np.count_nonzero(np.diff(padded)))
+
+
+def evaluate(params: dict, history: dict = None) -> dict:
+    """Valuta una combinazione di parametri sull'intero storico"""
+    from app import PredictiveAlgorithm
+
+    history = history if history is not None else _history
+    result = {'params': params}
+    try:
+        algorithm = PredictiveAlgorithm().configure(**params)
+    except ValueError as e:
+        result['error'] = str(e)
+        return result
+
+    hours = history.get('hours_since_change')
+    metrics = algorithm.calculate_metrics_batch(history['pwm_percentage'], history['pressure_measured'], hours)
+
+    flow_blynk = history['flow_blynk']
+    # Campioni con letture mancanti (NaN) esclusi dall'errore
+    valid = (flow_blynk > MIN_VALID_FLOW) & ~np.isnan(metrics['flow_calculated'])
+    error = metrics['flow_calculated'][valid] - flow_blynk[valid]
+    samples = int(valid.sum())
+
+    result.update({
+        'flow_samples': samples,
+        'flow_mae': float(np.mean(np.abs(error))) if samples else float('inf'),
+        'flow_rmse': float(np.sqrt(np.mean(error ** 2))) if samples else float('inf'),
+        'flow_bias': float(np.mean(error)) if samples else 0.0,
+        'flow_mape': float(np.mean(np.abs(error) / flow_blynk[valid]) * 100) if samples else float('inf'),
+        'alerts': {}
+    })
+
+    transitions = 0
+    for alert in replay.ALERT_COLUMNS:
+        state = metrics[alert]
+        alert_transitions = count_transitions(state)
+        transitions += alert_transitions
+        fired = np.flatnonzero(state)
+        result['alerts'][alert] = {
+            'samples': int(state.sum()),
+            'transitions': alert_transitions,
+            'first_fired_epoch': float(history['ts_epoch'][fired[0]]) if len(fired) else None
+        }
+    result['alert_transitions'] = transitions
+    return result
+
+
+def build_grid(grid: dict) -> list:
+    """Prodotto cartesiano della griglia {parametro: [valori]}"""
+    if not grid:
+        return [{}]
+    names = list(grid)
+    for name in names:
+        if not isinstance(grid[name], list) or not grid[name]:
+            raise ValueError(f"La griglia per {name} deve essere una lista non vuota di valori")
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def run_sweep(history: dict, combinations: list, workers: int = None, rank_by: str = 'mae') -> list:
+    """Valuta tutte le combinazioni in parallelo e le ordina secondo rank_by"""
+    workers = max(1, min(workers or os.cpu_count() or 1, len(combinations)))
+
+    if workers == 1:
+        results = [evaluate(params, history) for params in combinations]
+    else:
+        blocks, layout = share_history(history)
+        try:
+            with multiprocessing.Pool(workers, initializer=init_worker, initargs=(layout,)) as pool:
+                chunksize = max(1, len(combinations) // (workers * 4))
+                results = pool.map(evaluate, combinations, chunksize=chunksize)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    valid = [r for r in results if 'error' not in r]
+    failed = [r for r in results if 'error' in r]
+    valid.sort(key=RANK_KEYS[rank_by])
+    for rank, result in enumerate(valid, 1):
+        result['rank'] = rank
+    return valid + failed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep parallelo parametri algoritmo sui dati registrati")
+    parser.add_argument('--source', default=os.environ.get('DB_PATH', '/data/test_data.db'),
+                        help="Database SQLite, file .npz o .csv[.gz]")
+    parser.add_argument('--device', default=os.environ.get('DEVICE_ID', 'default'),
+                        help="Dispositivo della flotta (solo sorgente SQLite)")
+    parser.add_argument('--from', dest='start', help="Inizio intervallo (epoch o ISO)")
+    parser.add_argument('--to', dest='end', help="Fine intervallo (epoch o ISO)")
+    parser.add_argument('--grid', help="File JSON {parametro: [valori]}")
+    parser.add_argument('--set', dest='overrides', action='append', default=[],
+                        help="Valori di un parametro, es. PRESSURE_OFFSET=[0,10,20] (ripetibile)")
+    parser.add_argument('--workers', type=int, default=None, help="Processi (default: tutti i core)")
+    parser.add_argument('--rank-by', choices=sorted(RANK_KEYS), default='mae', help="Criterio ordinamento")
+    parser.add_argument('--top', type=int, default=10, help="Combinazioni mostrate a video")
+    parser.add_argument('--output', help="File JSON con tutti i risultati")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    try:
+        grid = replay.parse_params(args.grid, args.overrides)
+        grid = {name: values if isinstance(values, list) else [values] for name, values in grid.items()}
+        from app import PredictiveAlgorithm
+        unknown = [name for name in grid if name not in PredictiveAlgorithm.TUNABLE_PARAMS]
+        if unknown:
+            raise ValueError(f"Parametri algoritmo sconosciuti: {', '.join(unknown)}")
+        combinations = build_grid(grid)
+        history = load_history(args.source, replay.parse_time(args.start), replay.parse_time(args.end),
+                               args.device)
+    except ValueError as e:
+        print(f"Errore: {e}", file=sys.stderr)
+        return 2
+
+    rows = len(history['ts_epoch'])
+    print(f"Sweep: {len(combinations)} combinazioni su {rows} campioni")
+    started = time.perf_counter()
+    results = run_sweep(history, combinations, args.workers, args.rank_by)
+    elapsed = time.perf_counter() - started
+    print(f"Completato in {elapsed:.1f}s ({len(combinations) / elapsed:.1f} combinazioni/s)")
+
+    for result in results[:args.top]:
+        if 'error' in result:
+            print(f"  ERRORE {result['params']}: {result['error']}")
+            continue
+        print(f"  #{result['rank']:<3} MAE {result['flow_mae']:8.1f}  RMSE {result['flow_rmse']:8.1f}  "
+              f"bias {result['flow_bias']:+8.1f}  transizioni {result['alert_transitions']:5d}  {result['params']}")
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump({'rows': rows, 'elapsed_s': elapsed, 'rank_by': args.rank_by, 'results': results},
+                      handle, indent=2, default=lambda value: np.asarray(value).tolist())
+        print(f"Risultati in {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
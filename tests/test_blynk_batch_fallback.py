@@ -0,0 +1,125 @@
+"""
+Ripiego da lettura multi-pin a richieste per pin contro il Blynk emulato (fake_blynk --no-batch)
+
+Esecuzione: python -m pytest -q tests
+"""
+import os
+import sys
+import math
+import time
+import logging
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_blynk import FakeBlynkServer  # noqa: E402
+
+# app legge la configurazione all'import: database temporaneo, niente Blynk reale
+os.environ.update({
+    'DB_PATH': os.path.join(tempfile.mkdtemp(prefix='test-app-'), 'test_data.db'),
+    'BLYNK_SERVER': 'http://127.0.0.1:9',
+    'BLYNK_TOKEN': 'test',
+    'DEBUG_MODE': 'false',
+    'BLYNK_RATE_LIMIT': '0',
+    'FLEET_CONFIG': '',
+    'PROFILER_HZ': '0',
+    'APP_ROLE': 'all'
+})
+logging.basicConfig(level=logging.WARNING)
+import app  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    server = FakeBlynkServer(generators={'v19': 'const:42', 'v10': 'const:1200', 'v26': 'const:70',
+                                         'v8': 'const:22', 'v4': 'const:10'}, batch=False).start()
+    yield server
+    server.stop()
+
+
+def make_client(server, mode='batch'):
+    urls = app.build_blynk_urls('test', server.url)
+    return app.BlynkDirectClient(urls, mode, 5, name=f'test-{mode}')
+
+
+def test_batch_rejected_falls_back_to_concurrent(server):
+    client = make_client(server)
+    snapshot = client.get_pins_snapshot(app.SAMPLING_PINS)
+
+    assert snapshot.missing == []
+    assert snapshot.values['pressure'] == 42
+    assert snapshot.values['flow'] == 1200
+    assert snapshot.values['pwm'] == 70
+    assert client.batch_supported is False
+    # Una richiesta multi-pin rifiutata più una per pin
+    assert server.stats['requests'] == 1 + len(app.SAMPLING_PINS)
+
+
+def test_batch_not_retried_after_rejection(server):
+    client = make_client(server)
+    client.get_pins_snapshot(app.SAMPLING_PINS)
+    before = server.stats['requests']
+
+    snapshot = client.get_pins_snapshot(app.SAMPLING_PINS)
+
+    assert snapshot.missing == []
+    assert server.stats['requests'] - before == len(app.SAMPLING_PINS)
+
+
+def test_batch_reprobed_after_cooldown(server):
+    client = make_client(server)
+    client.batch_cooldown = 0.05
+    client.get_pins_snapshot(app.SAMPLING_PINS)
+    assert client.batch_supported is False
+
+    # Il server torna ad accettare richieste multi-pin (es. token rinnovato): dopo il cooldown si riprova
+    server.batch = True
+    time.sleep(0.06)
+    before = server.stats['requests']
+    snapshot = client.get_pins_snapshot(app.SAMPLING_PINS)
+
+    assert snapshot.missing == []
+    assert client.batch_supported is True
+    assert server.stats['requests'] - before == 1
+    assert client.breaker('batch').state == 'closed'
+
+
+def test_repeated_rejections_back_off(server):
+    client = make_client(server)
+    client.batch_cooldown = 0.05
+    for _ in range(app.BLYNK_BREAKER_THRESHOLD + 1):
+        client._batch_retry_at = 0.0
+        snapshot = client.get_pins_snapshot(app.SAMPLING_PINS)
+        # Mai letture NaN per circuito batch aperto: i rifiuti ripiegano sempre su concurrent
+        assert snapshot.missing == []
+
+    remaining = client._batch_retry_at - time.monotonic()
+    assert remaining > 0.05 * 2 ** (app.BLYNK_BREAKER_THRESHOLD - 1)
+
+
+def test_batch_used_when_supported(server):
+    server.batch = True
+    client = make_client(server)
+
+    snapshot = client.get_pins_snapshot(app.SAMPLING_PINS)
+
+    assert snapshot.missing == []
+    assert client.batch_supported is True
+    assert server.stats['requests'] == 1
+
+
+def test_server_error_keeps_nan_snapshot(server):
+    server.batch = True
+    server.error_rate = 1.0
+    server.error_status = 500
+    client = make_client(server)
+    client.retry_policy = app.RetryPolicy(0, 0)
+
+    snapshot = client.get_pins_snapshot(app.SAMPLING_PINS)
+
+    assert sorted(snapshot.missing) == sorted(app.SAMPLING_PINS)
+    assert all(math.isnan(value) for value in snapshot.values.values())
+    assert client.batch_supported is True
@@ -0,0 +1,74 @@
+"""
+calculate_metrics_batch deve coincidere esattamente con chiamate successive di calculate_metrics
+
+Esecuzione: python -m pytest -q tests
+"""
+import os
+import sys
+import math
+from dataclasses import fields
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def make_samples(count: int = 400, seed: int = 0):
+    """PWM interi e non, estremi 0/100, pressioni plausibili e fuori range, NaN sparsi, ore crescenti"""
+    rng = np.random.default_rng(seed)
+    pwm = rng.choice([0.0, 1.0, 30.0, 50.0, 70.0, 90.0, 100.0], count)
+    fractional = rng.random(count) < 0.2
+    pwm[fractional] = rng.uniform(0, 100, fractional.sum()).round(2)
+    pressure = rng.uniform(20, 120, count)
+    pressure[::37] = 600.0
+    pressure[::41] = -5.0
+    pwm[::23] = np.nan
+    pressure[::29] = np.nan
+    hours = np.linspace(0, 2500, count)
+    return pwm, pressure, hours
+
+
+def scalar_results(algorithm, pwm, pressure, hours) -> dict:
+    columns = {f.name: [] for f in fields(app.CalculatedMetrics)}
+    for pwm_value, pressure_value, hours_value in zip(pwm, pressure, hours):
+        algorithm.hours_since_change = float(hours_value)
+        metrics = algorithm.calculate_metrics(app.SystemData(
+            timestamp='2025-01-01T00:00:00', pwm_percentage=float(pwm_value),
+            pressure_measured=float(pressure_value), flow_blynk=math.nan, temperature=math.nan, pm_value=math.nan
+        ))
+        for name in columns:
+            columns[name].append(getattr(metrics, name))
+    return columns
+
+
+def test_batch_matches_scalar_loop():
+    pwm, pressure, hours = make_samples()
+    # Storico ostruzione e indice non banali, uguali per i due percorsi
+    scalar, batch = app.PredictiveAlgorithm(), app.PredictiveAlgorithm()
+    for algorithm in (scalar, batch):
+        algorithm.obstruction_history = [1.0 + i / 10 for i in range(10)]
+        algorithm.history_index = 3
+
+    expected = scalar_results(scalar, pwm, pressure, hours)
+    result = batch.calculate_metrics_batch(pwm, pressure, hours, update_state=True)
+
+    assert set(result) == set(expected)
+    for name, values in expected.items():
+        expected_array = np.array(values, dtype=result[name].dtype)
+        assert np.array_equal(result[name], expected_array, equal_nan=result[name].dtype != bool), name
+
+    assert batch.obstruction_history == scalar.obstruction_history
+    assert batch.history_index == scalar.history_index
+
+
+def test_batch_without_state_update_leaves_history():
+    pwm, pressure, hours = make_samples(50, seed=1)
+    algorithm = app.PredictiveAlgorithm()
+    history = list(algorithm.obstruction_history)
+
+    algorithm.calculate_metrics_batch(pwm, pressure, hours)
+
+    assert algorithm.obstruction_history == history
+    assert algorithm.history_index == 0
@@ -0,0 +1,80 @@
+"""
+Tabella PWM -> curve ventole scalate: coerenza con il calcolo per campione e invalidazione
+
+Esecuzione: python -m pytest -q tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def direct_curves(algorithm, pwm):
+    """Curve scalate calcolate come nel percorso per campione (senza tabella)"""
+    scale_factor = algorithm.convert_blynk_pwm_to_real_speed(float(pwm)) / 100.0
+    return algorithm.fan_flow_total * scale_factor, algorithm.fan_pressure * scale_factor * scale_factor
+
+
+def assert_table_matches(algorithm):
+    q_table, p_table = algorithm.fan_curve_table()
+    for pwm in range(101):
+        flow, pressure = direct_curves(algorithm, pwm)
+        assert np.array_equal(q_table[pwm], flow), pwm
+        assert np.array_equal(p_table[pwm], pressure), pwm
+
+
+def test_table_matches_per_sample_curves():
+    algorithm = app.PredictiveAlgorithm()
+    assert_table_matches(algorithm)
+    for pwm in (0, 1, 37, 99, 100):
+        flow, pressure = algorithm.scaled_fan_curves(pwm)
+        assert np.array_equal((flow, pressure), direct_curves(algorithm, pwm))
+
+
+@pytest.mark.parametrize('name, value', [
+    ('fan_flow_total', np.array([0, 1100, 2100, 3100, 4100, 5100, 6000])),
+    ('fan_pressure', np.array([460, 330, 250, 190, 130, 80, 30])),
+    ('MIN_FAN_SPEED_PWM', 80),
+    ('MAX_FAN_SPEED_PWM', 180),
+])
+def test_assignment_rebuilds_table(name, value):
+    algorithm = app.PredictiveAlgorithm()
+    before = algorithm.fan_curve_table()
+
+    setattr(algorithm, name, value)
+
+    after = algorithm.fan_curve_table()
+    assert not np.array_equal(before[0][50], after[0][50]) or not np.array_equal(before[1][50], after[1][50])
+    assert_table_matches(algorithm)
+
+
+def test_configure_rebuilds_table():
+    algorithm = app.PredictiveAlgorithm()
+    algorithm.fan_curve_table()
+
+    algorithm.configure(fan_flow=[0, 600, 1200, 1800, 2400, 3000, 3500], MAX_FAN_SPEED_PWM=170)
+
+    assert algorithm.fan_flow_total[1] == 1200
+    assert_table_matches(algorithm)
+
+
+def test_in_place_edit_is_rejected():
+    algorithm = app.PredictiveAlgorithm()
+    curve = np.array([0, 1100, 2100, 3100, 4100, 5100, 6000])
+    algorithm.fan_flow_total = curve
+    algorithm.fan_curve_table()
+
+    with pytest.raises(ValueError):
+        algorithm.fan_flow_total[0] = 99
+    with pytest.raises(ValueError):
+        algorithm.fan_pressure[0] = 99
+
+    # La curva del chiamante è copiata: resta modificabile e non altera la tabella
+    curve[1] = 0
+    assert algorithm.fan_flow_total[1] == 1100
+    assert_table_matches(algorithm)
@@ -0,0 +1,22 @@
+"""
+Importare app (come fanno replay, sweep, export e simulate) non deve aprire né creare DB_PATH
+
+Esecuzione: python -m pytest -q tests
+"""
+import os
+import sys
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_has_no_database_side_effects(tmp_path):
+    db_path = tmp_path / 'data' / 'test_data.db'
+    env = {**os.environ, 'DB_PATH': str(db_path), 'FLEET_CONFIG': '', 'PROFILER_HZ': '0', 'APP_ROLE': 'all'}
+    code = 'import app, threading; assert app.database is None; print(threading.active_count())'
+
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '1'
+    assert not db_path.parent.exists()